@@ -0,0 +1,94 @@
+'''
+persisted membership of the actors in the areas of all admin levels
+
+the areas the administrative locations of the actors lie in are determined
+with a spatial join once, when the locations or the areas are saved (resp.
+uploaded in bulk), so that filtering actors by areas is an integer join
+against ActorInArea instead of a point-in-polygon query
+
+geometries drawn ad hoc (not stored as areas) still have to be queried
+spatially
+'''
+from django.db import connection, transaction
+
+
+def _quoted_tables():
+    from repair.apps.asmfa.models import ActorInArea, AdministrativeLocation
+    from repair.apps.studyarea.models import Area
+    qn = connection.ops.quote_name
+    return (qn(ActorInArea._meta.db_table),
+            qn(AdministrativeLocation._meta.db_table),
+            qn(Area._meta.db_table))
+
+
+def _insert(column=None, ids=None, batch_size=1000):
+    '''
+    insert the memberships found by intersecting the locations with the
+    areas, restricted to the ids in the given column of the join
+    ('l.actor_id' or 'a.id') if given
+    '''
+    qn = connection.ops.quote_name
+    membership_table, location_table, area_table = _quoted_tables()
+    query = (
+        f'INSERT INTO {membership_table} ({qn("actor_id")}, {qn("area_id")}) '
+        f'SELECT l.{qn("actor_id")}, a.{qn("id")} '
+        f'FROM {area_table} a '
+        f'INNER JOIN {location_table} l '
+        f'ON ST_Intersects(a.{qn("geom")}, l.{qn("geom")}) '
+        f'WHERE l.{qn("actor_id")} IS NOT NULL'
+    )
+    with connection.cursor() as cursor:
+        if column is None:
+            cursor.execute(query)
+            return
+        ids = list(ids)
+        for i in range(0, len(ids), batch_size):
+            batch = ids[i:i + batch_size]
+            cursor.execute(
+                f'{query} AND {column} IN ({", ".join(["%s"] * len(batch))})',
+                batch)
+
+
+def update_actor_areas(actor_ids):
+    '''redetermine the areas the actors with the given ids lie in'''
+    from repair.apps.asmfa.models import ActorInArea
+    actor_ids = set(actor_ids)
+    if not actor_ids:
+        return
+    with transaction.atomic():
+        ActorInArea.objects.filter(actor_id__in=actor_ids).delete()
+        _insert('l.actor_id', actor_ids)
+
+
+def update_area_actors(area_ids):
+    '''redetermine the actors lying in the areas with the given ids'''
+    from repair.apps.asmfa.models import ActorInArea
+    area_ids = set(area_ids)
+    if not area_ids:
+        return
+    with transaction.atomic():
+        ActorInArea.objects.filter(area_id__in=area_ids).delete()
+        _insert('a.id', area_ids)
+
+
+def rebuild_actor_areas():
+    '''redetermine the memberships of all actors in all areas'''
+    from repair.apps.asmfa.models import ActorInArea
+    with transaction.atomic():
+        ActorInArea.objects.all().delete()
+        _insert()
+
+
+def update_on_location_save(sender, instance, **kwargs):
+    if instance.actor_id is not None:
+        update_actor_areas([instance.actor_id])
+
+
+def update_on_location_delete(sender, instance, **kwargs):
+    from repair.apps.asmfa.models import ActorInArea
+    if instance.actor_id is not None:
+        ActorInArea.objects.filter(actor_id=instance.actor_id).delete()
+
+
+def update_on_area_save(sender, instance, **kwargs):
+    update_area_actors([instance.id])
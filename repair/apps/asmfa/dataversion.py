@@ -0,0 +1,121 @@
+'''
+per-keyflow counter of the versions of the data
+
+the counter (KeyflowInCasestudy.data_version) is bumped whenever data the
+results calculated for the keyflow depend on changes (flows, actors,
+locations, areas, materials, indicators and the calculation of strategies),
+results can be cached as long as the version doesn't change
+
+a second counter (KeyflowInCasestudy.statusquo_version) is bumped by the
+same changes except the calculation of strategies, results of one strategy
+don't have to be discarded when another one is calculated
+'''
+import threading
+from contextlib import contextmanager
+
+from django.db.models import F
+
+_local = threading.local()
+
+
+def get_data_version(keyflow_id):
+    '''return the current version of the data of the keyflow'''
+    from repair.apps.asmfa.models import KeyflowInCasestudy
+    return KeyflowInCasestudy.objects.values_list(
+        'data_version', flat=True).get(id=keyflow_id)
+
+
+def bump_data_version(statusquo=True, **kwargs):
+    '''
+    increase the versions of the keyflows matching the filter arguments
+    (e.g. id=1 or casestudy=2), all keyflows if none are given,
+    statusquo=False for changes of strategies (the status quo version is
+    kept)
+    '''
+    from repair.apps.asmfa.models import KeyflowInCasestudy
+    if getattr(_local, 'suppressed', False):
+        return
+    pending = getattr(_local, 'pending', None)
+    if pending is not None:
+        key = repr(sorted(kwargs.items()))
+        statusquo = statusquo or pending.get(key, (kwargs, False))[1]
+        pending[key] = (kwargs, statusquo)
+        return
+    versions = {'data_version': F('data_version') + 1}
+    if statusquo:
+        versions['statusquo_version'] = F('statusquo_version') + 1
+    # the update is part of the transaction of the change, a rolled back
+    # change doesn't invalidate anything
+    KeyflowInCasestudy.objects.filter(**kwargs).update(**versions)
+
+
+@contextmanager
+def bulk_changes():
+    '''
+    context for changing many rows at once, the versions are bumped once per
+    distinct filter when leaving the context instead of on every change
+    '''
+    if getattr(_local, 'pending', None) is not None:
+        # nested, the outer context bumps
+        yield
+        return
+    _local.pending = {}
+    try:
+        yield
+    finally:
+        pending = _local.pending
+        _local.pending = None
+        for kwargs, statusquo in pending.values():
+            bump_data_version(statusquo=statusquo, **kwargs)
+
+
+@contextmanager
+def suppress_bumps():
+    '''
+    context for changes whose versions are bumped by the caller (e.g. in the
+    processes of a parallel run), nothing is bumped within the context
+    '''
+    suppressed = getattr(_local, 'suppressed', False)
+    _local.suppressed = True
+    try:
+        yield
+    finally:
+        _local.suppressed = suppressed
+
+
+def bump_on_change(sender, instance, **kwargs):
+    '''receiver for models related to a keyflow (flows, indicators)'''
+    # flows created by strategies don't change the status quo
+    statusquo = getattr(instance, 'strategy_id', None) is None
+    bump_data_version(statusquo=statusquo, id=instance.keyflow_id)
+
+
+def bump_on_indicator_flow_change(sender, instance, **kwargs):
+    '''
+    receiver for the flows of indicators, they are related to the keyflow via
+    their indicators only (connect to pre_delete, the indicators lose their
+    reference on delete)
+    '''
+    bump_data_version(flowindicator__flow_a=instance.id)
+    bump_data_version(flowindicator__flow_b=instance.id)
+
+
+def bump_on_actor_change(sender, instance, **kwargs):
+    bump_data_version(activitygroup__activity=instance.activity_id)
+
+
+def bump_on_location_change(sender, instance, **kwargs):
+    if instance.actor_id is not None:
+        bump_data_version(activitygroup__activity__actor=instance.actor_id)
+
+
+def bump_on_area_change(sender, instance, **kwargs):
+    bump_data_version(casestudy__adminlevels=instance.adminlevel_id)
+
+
+def bump_on_material_change(sender, instance, **kwargs):
+    # materials without keyflow are shared by all keyflows
+    if instance.keyflow_id is None:
+        bump_data_version()
+    else:
+        bump_data_version(id=instance.keyflow_id)
@@ -0,0 +1,99 @@
+'''
+process-level cache of the graphs loaded from files
+
+the graphs are kept by their file name and the time of the last modification
+of the file, graphs of outdated files are reloaded automatically; if the
+summed up size of the cached graphs exceeds settings.GRAPH_CACHE_SIZE (in
+bytes, estimated by the size of the files), the least recently used graphs
+are evicted
+'''
+try:
+    import graph_tool as gt
+except ModuleNotFoundError:
+    pass
+import os
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+
+class GraphCache:
+    '''
+    least recently used cache of graphs with a memory budget
+
+    Parameters
+    ----------
+    max_size: int, optional
+       the budget in bytes, defaults to settings.GRAPH_CACHE_SIZE
+    '''
+    def __init__(self, max_size=None):
+        self._max_size = max_size
+        # filename -> (modification time, size, graph)
+        self._graphs = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def max_size(self):
+        if self._max_size is not None:
+            return self._max_size
+        return getattr(settings, 'GRAPH_CACHE_SIZE', 512 * 1024 ** 2)
+
+    @property
+    def size(self):
+        '''the estimated size of all cached graphs in bytes'''
+        with self._lock:
+            return sum(size for mtime, size, graph in self._graphs.values())
+
+    def __len__(self):
+        return len(self._graphs)
+
+    def __contains__(self, filename):
+        return filename in self._graphs
+
+    def get(self, filename):
+        '''
+        return a copy of the graph stored in the file, the graph is only read
+        from the file if it is not cached yet or the file was modified since
+
+        raises FileNotFoundError if there is no such file
+        '''
+        stat = os.stat(filename)
+        with self._lock:
+            cached = self._graphs.get(filename)
+            if cached and cached[0] == stat.st_mtime_ns:
+                self._graphs.move_to_end(filename)
+                graph = cached[2]
+            else:
+                graph = None
+        if graph is None:
+            graph = gt.load_graph(filename)
+            self._put(filename, stat, graph)
+        # copying the graph in memory is a lot cheaper than parsing the file,
+        # changes of the callers don't affect the cached graph
+        return gt.Graph(graph)
+
+    def _put(self, filename, stat, graph):
+        with self._lock:
+            self._graphs[filename] = (stat.st_mtime_ns, stat.st_size, graph)
+            self._graphs.move_to_end(filename)
+            size = sum(size for mtime, size, g in self._graphs.values())
+            # evict the least recently used graphs, the latest one is kept
+            # even if it exceeds the budget on its own
+            while size > self.max_size and len(self._graphs) > 1:
+                fn, (mtime, evicted_size, g) = self._graphs.popitem(
+                    last=False)
+                size -= evicted_size
+
+    def invalidate(self, filename):
+        '''remove the graph of the file from the cache'''
+        with self._lock:
+            self._graphs.pop(filename, None)
+
+    def clear(self):
+        '''remove all graphs from the cache'''
+        with self._lock:
+            self._graphs.clear()
+
+
+graph_cache = GraphCache()
@@ -5,10 +5,20 @@ try:
     import cairo
 except ModuleNotFoundError:
     pass
+try:
+    from scipy.spatial import cKDTree
+except ModuleNotFoundError:
+    pass
+try:
+    import fcntl
+except ModuleNotFoundError:
+    # no file locks on windows
+    fcntl = None
 
-from django.db.models import Q, Sum, F
+from django.db.models import Q, F, Sum
+from django.contrib.gis.db.models.functions import Transform
 from django.db.models.functions import Coalesce
-from django.db import connection
+from django.db import connection, transaction
 import numpy as np
 import pandas as pd
 import datetime
@@ -18,19 +28,38 @@ import os
 from datetime import datetime
 from itertools import chain
 import itertools
-import time
+import json
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
 
 from repair.apps.asmfa.models import (Actor2Actor, FractionFlow, Actor,
                                       ActorStock, Material,
                                       StrategyFractionFlow)
-from repair.apps.utils.utils import get_annotated_fractionflows
-from repair.apps.changes.models import (SolutionInStrategy,
+from repair.apps.utils.utils import (get_annotated_fractionflows,
+                                     clear_strategy_flows,
+                                     refresh_strategy_flows)
+from repair.apps.asmfa.dataversion import bump_data_version, suppress_bumps
+from repair.apps.changes.models import (Strategy, SolutionInStrategy,
                                         ImplementationQuantity,
                                         AffectedFlow, Scheme,
-                                        ImplementationArea)
+                                        ImplementationArea,
+                                        ImplementationQuestion,
+                                        PossibleImplementationArea,
+                                        SolutionPart, FlowReference)
 from repair.apps.statusquo.models import SpatialChoice
 from repair.apps.utils.utils import descend_materials, copy_django_model
 from repair.apps.asmfa.graphs.graphwalker import GraphWalker
+from repair.apps.asmfa.graphs.cache import graph_cache
+from repair.apps.asmfa.graphs.snapshot import (GraphSnapshot, write_snapshot,
+                                               remove_snapshot, diff_snapshots,
+                                               read_meta)
+
+logger = logging.getLogger(__name__)
+
+# the graph files locked by the current thread
+_held_locks = threading.local()
 
 
 class Formula:
@@ -99,8 +128,10 @@ class AbsoluteFormula(Formula):
         self.total = 0
         self.n_flows = 0
 
-    def set_total(self, flows):
-        self.total = sum(flows.values_list('strategy_amount', flat=True))
+    def set_total(self, flows, amounts=None):
+        if amounts is None:
+            amounts = flows.values_list('strategy_amount', flat=True)
+        self.total = sum(amounts)
         self.n_flows = len(flows)
 
     def set_n_flows(self, n_flows: int):
@@ -150,6 +181,11 @@ class RelativeFormula(Formula):
 
 
 class BaseGraph:
+    # fields of the FractionFlows needed to build the graph
+    flow_fields = ['id', 'origin_id', 'destination_id', 'to_stock',
+                   'amount', 'material_id', 'process_id', 'waste',
+                   'hazardous']
+
     def __init__(self, keyflow, tag=''):
         self.keyflow = keyflow
         self.tag = tag
@@ -169,6 +205,11 @@ class BaseGraph:
         fn = "keyflow-{}-base.gt".format(self.keyflow.id)
         return os.path.join(self.path, fn)
 
+    @property
+    def snapshot_path(self):
+        '''directory of the columnar snapshot of the graph'''
+        return f'{os.path.splitext(self.filename)[0]}-snapshot'
+
     @property
     def date(self):
         if not self.exists:
@@ -180,51 +221,136 @@ class BaseGraph:
     def exists(self):
         return os.path.exists(self.filename)
 
+    @contextmanager
+    def lock(self):
+        '''
+        exclusive lock of the graph file across processes, keeps concurrent
+        builds, patches and snapshot writes from overwriting each other,
+        reentrant within a thread
+        '''
+        held = getattr(_held_locks, 'filenames', None)
+        if held is None:
+            held = _held_locks.filenames = set()
+        if fcntl is None or self.filename in held:
+            yield
+            return
+        with open(f'{self.filename}.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            held.add(self.filename)
+            try:
+                yield
+            finally:
+                held.discard(self.filename)
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
     def load(self):
-        self.graph = gt.load_graph(self.filename)
+        # the base graphs are shared by all strategies of the keyflow,
+        # they are read only once per process
+        self.graph = graph_cache.get(self.filename)
         return self.graph
 
+    def load_snapshot(self):
+        '''
+        return the memory-mapped snapshot of the graph for read-only use,
+        the snapshot is written first if it is missing or older than the
+        graph file (raises FileNotFoundError if there is no graph file)
+        '''
+        path = self.snapshot_path
+        if self._snapshot_outdated():
+            with self.lock():
+                # written by another process while waiting for the lock
+                if self._snapshot_outdated():
+                    write_snapshot(gt.load_graph(self.filename), path)
+        try:
+            return GraphSnapshot(path)
+        except FileNotFoundError:
+            # replaced while opening, the lock waits for the writer
+            with self.lock():
+                return GraphSnapshot(path)
+
+    def _snapshot_outdated(self):
+        path = self.snapshot_path
+        mtime = os.path.getmtime(self.filename)
+        return (not GraphSnapshot.exists(path) or
+                os.path.getmtime(path) < mtime)
+
+    def _graph_property(self, name, default=None):
+        '''
+        value of a graph property of the built graph, read from the meta data
+        of the snapshot (the snapshot is only written if outdated)
+        '''
+        if self._snapshot_outdated():
+            return self.load_snapshot().graph_properties.get(name, default)
+        try:
+            meta = read_meta(self.snapshot_path)
+        except FileNotFoundError:
+            # replaced in the meantime
+            return self.load_snapshot().graph_properties.get(name, default)
+        value_type, value = meta.get('graph_properties', {}).get(
+            name, (None, default))
+        return value
+
     def save(self, graph=None):
-        graph = graph or self.graph
-        self.graph.save(self.filename)
+        if graph is None:
+            graph = self.graph
+        graph_cache.invalidate(self.filename)
+        graph.save(self.filename)
+        write_snapshot(graph, self.snapshot_path)
 
     def remove(self):
         self.graph = None
+        graph_cache.invalidate(self.filename)
         if os.path.exists(self.filename):
             os.remove(self.filename)
+        remove_snapshot(self.snapshot_path)
 
     def build(self):
-        actorflows = FractionFlow.objects.filter(
-            keyflow=self.keyflow, to_stock=False)
-        stockflows = FractionFlow.objects.filter(
-            keyflow=self.keyflow, to_stock=True)
+        # the flows changed while building are patched afterwards
+        with self.lock():
+            return self._build()
+
+    def _build(self):
+        # load all flows of the keyflow at once, stocks are (as before)
+        # modelled as flows from the origin to itself
+        flows = FractionFlow.objects.filter(keyflow=self.keyflow,
+                                            strategy__isnull=True)
+        df_flows = pd.DataFrame.from_records(
+            flows.values_list(*self.flow_fields),
+            columns=self.flow_fields)
         actors = Actor.objects.filter(
-            Q(id__in=actorflows.values('origin_id')) |
-            Q(id__in=actorflows.values('destination_id')) |
-            Q(id__in=stockflows.values('origin_id'))
-        ).values()
-        flows = list(chain(actorflows.values(), stockflows.values()))
+            Q(id__in=flows.filter(to_stock=False).values('origin_id')) |
+            Q(id__in=flows.filter(to_stock=False).values('destination_id')) |
+            Q(id__in=flows.filter(to_stock=True).values('origin_id'))
+        ).order_by('id').values_list('id', 'BvDid', 'name', 'activity',
+                                     'activity__activitygroup')
+        df_actors = pd.DataFrame.from_records(
+            actors, columns=['id', 'BvDid', 'name', 'activity',
+                             'activitygroup'])
 
         self.graph = gt.Graph(directed=True)
 
         # Add the actors to the graph
-        self.graph.add_vertex(len(actors))
+        self.graph.add_vertex(len(df_actors))
         self.graph.vertex_properties["id"] = \
             self.graph.new_vertex_property("int")
         self.graph.vertex_properties["bvdid"] = \
-            self.graph.new_vertex_property("string")
+            self.graph.new_vertex_property("string",
+                                           vals=df_actors['BvDid'].tolist())
         self.graph.vertex_properties["name"] = \
-            self.graph.new_vertex_property("string")
+            self.graph.new_vertex_property("string",
+                                           vals=df_actors['name'].tolist())
         self.graph.vertex_properties["downstream_balance_factor"] = \
             self.graph.new_vertex_property("double", val=1)
-
-        actorids = {}
-        for i in range(len(actors)):
-            actor_id = actors[i]['id']
-            self.graph.vp.id[i] = actors[i]['id']
-            self.graph.vp.bvdid[i] = actors[i]['BvDid']
-            self.graph.vp.name[i] = actors[i]['name']
-            actorids[actor_id] = i
+        actor_ids = df_actors['id'].values.astype(int)
+        self.graph.vp.id.a[:] = actor_ids
+        # the flows of solution parts are selected by the activities (and
+        # groups) of their actors
+        self.graph.vertex_properties["activity"] = \
+            self.graph.new_vertex_property("int")
+        self.graph.vp.activity.a[:] = df_actors['activity'].values
+        self.graph.vertex_properties["activitygroup"] = \
+            self.graph.new_vertex_property("int")
+        self.graph.vp.activitygroup.a[:] = df_actors['activitygroup'].values
 
         # Add the flows to the graph
         # need a persistent edge id, because graph-tool can reindex the edges
@@ -239,66 +365,270 @@ class BaseGraph:
             self.graph.new_edge_property("bool")
         self.graph.edge_properties['hazardous'] = \
             self.graph.new_edge_property("bool")
+        self.graph.edge_properties['to_stock'] = \
+            self.graph.new_edge_property("bool")
 
-        for i in range(len(flows)):
-            # get the start and and actor id's
-            flow = flows[i]
-            v0 = actorids.get(flow['origin_id'])
-            if not flow['to_stock']:
-                v1 = actorids.get(flow['destination_id'])
-            else:
-                v1 = v0
-
-            if (v0 != None and v1 != None):
-                e = self.graph.add_edge(
-                    self.graph.vertex(v0), self.graph.vertex(v1))
-                self.graph.ep.id[e] = flow['id']
-                self.graph.ep.material[e] = flow['material_id']
-                self.graph.ep.waste[e] = flow['waste']
-                self.graph.ep.hazardous[e] = flow['hazardous']
-                process_id = flow['process_id']
-                self.graph.ep.process[e] = process_id\
-                     if process_id is not None else - 1
-                self.graph.ep.amount[e] = flow['amount']
-
-        #  get the original order of the vertices and edges in the graph
-        edge_index = np.fromiter(self.graph.edge_index,  dtype=int)
-        vertex_index = np.fromiter(self.graph.vertex_index,  dtype=int)
-        # get an array with the source and target ids of all edges
-        edges = self.graph.get_edges()
-        # get the amounts, sorted by the edge_index
-        amount = self.graph.ep.amount.a[edge_index]
+        self._add_flows(self.graph, df_flows)
 
-        #  put them in a Dataframe
-        df = pd.DataFrame(data={'amount': amount,
-                                'fromnode': edges[:, 0],
-                                'tonode': edges[: ,1],})
+        self.graph.vp.downstream_balance_factor.a[:] = \
+            self._calc_balance_factors(self.graph)
 
-        # sum up the in- and outflows for each node
-        sum_fromnode = df.groupby('fromnode').sum()
-        sum_fromnode.index.name = 'nodeid'
-        sum_fromnode.rename(columns={'amount': 'sum_outflows',}, inplace=True)
-        sum_tonode = df.groupby('tonode').sum()
-        sum_tonode.index.name = 'nodeid'
-        sum_tonode.rename(columns={'amount': 'sum_inflows',}, inplace=True)
-
-        # merge in- and outflows
-        merged = sum_tonode.merge(sum_fromnode, how='outer',  on='nodeid')
-        # calculate the balance_factor
-        merged['balance_factor'] = merged['sum_outflows'] / merged['sum_inflows']
-        #  set balance_factor to 1.0, if inflow or outflow is NAN
-        balance_factor = merged['balance_factor'].fillna(value=1).sort_index()
-
-        #  set balance_factor also to 1.0 if it is 0 or infinitive
-        balance_factor.loc[balance_factor==0] = 1
-        balance_factor.loc[np.isinf(balance_factor)] = 1
-
-        #  write the results to the property-map downstream_balance_factor
-        self.graph.vp.downstream_balance_factor.a[vertex_index] = balance_factor
+        # the version counts up with every build or patch of the graph
+        self._set_version(self.graph, (self.version or 0) + 1)
 
         self.save()
         return self.graph
 
+    @classmethod
+    def _add_flows(cls, graph, df_flows):
+        '''
+        add the flows (rows with the flow_fields) as edges between the
+        vertices of their actors, flows of actors not in the graph are
+        skipped
+
+        returns the vertex indices of the sources and targets of the added
+        edges
+        '''
+        if not len(df_flows):
+            return np.array([], dtype=int), np.array([], dtype=int)
+        # flows into stock end at their origin
+        to_stock = df_flows['to_stock'].values.astype(bool)
+        origins = df_flows['origin_id'].fillna(-1).values.astype(int)
+        destinations = df_flows['destination_id'].fillna(-1)\
+            .values.astype(int)
+        destinations[to_stock] = origins[to_stock]
+
+        v0 = cls._lookup_vertices(graph, origins)
+        v1 = cls._lookup_vertices(graph, destinations)
+        # skip flows with origins or destinations not in the graph
+        valid = (v0 >= 0) & (v1 >= 0)
+        v0 = v0[valid]
+        v1 = v1[valid]
+        df_flows = df_flows[valid]
+        process = df_flows['process_id'].fillna(-1).values
+
+        # columns: source, target and the values of the edge properties
+        # in the same order as passed to eprops
+        edge_list = np.column_stack([
+            v0, v1,
+            df_flows['id'].values,
+            df_flows['amount'].values,
+            df_flows['material_id'].values,
+            process,
+            df_flows['waste'].values,
+            df_flows['hazardous'].values,
+            df_flows['to_stock'].values
+        ]).astype(float)
+
+        graph.add_edge_list(
+            edge_list,
+            eprops=[graph.ep.id, graph.ep.amount,
+                    graph.ep.material, graph.ep.process,
+                    graph.ep.waste, graph.ep.hazardous, graph.ep.to_stock])
+        return v0, v1
+
+    @classmethod
+    def _lookup_vertices(cls, graph, actor_ids):
+        '''
+        return the indices of the vertices of the actors, -1 for actors not
+        in the graph
+        '''
+        # the vertices of a built graph are sorted by actor id, vertices
+        # added later on are appended, so the ids are sorted for the lookup
+        vertex_ids = graph.vp.id.a
+        order = np.argsort(vertex_ids, kind='stable')
+        idx = cls._vertex_indices(vertex_ids[order], actor_ids)
+        found = idx >= 0
+        idx[found] = order[idx[found]]
+        return idx
+
+    def _index_attributes(self, graph):
+        '''
+        add the attributes the flows of solution parts are selected by to
+        graphs built before they were part of the graph (activities and
+        activity groups of the actors, flows into stock)
+        '''
+        if 'activity' not in graph.vertex_properties.keys():
+            actors = np.array(Actor.objects.filter(
+                activity__activitygroup__keyflow=self.keyflow).values_list(
+                    'id', 'activity', 'activity__activitygroup'),
+                dtype=int).reshape(-1, 3)
+            vertices = self._lookup_vertices(graph, actors[:, 0])
+            found = vertices >= 0
+            graph.vertex_properties['activity'] = \
+                graph.new_vertex_property('int')
+            graph.vp.activity.a[vertices[found]] = actors[found, 1]
+            graph.vertex_properties['activitygroup'] = \
+                graph.new_vertex_property('int')
+            graph.vp.activitygroup.a[vertices[found]] = actors[found, 2]
+        if 'to_stock' not in graph.edge_properties.keys():
+            stock_ids = FractionFlow.objects.filter(
+                keyflow=self.keyflow, to_stock=True).values_list(
+                    'id', flat=True)
+            graph.edge_properties['to_stock'] = \
+                graph.new_edge_property('bool')
+            graph.ep.to_stock.a[:] = np.isin(graph.ep.id.a, list(stock_ids))
+
+    @property
+    def version(self):
+        '''
+        the version of the built graph, increased with every build or patch
+        (None if not built yet)
+        '''
+        if not self.exists:
+            return None
+        return self._graph_property('version', 0)
+
+    @staticmethod
+    def _set_version(graph, version):
+        graph.graph_properties['version'] = graph.new_graph_property(
+            'int', version)
+
+    def patch(self, flow_ids):
+        '''
+        update the edges of the fraction flows with the given ids (created,
+        changed or deleted since the graph was built or patched) instead of
+        rebuilding the whole graph, the balance factors are recalculated for
+        the vertices of these edges only
+
+        Parameters
+        ----------
+        flow_ids: list
+            the ids of the changed fraction flows
+
+        Returns
+        -------
+        Graph
+            the patched graph (saved)
+        '''
+        # the graph file is read and written by the patches of other
+        # processes as well
+        with self.lock():
+            return self._patch(flow_ids)
+
+    def _patch(self, flow_ids):
+        graph = self.load()
+        self._index_attributes(graph)
+        flow_ids = np.unique(np.fromiter(flow_ids, dtype=int))
+
+        # remove the outdated edges
+        edges = graph.get_edges([graph.edge_index])
+        outdated = np.isin(graph.ep.id.a[edges[:, 2]], flow_ids)
+        touched = [edges[outdated, 0], edges[outdated, 1]]
+        if outdated.any():
+            keep = graph.new_edge_property('bool')
+            keep.a[:] = ~np.isin(graph.ep.id.a, flow_ids)
+            graph.set_edge_filter(keep)
+            graph.purge_edges()
+            graph.clear_filters()
+
+        # add the edges of the flows still existing in their current state
+        rows = []
+        # sqlite limits the number of parameters of a query
+        batch_size = max(len(flow_ids), 1)
+        max_params = connection.features.max_query_params
+        if max_params:
+            batch_size = min(batch_size, max_params - 1)
+        for i in range(0, len(flow_ids), batch_size):
+            ids = flow_ids[i:i + batch_size].tolist()
+            rows.extend(FractionFlow.objects.filter(
+                keyflow=self.keyflow, strategy__isnull=True,
+                id__in=ids).values_list(*self.flow_fields))
+        df_flows = pd.DataFrame.from_records(rows, columns=self.flow_fields)
+        if len(df_flows):
+            actor_ids = set(df_flows['origin_id'].dropna()) | set(
+                df_flows['destination_id'].dropna())
+            self._add_vertices(graph, actor_ids)
+        touched.extend(self._add_flows(graph, df_flows))
+
+        touched = np.unique(np.concatenate(touched).astype(int))
+        graph.vp.downstream_balance_factor.a[touched] = \
+            self._calc_balance_factors(graph, vertices=touched)
+        # actors without any flows left are not part of the graph anymore
+        isolated = [int(v) for v in touched
+                    if graph.vertex(v).in_degree() +
+                    graph.vertex(v).out_degree() == 0]
+        if isolated:
+            graph.remove_vertex(isolated)
+
+        self._set_version(graph, (self.version or 0) + 1)
+        self.graph = graph
+        self.save()
+        return graph
+
+    @staticmethod
+    def _add_vertices(graph, actor_ids):
+        '''add vertices for those of the actors not in the graph yet'''
+        missing = set(actor_ids) - set(graph.vp.id.a.tolist())
+        if not missing:
+            return
+        actors = Actor.objects.filter(id__in=missing).order_by('id')\
+            .values_list('id', 'BvDid', 'name', 'activity',
+                         'activity__activitygroup')
+        first = graph.num_vertices()
+        graph.add_vertex(len(actors))
+        for i, (actor_id, bvdid, name, activity, group) in enumerate(actors):
+            vertex = graph.vertex(first + i)
+            graph.vp.id[vertex] = actor_id
+            graph.vp.bvdid[vertex] = bvdid
+            graph.vp.name[vertex] = name
+            graph.vp.activity[vertex] = activity
+            graph.vp.activitygroup[vertex] = group
+
+    @staticmethod
+    def _vertex_indices(vertex_ids: np.array, ids: np.array) -> np.array:
+        '''
+        vectorized lookup of the indices of the given ids in the sorted
+        vertex_ids, -1 for ids not found
+        '''
+        if not len(vertex_ids):
+            return np.full(len(ids), -1, dtype=int)
+        idx = np.searchsorted(vertex_ids, ids)
+        idx[idx >= len(vertex_ids)] = 0
+        found = vertex_ids[idx] == ids
+        idx[~found] = -1
+        return idx
+
+    @staticmethod
+    def _calc_balance_factors(graph, vertices=None) -> np.array:
+        '''
+        return the balance factors (sum of outflows / sum of inflows)
+        of all vertices (resp. of the given vertex indices) ordered by vertex
+        index, balance factors are set to 1 if there are either no inflows or
+        no outflows
+        '''
+        n_vertices = graph.num_vertices()
+        # get an array with the source, target and index of all edges
+        edges = graph.get_edges([graph.edge_index])
+        sources = edges[:, 0].astype(int)
+        targets = edges[:, 1].astype(int)
+        # get the amounts, sorted by the edge_index
+        amounts = graph.ep.amount.a[edges[:, 2].astype(int)]
+        outflows = inflows = slice(None)
+        if vertices is not None:
+            # only the edges of the given vertices are summed up
+            selected = np.zeros(n_vertices, dtype=bool)
+            selected[vertices] = True
+            outflows = selected[sources]
+            inflows = selected[targets]
+
+        # sum up the in- and outflows for each node
+        sum_outflows = np.bincount(sources[outflows],
+                                   weights=amounts[outflows],
+                                   minlength=n_vertices)
+        sum_inflows = np.bincount(targets[inflows], weights=amounts[inflows],
+                                  minlength=n_vertices)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            balance_factor = sum_outflows / sum_inflows
+
+        #  set balance_factor to 1.0 if it is nan, 0 or infinitive
+        balance_factor[~np.isfinite(balance_factor) |
+                       (balance_factor == 0)] = 1
+        if vertices is not None:
+            return balance_factor[vertices]
+        return balance_factor
+
     def validate(self):
         """Validate flows for a graph"""
         invalid = []
@@ -320,9 +650,10 @@ class BaseGraph:
             return 'Graph is valid'
 
     def serialize(self):
-        flows = []
         if not self.graph:
-            self.load()
+            # reading the columns is a lot faster than loading the graph
+            return self.load_snapshot().serialize()
+        flows = []
         for e in self.graph.edges():
             flow = {}
             flow['id'] = self.graph.ep.id[e]
@@ -340,6 +671,12 @@ class StrategyGraph(BaseGraph):
         self.strategy = strategy
         self.tag = tag
         self.graph = None
+        # flow id -> edge and actor id -> vertex
+        self._flow_edges = {}
+        self._actor_vertices = {}
+        # True if changes in the graph alter the selection of flows from the
+        # database (changed materials or processes)
+        self._selection_changed = False
 
     @property
     def filename(self):
@@ -354,27 +691,52 @@ class StrategyGraph(BaseGraph):
         self.graph = gt.load_graph(self.filename)
         return self.graph
 
+    @property
+    def base_version(self):
+        '''
+        the version of the base graph the strategy was calculated with
+        (None if not calculated yet), the calculation is outdated if it
+        differs from the current version of the base graph
+        '''
+        if not self.exists:
+            return None
+        return self._graph_property('base_version')
+
+    def diff(self):
+        '''
+        the flows changed by the strategy compared to the base graph (see
+        diff_snapshots), computed on the snapshots without loading the graphs
+        '''
+        base_graph = BaseGraph(self.keyflow, tag=self.tag)
+        return diff_snapshots(base_graph.load_snapshot(),
+                              self.load_snapshot())
+
     def _modify_flows(self, flows, formula: Formula, new_material=None, new_process=None,
                       new_waste=-1, new_hazardous=-1):
         '''
         modify flows with formula
         '''
         deltas = []
+        amounts = self._strategy_amounts(flows)
         if formula.is_absolute:
-            formula.set_total(flows)
+            formula.set_total(flows, amounts=amounts)
         if (new_material or new_process or
             new_waste >= 0 or new_hazardous >= 0):
             edges = self._get_edges(flows)
+        # the flows are selected by material and process in the database
+        if new_material or new_process:
+            self._selection_changed = True
         for i, flow in enumerate(flows):
-            delta = formula.calculate_delta(flow.strategy_amount)
+            amount = amounts[i]
+            delta = formula.calculate_delta(amount)
             if formula.is_absolute:
                 # cut the delta to avoid negative flow amounts
-                delta = max(-flow.strategy_amount, delta)
+                delta = max(-amount, delta)
             # if we have a relative change (*1.5),
             # then the delta is +0.5*strategy_amount
             #  so we have to substract the original amount
             else:
-                delta -= flow.strategy_amount
+                delta -= amount
 
             deltas.append(delta)
             if new_material:
@@ -398,13 +760,14 @@ class StrategyGraph(BaseGraph):
 
         new_flows = []
         if not flow_count:
-            print('WARNING: No orgins and/or destinations found '
-                  'while creating new flows')
+            logger.warning('No origins and/or destinations found '
+                           'while creating new flows')
             return new_flows, np.empty((0, ))
         formula.set_n_flows(flow_count)
         # equal distribution
         amount_per_flow = formula.calculate_delta()
         deltas = np.full((flow_count), amount_per_flow)
+        new_edges = []
         for origin, destination in itertools.product(origins, destinations):
             new_flow = FractionFlow(
                 origin=origin, destination=destination,
@@ -413,21 +776,17 @@ class StrategyGraph(BaseGraph):
                 strategy=self.strategy,
                 keyflow=self.keyflow
             )
-            #new_flows.append(new_flow)
-            # spatialite doesn't set the ids when bulk creating
-            # when saving it does (weird)
-            new_flow.save()
             o_vertex = self._get_vertex(origin.id)
             d_vertex = self._get_vertex(destination.id)
             new_edge = self.graph.add_edge(o_vertex, d_vertex)
-            self.graph.ep.id[new_edge] = new_flow.id
             self.graph.ep.amount[new_edge] = 0
             self.graph.ep.material[new_edge] = new_flow.material.id
             self.graph.ep.process[new_edge] = \
                 new_flow.process.id if new_flow.process is not None else - 1
             new_flows.append(new_flow)
+            new_edges.append(new_edge)
 
-        #FractionFlow.objects.bulk_create(new_flows)
+        self._save_new_flows(new_flows, new_edges)
         return new_flows, deltas
 
     def _shift_flows(self, referenced_flows, possible_new_targets,
@@ -446,6 +805,7 @@ class StrategyGraph(BaseGraph):
         '''
         changed_ref_flows = []
         new_flows = []
+        new_edges = []
         changed_ref_deltas = []
         new_deltas = []
 
@@ -457,11 +817,12 @@ class StrategyGraph(BaseGraph):
         # actors in possible new targets that are closest
         closest_dict = self.find_closest_actor(actors_kept,
                                                possible_new_targets)
+        amounts = self._strategy_amounts(referenced_flows)
         if formula.is_absolute:
-            formula.set_total(referenced_flows)
+            formula.set_total(referenced_flows, amounts=amounts)
 
         # create new flows and add corresponding edges
-        for flow in referenced_flows:
+        for flow, amount in zip(referenced_flows, amounts):
             kept_id = flow.destination_id if shift_origin \
                 else flow.origin_id
 
@@ -474,19 +835,16 @@ class StrategyGraph(BaseGraph):
 
             new_vertex = self._get_vertex(new_id)
 
-            delta = formula.calculate_delta(flow.strategy_amount)
-            delta = min(delta, flow.strategy_amount)
+            delta = formula.calculate_delta(amount)
+            delta = min(delta, amount)
 
             # the edge corresponding to the referenced flow
             # (the one to be shifted)
-            edges = util.find_edge(self.graph, self.graph.ep['id'], flow.id)
-            if len(edges) > 1:
-                raise ValueError("FractionFlow.id ", flow.id,
-                                 " is not unique in the graph")
-            elif len(edges) == 0:
-                print("Cannot find FractionFlow.id ", flow.id, " in the graph")
+            edge = self._flow_edges.get(flow.id)
+            if edge is None:
+                logger.warning(
+                    f'Cannot find FractionFlow.id {flow.id} in the graph')
                 continue
-            edge = edges[0]
 
             new_edge_args = [new_vertex, edge.target()] if shift_origin \
                 else [edge.source(), new_vertex]
@@ -515,11 +873,9 @@ class StrategyGraph(BaseGraph):
 
             # strategy marks flow as new flow
             new_flow.strategy = self.strategy
-            new_flow.save()
 
             # create the edge in the graph
             new_edge = self.graph.add_edge(*new_edge_args)
-            self.graph.ep.id[new_edge] = new_flow.id
             self.graph.ep.amount[new_edge] = 0
 
             self.graph.ep.material[new_edge] = new_flow.material.id
@@ -531,6 +887,7 @@ class StrategyGraph(BaseGraph):
             self.graph.ep.hazardous[new_edge] = new_flow.hazardous
 
             new_flows.append(new_flow)
+            new_edges.append(new_edge)
             new_deltas.append(delta)
 
             # reduce (resp. increase) the referenced flow by the same amount
@@ -538,6 +895,8 @@ class StrategyGraph(BaseGraph):
                 changed_ref_flows.append(flow)
                 changed_ref_deltas.append(-delta)
 
+        self._save_new_flows(new_flows, new_edges)
+
         # new flows shall be created before modifying the existing ones
         return new_flows + changed_ref_flows, new_deltas + changed_ref_deltas
 
@@ -560,6 +919,7 @@ class StrategyGraph(BaseGraph):
                 'Formula for PrependFlow and AppendFlow must be relative')
 
         new_flows = []
+        new_edges = []
         deltas = []
 
         ids = referenced_flows.values_list('destination') if prepend\
@@ -569,8 +929,10 @@ class StrategyGraph(BaseGraph):
         closest_dict = self.find_closest_actor(actors_kept,
                                                possible_new_targets)
 
+        amounts = self._strategy_amounts(referenced_flows)
+
         # create new flows and add corresponding edges
-        for flow in referenced_flows:
+        for flow, amount in zip(referenced_flows, amounts):
             kept_id = flow.destination_id if prepend \
                 else flow.origin_id
 
@@ -583,17 +945,14 @@ class StrategyGraph(BaseGraph):
 
             new_vertex = self._get_vertex(new_id)
 
-            delta = formula.calculate_delta(flow.strategy_amount)
+            delta = formula.calculate_delta(amount)
 
             # the edge corresponding to the referenced flow
-            edges = util.find_edge(self.graph, self.graph.ep['id'], flow.id)
-            if len(edges) > 1:
-                raise ValueError("FractionFlow.id ", flow.id,
-                                 " is not unique in the graph")
-            elif len(edges) == 0:
-                print("Cannot find FractionFlow.id ", flow.id, " in the graph")
+            edge = self._flow_edges.get(flow.id)
+            if edge is None:
+                logger.warning(
+                    f'Cannot find FractionFlow.id {flow.id} in the graph')
                 continue
-            edge = edges[0]
 
             new_edge_args = [new_vertex, edge.source()] if prepend \
                 else [edge.target(), new_vertex]
@@ -624,11 +983,9 @@ class StrategyGraph(BaseGraph):
 
             # strategy marks flow as new flow
             new_flow.strategy = self.strategy
-            new_flow.save()
 
             # create the edge in the graph
             new_edge = self.graph.add_edge(*new_edge_args)
-            self.graph.ep.id[new_edge] = new_flow.id
             self.graph.ep.amount[new_edge] = 0
 
             self.graph.ep.material[new_edge] = new_flow.material.id
@@ -640,10 +997,41 @@ class StrategyGraph(BaseGraph):
             self.graph.ep.hazardous[new_edge] = new_flow.hazardous
 
             new_flows.append(new_flow)
+            new_edges.append(new_edge)
             deltas.append(delta)
 
+        self._save_new_flows(new_flows, new_edges)
         return new_flows, deltas
 
+    def _save_new_flows(self, new_flows, new_edges):
+        '''
+        create the new flows in the database and link them to their edges
+        '''
+        if connection.features.can_return_ids_from_bulk_insert:
+            FractionFlow.objects.bulk_create(new_flows)
+        else:
+            # spatialite doesn't set the ids when bulk creating
+            # when saving it does (weird), the build bumps the version once
+            # at the end
+            with suppress_bumps():
+                for new_flow in new_flows:
+                    new_flow.save()
+        for new_flow, new_edge in zip(new_flows, new_edges):
+            self.graph.ep.id[new_edge] = new_flow.id
+            self._flow_edges[new_flow.id] = new_edge
+
+    def _strategy_amounts(self, flows):
+        '''
+        the current amounts of the flows in the strategy, taken from the graph
+        (the database might not be up to date if the persistence is deferred)
+        '''
+        amounts = []
+        for flow in flows:
+            edge = self._flow_edges.get(flow.id)
+            amounts.append(flow.strategy_amount if edge is None
+                           else self.graph.ep.amount[edge])
+        return amounts
+
     def clean_db(self):
         '''
         wipe all related StrategyFractionFlows
@@ -653,39 +1041,69 @@ class StrategyGraph(BaseGraph):
         new_flows.delete()
         modified = StrategyFractionFlow.objects.filter(strategy=self.strategy)
         modified.delete()
+        # the deleted flows send no signals
+        self._bump_versions()
+
+    def _bump_versions(self):
+        '''
+        bump the data version of the keyflow (keeping its status quo version)
+        and the build version of the strategy
+        '''
+        bump_data_version(statusquo=False, id=self.strategy.keyflow_id)
+        Strategy.objects.filter(id=self.strategy.id).update(
+            build_version=F('build_version') + 1)
+
+    @staticmethod
+    def _filter_actors(activity, area, implementation):
+        '''
+        return the actors of the activity, filtered by the implementation area
+        (drawn by the user, the possible implementation area otherwise) if
+        an area is given
+        '''
+        actors = Actor.objects.filter(activity=activity)
+        if area:
+            # implementation area
+            implementation_area = area.implementationarea_set.get(
+                implementation=implementation)
+            # if user didn't draw sth. take poss. impl. area instead
+            geom = implementation_area.geom or area.geom
+            actors = actors.filter(
+                administrative_location__geom__intersects=geom)
+        return actors
 
     def _get_actors(self, flow_reference, implementation):
         origins = destinations = []
         if flow_reference.origin_activity:
-            origins = Actor.objects.filter(
-                activity=flow_reference.origin_activity)
-            # filter by origin area
-            if flow_reference.origin_area:
-                # implementation area
-                implementation_area = flow_reference.origin_area\
-                    .implementationarea_set.get(implementation=implementation)
-                # if user didn't draw sth. take poss. impl. area instead
-                geom = implementation_area.geom or flow_reference.origin_area.geom
-                origins = origins.filter(
-                            administrative_location__geom__intersects=geom)
+            origins = self._filter_actors(flow_reference.origin_activity,
+                                          flow_reference.origin_area,
+                                          implementation)
         if flow_reference.destination_activity:
-            destinations = Actor.objects.filter(
-                activity=flow_reference.destination_activity)
-            # filter by destination area
-            if flow_reference.destination_area:
-                implementation_area = flow_reference.destination_area\
-                    .implementationarea_set.get(implementation=implementation)
-                geom = implementation_area.geom or \
-                    flow_reference.destination_area.geom
-                destinations = destinations.filter(
-                            administrative_location__geom__intersects=geom)
+            destinations = self._filter_actors(
+                flow_reference.destination_activity,
+                flow_reference.destination_area, implementation)
         return origins, destinations
 
+    def _edge_endpoints(self):
+        '''
+        the vertex indices of the sources and targets of the edges ordered by
+        edge index (as the arrays of the edge properties)
+        '''
+        edges = self.graph.get_edges([self.graph.edge_index])
+        n_edges = len(self.graph.ep.id.a)
+        sources = np.zeros(n_edges, dtype=int)
+        targets = np.zeros(n_edges, dtype=int)
+        idx = edges[:, 2].astype(int)
+        sources[idx] = edges[:, 0]
+        targets[idx] = edges[:, 1]
+        return sources, targets
+
     def _get_referenced_flows(self, flow_reference, implementation):
         '''
         return flows on actor level filtered by flow_reference attributes
         and implementation areas
         '''
+        # the actors are selected by subqueries, a list of the ids of the
+        # selected flows could exceed the number of parameters of a query
         origins, destinations = self._get_actors(flow_reference, implementation)
         flows = get_annotated_fractionflows(self.strategy.keyflow.id,
                                             self.strategy.id)
@@ -694,10 +1112,9 @@ class StrategyGraph(BaseGraph):
             destination__in=destinations
         )
         if flow_reference.include_child_materials:
-            impl_materials = Material.objects.filter(id__in=descend_materials(
-                [flow_reference.material]))
             kwargs = {
-                'strategy_material__in': impl_materials
+                'strategy_material__in': descend_materials(
+                    [flow_reference.material])
             }
         else:
             kwargs = {
@@ -705,59 +1122,47 @@ class StrategyGraph(BaseGraph):
             }
         if flow_reference.process:
             kwargs['strategy_process'] = flow_reference.process.id
-        reference_flows = flows.filter(**kwargs)
-        return reference_flows
+        return flows.filter(**kwargs)
 
     def _get_affected_flows(self, solution_part):
         '''
-        filters flows by definitions in solution part
-        return tuple (implementation flows, affected flows)
+        boolean mask over the edges of the flows affected by the solution part
         '''
-        # set the AffectedFlow include property to true
+        sources, targets = self._edge_endpoints()
+        activities = self.graph.vp.activity.a
+        materials = self.graph.ep.material.a
+        processes = self.graph.ep.process.a
+        not_to_stock = ~self.graph.ep.to_stock.a.astype(bool)
+        mask = np.zeros(len(materials), dtype=bool)
         affectedflows = AffectedFlow.objects.filter(
-                        solution_part=solution_part)
-        # get FractionFlows related to AffectedFlow
-        aff_flows = FractionFlow.objects.none()
-        for af in affectedflows:
-            #materials = descend_materials([af.material])
-            flows = get_annotated_fractionflows(self.strategy.keyflow.id,
-                                                self.strategy.id)
-            flows = flows.filter(
-                origin__activity = af.origin_activity,
-                destination__activity = af.destination_activity
-            )
-
-            kwargs = {
-                'strategy_material': af.material.id
-            }
-            if af.process:
-                kwargs['strategy_process': af.process]
-            aff_flows = aff_flows | flows.filter(**kwargs)
-        return aff_flows
-
-    def _include(self, flows, do_include=True):
+            solution_part=solution_part).values_list(
+                'origin_activity', 'destination_activity', 'material',
+                'process')
+        for origin, destination, material, process in affectedflows:
+            affected = ((activities[sources] == origin) &
+                        (activities[targets] == destination) &
+                        (materials == material) & not_to_stock)
+            if process:
+                affected &= processes == process
+            mask |= affected
+        return mask
+
+    def _index_graph(self):
         '''
-        include flows in graph, excludes all others
-        set do_include=False to exclude
-        graph is changed in place
+        index the edges by the ids of their flows and the vertices by the ids
+        of their actors, has to be done every time the graph is replaced
         '''
-        start = time.time()
-        # include affected edges
-        edges = self._get_edges(flows)
-        for edge in edges:
-            self.graph.ep.include[edge] = do_include
-        end = time.time()
-
-    def _reset_include(self, do_include=True):
-        # exclude all
-        self.graph.ep.include.a[:] = do_include
+        self._flow_edges = {self.graph.ep.id[e]: e
+                            for e in self.graph.edges()}
+        self._actor_vertices = dict(zip(self.graph.vp.id.a.tolist(),
+                                        self.graph.vertices()))
 
     def _get_edges(self, flows):
         edges = []
         for flow in flows:
-            e = util.find_edge(self.graph, self.graph.ep['id'], flow.id)
-            if len(e) > 0:
-                edges.append(e[0])
+            e = self._flow_edges.get(flow.id)
+            if e is not None:
+                edges.append(e)
             else:
                 # shouldn't happen if graph is up to date
                 raise Exception(f'graph is missing flow {flow.id}')
@@ -766,14 +1171,13 @@ class StrategyGraph(BaseGraph):
     def _get_vertex(self, id):
         ''' return vertex with given id, creates vertex with corresponding
         actor information if id is not in graph yet'''
-        vertices = util.find_vertex(
-            self.graph, self.graph.vp['id'], id)
+        vertex = self._actor_vertices.get(id)
 
-        if(len(vertices) > 0):
-            return vertices[0]
+        if vertex is not None:
+            return vertex
 
         # add actor to graph
-        actor = Actor.objects.get(id=id)
+        actor = Actor.objects.select_related('activity').get(id=id)
         vertex = self.graph.add_vertex()
         # not existing in basegraph -> no flows in or out in status quo ->
         # balance factor of 1
@@ -781,340 +1185,495 @@ class StrategyGraph(BaseGraph):
         self.graph.vp.id[vertex] = id
         self.graph.vp.bvdid[vertex] = actor.BvDid
         self.graph.vp.name[vertex] = actor.name
+        self.graph.vp.activity[vertex] = actor.activity_id
+        self.graph.vp.activitygroup[vertex] = actor.activity.activitygroup_id
+        self._actor_vertices[id] = vertex
         return vertex
 
-    def build(self):
+    def build(self, callback=None, incremental=True, deferred=False):
+        '''
+        calculate the strategy based on the base graph of the keyflow
+
+        the graph is checkpointed after each solution part, if incremental is
+        True, the calculation is resumed from the checkpoint before the first
+        solution part whose inputs changed since the last build
+
+        if deferred is True, the changed flows are written to the database
+        once at the end instead of after each solution part, they are only
+        written in between if a solution part changed materials or processes
+        (the following parts select their flows by those in the database)
+
+        Parameters
+        ----------
+        callback: function, optional
+           called with the implementation and the solution part
+           every time the calculation of a solution part is done
+        incremental: bool, optional
+           resume from the last valid checkpoint, defaults to True
+        deferred: bool, optional
+           defer writing the changes to the database, defaults to False
+        '''
         base_graph = BaseGraph(self.keyflow, tag=self.tag)
         # if the base graph is not built yet, it shouldn't be done automatically
         # there are permissions controlling who is allowed to build it and
         # who isn't
         if not base_graph.exists:
             raise FileNotFoundError
-        self.graph = base_graph.load()
-        gw = GraphWalker(self.graph)
-        self.clean_db()
-        #self.mock_changes()
-        #return
 
-        # attribute marks edges to be ignored or not (defaults to False)
-        self.graph.ep.include = self.graph.new_edge_property("bool")
-        # attribute marks changed edges (defaults to False)
-        self.graph.ep.changed = self.graph.new_edge_property("bool")
+        # the materialized flows are outdated as soon as the calculation
+        # starts, the flows are selected from the strategy fraction flows
+        # directly while calculating
+        clear_strategy_flows(self.strategy)
 
         # get the implementations of the solution in this strategy
         # and order them by priority
         # wording might confuse (implementation instead of solution in strategy)
         # but we shifted to using the term "implementation" in most parts
         implementations = SolutionInStrategy.objects.filter(
-                strategy=self.strategy).order_by('priority')
-        for implementation in implementations.order_by('priority'):
+                strategy=self.strategy).order_by('priority', 'id')
+        steps = []
+        for implementation in implementations:
             solution = implementation.solution
-            parts = solution.solution_parts.all()
             # get the solution parts using the reverse relation
-            for solution_part in parts.order_by('priority'):
-                deltas = []
-                formula = Formula.from_implementation(
-                    solution_part, implementation)
-
-                # all but new flows reference existing flows (there the
-                # implementation flows are the new ones themselves)
-                reference = solution_part.flow_reference
-                changes = solution_part.flow_changes
-                if solution_part.scheme != Scheme.NEW:
-                    implementation_flows = self._get_referenced_flows(
-                        reference, implementation)
-
-                if solution_part.scheme == Scheme.MODIFICATION:
-                    kwargs = {}
-                    if changes:
-                        kwargs['new_material'] = changes.material
-                        kwargs['new_process'] = changes.process
-                        kwargs['new_waste'] = changes.waste
-                        kwargs['new_hazardous'] = changes.hazardous
-
-                    deltas = self._modify_flows(implementation_flows, formula,
-                                                **kwargs)
-
-                elif solution_part.scheme == Scheme.SHIFTDESTINATION:
-                    o, possible_destinations = self._get_actors(
-                        changes, implementation)
-                    implementation_flows, deltas = self._shift_flows(
-                        implementation_flows, possible_destinations,
-                        formula, shift_origin=False,
-                        new_material=changes.material,
-                        new_process=changes.process,
-                        new_waste=changes.waste,
-                        new_hazardous=changes.hazardous
-                    )
-
-                elif solution_part.scheme == Scheme.SHIFTORIGIN:
-                    possible_origins, d = self._get_actors(
-                        changes, implementation)
-                    implementation_flows, deltas = self._shift_flows(
-                        implementation_flows, possible_origins,
-                        formula, shift_origin=True,
-                        new_material=changes.material,
-                        new_process=changes.process,
-                        new_waste=changes.waste,
-                        new_hazardous=changes.hazardous
-                    )
-
-                elif solution_part.scheme == Scheme.NEW:
-                    origins, destinations = self._get_actors(
-                        changes, implementation)
-                    implementation_flows, deltas = self._create_flows(
-                        origins, destinations, changes.material,
-                        changes.process, formula)
-
-                elif solution_part.scheme == Scheme.PREPEND:
-                    possible_origins, d = self._get_actors(
-                        changes, implementation)
-                    if len(possible_origins) > 0:
-                        implementation_flows, deltas = self._chain_flows(
-                            implementation_flows, possible_origins,
-                            formula, prepend=True,
-                            new_material=changes.material,
-                            new_process=changes.process,
-                            new_waste=changes.waste,
-                            new_hazardous=changes.hazardous)
-                    else:
-                        print('Warning: no new targets found! Skipping prepend')
-
-                elif solution_part.scheme == Scheme.APPEND:
-                    o, possible_destinations = self._get_actors(
-                        changes, implementation)
-                    if len(possible_destinations) > 0:
-                        implementation_flows, deltas = self._chain_flows(
-                            implementation_flows, possible_destinations,
-                            formula, prepend=False,
-                            new_material=changes.material,
-                            new_process=changes.process,
-                            new_waste=changes.waste,
-                            new_hazardous=changes.hazardous)
-                    else:
-                        print('Warning: no new targets found! Skipping append')
-
-                else:
-                    raise ValueError(
-                        f'scheme {solution_part.scheme} is not implemented')
-
-                affected_flows = self._get_affected_flows(solution_part)
-                # exclude all edges
-                self._reset_include(do_include=False)
-                # include affected flows
-                self._include(affected_flows)
-                # exclude implementation flows in case they are also in affected
-                # flows (ToDo: side effects?)
-                #self._include(implementation_flows, do_include=False)
-
-                impl_edges = self._get_edges(implementation_flows)
+            parts = solution.solution_parts.all()
+            for solution_part in parts.order_by('priority', 'id'):
+                steps.append((implementation, solution_part))
+
+        keys = self._checkpoint_keys(steps, base_graph)
+        stored_keys = self._load_checkpoint_keys() if incremental else []
+        start = 0
+        for i, key in enumerate(keys):
+            if (i >= len(stored_keys) or stored_keys[i] != key or
+                not os.path.exists(self._checkpoint_filename(i))):
+                break
+            start = i + 1
+
+        if start > 0:
+            # resume from the checkpoint before the first changed part
+            self.graph = gt.load_graph(self._checkpoint_filename(start - 1))
+        else:
+            self.graph = base_graph.load()
+            self.clean_db()
+            # attribute marks edges changed by any of the calculated parts
+            self.graph.ep.touched = self.graph.new_edge_property("bool")
+        self._index_attributes(self.graph)
+        # the version of the base graph the strategy is calculated with
+        self.graph.graph_properties['base_version'] = \
+            self.graph.new_graph_property('int', base_graph.version)
+        self._index_graph()
 
-                gw = GraphWalker(self.graph)
-                self.graph = gw.calculate(impl_edges, deltas)
+        # attribute marks edges to be ignored or not (defaults to False)
+        self.graph.ep.include = self.graph.new_edge_property("bool")
+        # attribute marks changed edges (defaults to False)
+        self.graph.ep.changed = self.graph.new_edge_property("bool")
 
-                # save modifications and new flows into database
-                self.translate_to_db()
-                self.graph.ep.changed.a[:] = False
+        if start > 0:
+            self._restore_db()
+        self._save_checkpoint_keys(keys[:start])
+        if callback:
+            for implementation, solution_part in steps[:start]:
+                callback(implementation, solution_part)
+
+        self._selection_changed = False
+        for i in range(start, len(steps)):
+            implementation, solution_part = steps[i]
+            if self._selection_changed:
+                self._flush()
+            self._calculate_part(implementation, solution_part)
+            self.graph.ep.touched.a |= self.graph.ep.changed.a
+
+            # save modifications into database
+            if not deferred:
+                self._flush()
+
+            self.graph.save(self._checkpoint_filename(i))
+            self._save_checkpoint_keys(keys[:i + 1])
+
+            if callback:
+                callback(implementation, solution_part)
+
+        self._flush()
+        self._remove_checkpoints(start=len(steps))
+        # cached results of the strategy are outdated now
+        self._bump_versions()
+        # materialized with the bumped versions
+        refresh_strategy_flows(self.strategy)
 
         # save the strategy graph to a file
         self.graph.save(self.filename)
+        write_snapshot(self.graph, self.snapshot_path)
 
         return self.graph
 
-    def translate_to_db(self):
-        # ToDo: filter for changes
-        # store edges (flows) to database
-        strat_flows = []
-        changed_edges = util.find_edge(
-            self.graph, self.graph.ep['changed'], True)
-        for edge in changed_edges:
-            new_amount = self.graph.ep.amount[edge]
-            # get the related FractionFlow
-            flow = FractionFlow.objects.get(id=self.graph.ep.id[edge])
-            material = self.graph.ep.material[edge]
-            process = self.graph.ep.process[edge]
-            if process == -1:
-                process = None
-            waste = self.graph.ep.waste[edge]
-            hazardous = self.graph.ep.hazardous[edge]
-            # new flow is marked with strategy relation
-            # (no seperate strategy fraction flow needed)
-            if flow.strategy is not None:
-                flow.amount = new_amount
-                flow.hazardous = hazardous
-                flow.material_id = material
-                flow.waste = waste
-                flow.process_id = process
-                flow.save()
-            # changed flow gets a related strategy fraction flow holding changes
+    def _calculate_part(self, implementation, solution_part):
+        '''
+        calculate the changes of a solution part of an implementation and
+        apply them to the graph
+        '''
+        deltas = []
+        formula = Formula.from_implementation(
+            solution_part, implementation)
+
+        # all but new flows reference existing flows (there the
+        # implementation flows are the new ones themselves)
+        reference = solution_part.flow_reference
+        changes = solution_part.flow_changes
+        if solution_part.scheme != Scheme.NEW:
+            implementation_flows = self._get_referenced_flows(
+                reference, implementation)
+
+        if solution_part.scheme == Scheme.MODIFICATION:
+            kwargs = {}
+            if changes:
+                kwargs['new_material'] = changes.material
+                kwargs['new_process'] = changes.process
+                kwargs['new_waste'] = changes.waste
+                kwargs['new_hazardous'] = changes.hazardous
+
+            deltas = self._modify_flows(implementation_flows, formula,
+                                        **kwargs)
+
+        elif solution_part.scheme == Scheme.SHIFTDESTINATION:
+            o, possible_destinations = self._get_actors(
+                changes, implementation)
+            implementation_flows, deltas = self._shift_flows(
+                implementation_flows, possible_destinations,
+                formula, shift_origin=False,
+                new_material=changes.material,
+                new_process=changes.process,
+                new_waste=changes.waste,
+                new_hazardous=changes.hazardous
+            )
+
+        elif solution_part.scheme == Scheme.SHIFTORIGIN:
+            possible_origins, d = self._get_actors(
+                changes, implementation)
+            implementation_flows, deltas = self._shift_flows(
+                implementation_flows, possible_origins,
+                formula, shift_origin=True,
+                new_material=changes.material,
+                new_process=changes.process,
+                new_waste=changes.waste,
+                new_hazardous=changes.hazardous
+            )
+
+        elif solution_part.scheme == Scheme.NEW:
+            origins, destinations = self._get_actors(
+                changes, implementation)
+            implementation_flows, deltas = self._create_flows(
+                origins, destinations, changes.material,
+                changes.process, formula)
+
+        elif solution_part.scheme == Scheme.PREPEND:
+            possible_origins, d = self._get_actors(
+                changes, implementation)
+            if len(possible_origins) > 0:
+                implementation_flows, deltas = self._chain_flows(
+                    implementation_flows, possible_origins,
+                    formula, prepend=True,
+                    new_material=changes.material,
+                    new_process=changes.process,
+                    new_waste=changes.waste,
+                    new_hazardous=changes.hazardous)
+            else:
+                logger.warning('No new targets found! Skipping prepend')
+
+        elif solution_part.scheme == Scheme.APPEND:
+            o, possible_destinations = self._get_actors(
+                changes, implementation)
+            if len(possible_destinations) > 0:
+                implementation_flows, deltas = self._chain_flows(
+                    implementation_flows, possible_destinations,
+                    formula, prepend=False,
+                    new_material=changes.material,
+                    new_process=changes.process,
+                    new_waste=changes.waste,
+                    new_hazardous=changes.hazardous)
             else:
-                ex = StrategyFractionFlow.objects.filter(
-                    fractionflow=flow, strategy=self.strategy)
+                logger.warning('No new targets found! Skipping append')
+
+        else:
+            raise ValueError(
+                f'scheme {solution_part.scheme} is not implemented')
+
+        # include the affected flows only
+        self.graph.ep.include.a[:] = self._get_affected_flows(solution_part)
+
+        impl_edges = self._get_edges(implementation_flows)
+
+        # the walker changes the amounts of the graph in place, the edges and
+        # vertices stay valid
+        gw = GraphWalker(self.graph, in_place=True)
+        gw.calculate(impl_edges, deltas)
+
+    def _checkpoint_filename(self, step):
+        fn = (f"{self.tag}keyflow-{self.keyflow.id}-s{self.strategy.id}"
+              f"-checkpoint-{step}.gt")
+        return os.path.join(self.path, fn)
+
+    @property
+    def _checkpoint_keys_filename(self):
+        fn = (f"{self.tag}keyflow-{self.keyflow.id}-s{self.strategy.id}"
+              "-checkpoints.json")
+        return os.path.join(self.path, fn)
+
+    def _load_checkpoint_keys(self):
+        if not os.path.exists(self._checkpoint_keys_filename):
+            return []
+        with open(self._checkpoint_keys_filename) as f:
+            return json.load(f)
+
+    def _save_checkpoint_keys(self, keys):
+        with open(self._checkpoint_keys_filename, 'w') as f:
+            json.dump(keys, f)
+
+    def _remove_checkpoints(self, start=0):
+        '''remove the checkpoint files of all steps from start on'''
+        step = start
+        while os.path.exists(self._checkpoint_filename(step)):
+            os.remove(self._checkpoint_filename(step))
+            step += 1
+        if start == 0 and os.path.exists(self._checkpoint_keys_filename):
+            os.remove(self._checkpoint_keys_filename)
+
+    def _checkpoint_keys(self, steps, base_graph):
+        '''
+        hashes of the inputs of the calculation up to each step,
+        the key of a step changes if the inputs of the step or of any of the
+        steps before changed (incl. the order of the steps and the base graph)
+        '''
+        key = hashlib.sha1(repr((os.path.getmtime(base_graph.filename),
+                                 base_graph.version)).encode())
+        keys = []
+        for implementation, solution_part in steps:
+            key.update(
+                self._step_inputs(implementation, solution_part).encode())
+            keys.append(key.hexdigest())
+        return keys
+
+    @staticmethod
+    def _step_inputs(implementation, solution_part):
+        '''
+        textual representation of all user inputs and definitions
+        the calculation of the solution part in the implementation depends on
+        '''
+        references = [solution_part.flow_reference_id,
+                      solution_part.flow_changes_id]
+        inputs = [
+            SolutionInStrategy.objects.filter(
+                id=implementation.id).values('id', 'solution', 'priority'),
+            ImplementationQuantity.objects.filter(
+                implementation=implementation).order_by('id').values(
+                    'question', 'value'),
+            ImplementationArea.objects.filter(
+                implementation=implementation).order_by('id').values(
+                    'possible_implementation_area', 'geom'),
+            PossibleImplementationArea.objects.filter(
+                solution=solution_part.solution).order_by('id').values(
+                    'id', 'geom'),
+            SolutionPart.objects.filter(id=solution_part.id).values(),
+            ImplementationQuestion.objects.filter(
+                id=solution_part.question_id).values('is_absolute'),
+            FlowReference.objects.filter(id__in=references).values(),
+            AffectedFlow.objects.filter(
+                solution_part=solution_part).order_by('id').values()
+        ]
+        rows = []
+        for values in inputs:
+            for row in values:
+                # geometries are compared by their well-known text
+                rows.append({k: v.ewkt if hasattr(v, 'ewkt') else v
+                             for k, v in row.items()})
+        return repr(rows)
+
+    def _flush(self):
+        '''
+        write the changes made since the last flush to the database
+        '''
+        self.translate_to_db()
+        self.graph.ep.changed.a[:] = False
+        self._selection_changed = False
+
+    def _restore_db(self):
+        '''
+        reset the changes of the strategy in the database to the state of the
+        graph (e.g. after loading a checkpoint)
+        '''
+        # remove new flows created after the checkpoint
+        graph_ids = self.graph.ep.id.a
+        new_flows = FractionFlow.objects.filter(strategy=self.strategy)
+        new_ids = np.array(new_flows.values_list('id', flat=True), dtype=int)
+        stale_ids = np.setdiff1d(new_ids, graph_ids)
+        if len(stale_ids):
+            FractionFlow.objects.filter(id__in=stale_ids.tolist()).delete()
+        StrategyFractionFlow.objects.filter(strategy=self.strategy).delete()
+        # write all changes made up to the checkpoint, new flows might have
+        # been changed after the checkpoint as well
+        self.graph.ep.changed.a[:] = (self.graph.ep.touched.a.astype(bool) |
+                                      np.isin(graph_ids, new_ids))
+        self.translate_to_db()
+        self.graph.ep.changed.a[:] = False
+
+    def translate_to_db(self, batch_size=1000):
+        '''
+        write the changed edges to the database, the new flows of the
+        strategy are updated directly, the changes of the flows of the status
+        quo are stored as StrategyFractionFlows
+        '''
+        ep = self.graph.ep
+        changed = ep.changed.a.astype(bool)
+        if not changed.any():
+            return
+        ids = ep.id.a[changed]
+        processes = ep.process.a[changed].astype(object)
+        processes[processes == -1] = None
+        rows = list(zip(ids.tolist(),
+                        ep.amount.a[changed].tolist(),
+                        ep.material.a[changed].tolist(),
+                        processes.tolist(),
+                        ep.waste.a[changed].astype(bool).tolist(),
+                        ep.hazardous.a[changed].astype(bool).tolist()))
+
+        # new flows are marked with the strategy relation
+        # (no seperate strategy fraction flow needed)
+        new_ids = FractionFlow.objects.filter(
+            strategy=self.strategy).values_list('id', flat=True)
+        is_new = np.isin(ids, np.array(new_ids, dtype=int))
+
+        fields = ['amount', 'material', 'process', 'waste', 'hazardous']
+        with transaction.atomic():
+            new_flows = [
+                FractionFlow(id=flow_id, amount=amount, material_id=material,
+                             process_id=process, waste=waste,
+                             hazardous=hazardous)
+                for i, (flow_id, amount, material, process, waste, hazardous)
+                in enumerate(rows) if is_new[i]]
+            FractionFlow.objects.bulk_update(new_flows, fields,
+                                             batch_size=batch_size)
+            # changed flows get related strategy fraction flows holding the
+            # changes
+            changed_rows = [row for i, row in enumerate(rows)
+                            if not is_new[i]]
+            if connection.vendor == 'postgresql':
+                self._upsert_strategy_flows(changed_rows, batch_size)
+                return
+            existing = dict(StrategyFractionFlow.objects.filter(
+                strategy=self.strategy).values_list('fractionflow_id', 'id'))
+            modified = []
+            strat_flows = []
+            for (flow_id, amount, material, process, waste,
+                 hazardous) in changed_rows:
+                strat_flow = StrategyFractionFlow(
+                    id=existing.get(flow_id),
+                    strategy=self.strategy,
+                    fractionflow_id=flow_id,
+                    amount=amount,
+                    material_id=material,
+                    process_id=process,
+                    waste=waste,
+                    hazardous=hazardous
+                )
                 # if there already was a modification, overwrite it
-                if len(ex) == 1:
-                    strat_flow = ex[0]
-                    strat_flow.amount = new_amount
-                    strat_flow.material_id = material
-                    strat_flow.waste = waste
-                    strat_flow.hazardous = hazardous
-                    strat_flow.process_id = process
-                    strat_flow.save()
-                elif len(ex) > 1:
-                    raise Exception('more than StrategyFractionFlow '
-                                    'found per flow. This should not happen.')
+                if strat_flow.id is not None:
+                    modified.append(strat_flow)
                 else:
-                    strat_flow = StrategyFractionFlow(
-                        strategy=self.strategy,
-                        amount=new_amount,
-                        fractionflow=flow,
-                        material_id=material,
-                        waste=waste,
-                        hazardous=hazardous,
-                        process_id=process
-                    )
                     strat_flows.append(strat_flow)
+            StrategyFractionFlow.objects.bulk_update(
+                modified, fields, batch_size=batch_size)
+            StrategyFractionFlow.objects.bulk_create(
+                strat_flows, batch_size=batch_size)
 
-        StrategyFractionFlow.objects.bulk_create(strat_flows)
+    def _upsert_strategy_flows(self, rows, batch_size):
+        '''
+        insert the strategy fraction flows or overwrite the existing ones
+        in one statement per batch (PostgreSQL only)
+        '''
+        meta = StrategyFractionFlow._meta
+        qn = connection.ops.quote_name
+        columns = [qn(meta.get_field(field).column) for field in
+                   ['strategy', 'fractionflow', 'amount', 'material',
+                    'process', 'waste', 'hazardous']]
+        updates = ', '.join(f'{c} = EXCLUDED.{c}' for c in columns[2:])
+        placeholder = '({})'.format(', '.join(['%s'] * len(columns)))
+        with connection.cursor() as cursor:
+            for i in range(0, len(rows), batch_size):
+                batch = rows[i:i + batch_size]
+                query = (
+                    f'INSERT INTO {qn(meta.db_table)} ({", ".join(columns)}) '
+                    f'VALUES {", ".join([placeholder] * len(batch))} '
+                    f'ON CONFLICT ({columns[0]}, {columns[1]}) '
+                    f'DO UPDATE SET {updates}')
+                params = [value for row in batch
+                          for value in (self.strategy.id, ) + row]
+                cursor.execute(query, params)
+
+    @staticmethod
+    def _projected_points(actors, srid=3035):
+        '''
+        ids and projected coordinates (n x 2 array) of the administrative
+        locations of the actors, actors without location are skipped
+        '''
+        rows = actors.filter(administrative_location__geom__isnull=False)\
+            .annotate(pnt=Transform('administrative_location__geom', srid))\
+            .values_list('id', 'pnt')
+        ids = np.empty(len(rows), dtype=np.int64)
+        coords = np.empty((len(rows), 2))
+        for i, (actor_id, pnt) in enumerate(rows):
+            ids[i] = actor_id
+            coords[i] = pnt.x, pnt.y
+        return ids, coords
 
     @staticmethod
     def find_closest_actor(actors_in_solution,
                            possible_target_actors,
                            max_distance: int=500,
                            absolute_max_distance: int=100000):
+        '''
+        pick the closest one of the possible target actors for each of the
+        actors in the solution, the distances are measured in EPSG:3035
+
+        both sets of locations are fetched only once and all actors are
+        matched with a KD-tree of the possible targets at once
+
+        Parameters
+        ----------
+        actors_in_solution: QuerySet
+           the actors to find the closest target actors for
+        possible_target_actors: QuerySet
+           the actors to pick from
+        max_distance: int, optional
+           not used anymore, kept for compatibility (initial search radius
+           of the former iterative search)
+        absolute_max_distance: int, optional
+           maximum distance in meters, actors without any target within this
+           distance are not matched
+
+        Returns
+        -------
+        dict
+           the ids of the closest target actors by the ids of the actors in
+           the solution
+        '''
         # ToDo: for each actor pick a closest new one
         #     don't distribute amounts equally!
         #     (calc. amount based on the shifted flow for relative or distribute
         #      absolute total based on total amounts going into the shifted
         #      actor before?)
-        backend = connection.vendor
-        st_dwithin = {'sqlite': 'PtDistWithin',
-                      'postgresql': 'st_dwithin',}
-
-        cast_to_geography = {'sqlite': '',
-                             'postgresql': '::geography',}
-
-        # code for auto picking actor by distance
-        # start with maximum distance of 500m
-        target_actors = dict()
-
-        actors_not_found_yet = actors_in_solution
-
-        while (actors_not_found_yet
-               and max_distance < absolute_max_distance):
-
-            query_actors_in_solution = actors_not_found_yet \
-                .annotate(pnt=F('administrative_location__geom')) \
-                .values('id', 'pnt') \
-                .query
-
-            query_target_actors = possible_target_actors \
-                .annotate(pnt=F('administrative_location__geom')) \
-                .values('id', 'pnt') \
-                .query
-
-            if backend == 'sqlite':
-                querytext_actors_in_solution,  params_actors_in_solution = \
-                    query_actors_in_solution.sql_with_params()
-                querytext_actors_in_solution = \
-                    querytext_actors_in_solution.replace(
-                        'CAST (AsEWKB("asmfa_administrativelocation"."geom") AS BLOB)',
-                        '"asmfa_administrativelocation"."geom"')
-
-                querytext_target_actors, params_target_actors = \
-                    query_target_actors.sql_with_params()
-                querytext_target_actors = querytext_target_actors.replace(
-                    'CAST (AsEWKB("asmfa_administrativelocation"."geom") AS BLOB)',
-                    '"asmfa_administrativelocation"."geom"')
-
-                query = f'''
-                WITH
-                  ais AS ({querytext_actors_in_solution}),
-                  pta AS ({querytext_target_actors})
-                SELECT
-                  a.actor_id,
-                  a.target_actor_id
-                FROM
-                  (SELECT
-                    ais.id AS actor_id,
-                    pta.id AS target_actor_id,
-                    st_distance(
-                        ST_Transform(ais.pnt, 3035),
-                        ST_Transform(pta.pnt, 3035)) AS meter
-                  FROM ais, pta
-                  WHERE PtDistWithin(ais.pnt,
-                                   pta.pnt,
-                                   {max_distance})
-                  ) a,
-                  (SELECT
-                    ais.id AS actor_id,
-                    min(st_distance(
-                        ST_Transform(ais.pnt, 3035),
-                        ST_Transform(pta.pnt, 3035))) AS min_meter
-                  FROM ais, pta
-                  WHERE PtDistWithin(ais.pnt,
-                                     pta.pnt,
-                                     {max_distance})
-                  GROUP BY ais.id
-                  ) b
-                WHERE a.actor_id = b.actor_id
-                AND a.meter = b.min_meter
-                '''
-
-                params = params_actors_in_solution + params_target_actors
-
-            elif backend == 'postgresql':
-                query_actors_in_solution = str(
-                    query_actors_in_solution).replace(
-                    '"asmfa_administrativelocation"."geom"::bytea',
-                    '"asmfa_administrativelocation"."geom"')
-
-                query_target_actors = str(query_target_actors).replace(
-                    '"asmfa_administrativelocation"."geom"::bytea',
-                    '"asmfa_administrativelocation"."geom"')
-
-                query = f'''
-                WITH
-                  ais AS ({query_actors_in_solution}),
-                  pta AS ({query_target_actors})
-                SELECT
-                  a.actor_id,
-                  a.target_actor_id
-                FROM
-                  (SELECT
-                    ais.id AS actor_id,
-                    pta.id AS target_actor_id,
-                    row_number() OVER(
-                      PARTITION BY ais.id
-                      ORDER BY st_distance(
-                        ST_Transform(ais.pnt, 3035), ST_Transform(pta.pnt, 3035))
-                        ) AS rn
-                  FROM ais, pta
-                  WHERE st_dwithin(ais.pnt::geography,
-                                   pta.pnt::geography,
-                                   {max_distance})
-                  ) a
-                WHERE a.rn = 1
-                '''
-
-                params = None
-
-            else:
-                raise ConnectionError(f'unknown backend: {backend}')
-
-
-            with connection.cursor() as cursor:
-                cursor.execute(query, params)
-                rows = cursor.fetchall()
-
-            target_actors.update(dict(rows))
-
-            actors_not_found_yet = actors_in_solution.exclude(
-                id__in=target_actors.keys())
-
-            max_distance *= 2
-            max_distance = min(max_distance, absolute_max_distance)
-
-        return target_actors
+        actor_ids, actor_coords = StrategyGraph._projected_points(
+            actors_in_solution)
+        target_ids, target_coords = StrategyGraph._projected_points(
+            possible_target_actors)
+        if len(actor_ids) == 0 or len(target_ids) == 0:
+            return dict()
+
+        tree = cKDTree(target_coords)
+        distances, indices = tree.query(
+            actor_coords, k=1, distance_upper_bound=absolute_max_distance)
+        # actors without target in range get an infinite distance and the
+        # index n (number of targets)
+        found = np.isfinite(distances)
+        return dict(zip(actor_ids[found].tolist(),
+                        target_ids[indices[found]].tolist()))
 
     def mock_changes(self):
         '''make some random changes for testing'''
@@ -5,7 +5,14 @@ try:
 except ModuleNotFoundError:
     class BFSVisitor:
         pass
-import copy
+try:
+    from scipy import sparse
+    from scipy.sparse import csgraph
+    from scipy.sparse import linalg as sparse_linalg
+except ModuleNotFoundError:
+    pass
+import numpy as np
+from django.conf import settings
 
 
 class NodeVisitor(BFSVisitor):
@@ -76,7 +83,8 @@ class NodeVisitorBalanceDeltas(BFSVisitor):
             self.change[e_out] += amount_delta
 
 
-def traverse_graph(g, edge, delta, upstream=True):
+def traverse_graph(g, edge, delta, upstream=True, change=None,
+                   total_change=None):
     """Traverse the graph in a breadth-first-search manner
 
     Parameters
@@ -86,6 +94,8 @@ def traverse_graph(g, edge, delta, upstream=True):
     delta : signed change in absolute value (eg. tons) on the implementation flow (delta). For example -26.0 (tons)
     upstream : The direction of traversal. When upstream is True, the graph
                is explored upstream first, otherwise downstream first.
+    change, total_change : optional edge properties (float) to reuse as
+                           scratch space, new ones are created if not given
 
     Returns
     -------
@@ -95,8 +105,12 @@ def traverse_graph(g, edge, delta, upstream=True):
     plot = False
 
     amount = g.ep.amount
-    change = g.new_edge_property("float", val=0.0)
-    total_change = g.new_edge_property("float", val=0.0)
+    if change is None:
+        change = g.new_edge_property("float", val=0.0)
+    else:
+        change.a[:] = 0
+    if total_change is None:
+        total_change = g.new_edge_property("float", val=0.0)
 
     if plot:
         # prepare plotting of intermediate results
@@ -261,38 +275,237 @@ def reverse_graph(g, node_visitor: NodeVisitor, node_visitor2, edge):
     return node
 
 
-class GraphWalker:
-    def __init__(self, g):
-        self.graph = gt.Graph(g)
+def _solve_linear(sources, targets, amounts, balance_factor, downstream,
+                  fixed, rhs, upstream=None, balance_vertex=None):
+    """Solve the propagation of changes on edges as a sparse linear system
 
-    def calculate(self, implementation_edges, deltas):
-        """Calculate the changes on flows for a solution"""
-        # ToDo: deepcopy might be expensive. Why do we clone here?
-        # NOTE BD: initially the idea was that the this 'calculate' function
-        # returns a copy of the graph with the updated amounts. Needed to return
-        # an updated copy in order to compare this updated copy with the original
-        # graph, so we can say what was changed by the solution.
-        # For this, we need a deepcopy, otherwise the original graph would be
-        # overwritten.
-        # If it is OK to overwrite the amounts on the input graph because we
-        # have this data in the database so we can compare the output (right?),
-        # then no need to deepcopy.
-        g = copy.deepcopy(self.graph)
+    Every edge gets one equation:
 
-        # store the changes for each actor to sum total in the end
-        overall_changes = None
+    - fixed edges (the implementation edges) keep the change given in rhs
+    - the change on an edge leaving a downstream vertex is its share (by
+      amount) of the balanced inflow of the vertex (supply is pushed
+      downstream)
+    - the change on an edge entering an upstream vertex is its share (by
+      amount) of the balanced outflow of the vertex (demand is pulled
+      upstream)
+    - edges from upstream into downstream vertices (feeders) cover the
+      imbalance at the balance vertex, if given, otherwise they do not change
 
-        for i, edge in enumerate(implementation_edges):
+    The sums of the in- and outflows of the vertices are additional unknowns,
+    so the system stays as sparse as the graph itself.
 
-            g.ep.include[edge] = True
-            solution_delta = deltas[i]
-            changes = traverse_graph(g, edge=edge,
-                                     delta=solution_delta)
-            if overall_changes is None:
-                overall_changes = changes.a
-            else:
-                overall_changes += changes.a
-            g.ep.include[edge] = False
+    Parameters
+    ----------
+    sources, targets : vertex indices of the edges
+    amounts : amounts of the edges
+    balance_factor : downstream balance factors, indexed by vertex
+    downstream : bool array indexed by vertex, True for vertices downstream
+                 of the implementation edges
+    fixed : bool array, True for the edges with given changes
+    rhs : 2D array (edges x number of right-hand sides), the changes on the
+          fixed edges
+    upstream : optional bool array indexed by vertex, True for the vertices
+               upstream of the balance vertex
+    balance_vertex : optional vertex, whose imbalance is covered by the
+                     feeders going into upstream vertices
+
+    Returns
+    -------
+    2D array (edges x number of right-hand sides)
+        The signed change on the edges
+    """
+    n_edges = len(sources)
+    vertices, local = np.unique(np.concatenate([sources, targets]),
+                                return_inverse=True)
+    n_vertices = len(vertices)
+    src = local[:n_edges]
+    tgt = local[n_edges:]
+    bf = balance_factor[vertices]
+    is_downstream = downstream[vertices]
+    edges = np.arange(n_edges)
+    # columns of the inflows and outflows of the vertices
+    x = n_edges
+    y = n_edges + n_vertices
+
+    sum_out = np.bincount(src, weights=amounts, minlength=n_vertices)
+    sum_in = np.bincount(tgt, weights=amounts, minlength=n_vertices)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        out_share = np.nan_to_num(amounts / sum_out[src])
+        in_share = np.nan_to_num(amounts / sum_in[tgt])
+
+    push = ~fixed & is_downstream[src]
+    pull = ~fixed & ~is_downstream[src] & ~is_downstream[tgt]
+    feeder = ~fixed & ~is_downstream[src] & is_downstream[tgt]
+
+    rows = [edges, x + np.arange(n_vertices), y + np.arange(n_vertices),
+            # inflows and outflows
+            x + tgt, y + src,
+            # equations of the edges
+            edges[push], edges[pull]]
+    cols = [edges, x + np.arange(n_vertices), y + np.arange(n_vertices),
+            edges, edges,
+            x + src[push], y + tgt[pull]]
+    data = [np.ones(n_edges), np.ones(n_vertices), np.ones(n_vertices),
+            -np.ones(n_edges), -np.ones(n_edges),
+            -out_share[push] * bf[src[push]],
+            -in_share[pull] / bf[tgt[pull]]]
+    size = n_edges + 2 * n_vertices
+
+    if balance_vertex is not None:
+        feeder &= upstream[vertices][tgt]
+        feeder_amount = amounts[feeder].sum()
+        if feeder_amount > 0:
+            v = np.searchsorted(vertices, balance_vertex)
+            f = size
+            size += 1
+            rows += [edges[feeder], [f, f]]
+            cols += [np.full(feeder.sum(), f), [y + v, x + v]]
+            data += [-amounts[feeder] / feeder_amount, [1, -bf[v]]]
+
+    matrix = sparse.csc_matrix(
+        (np.concatenate(data),
+         (np.concatenate(rows), np.concatenate(cols))),
+        shape=(size, size))
+    b = np.zeros((size, rhs.shape[1]))
+    b[:n_edges][fixed] = rhs[fixed]
+    try:
+        solution = sparse_linalg.splu(matrix).solve(b)
+    except RuntimeError:
+        # singular system (e.g. closed cycles without any losses)
+        solution = np.column_stack(
+            [sparse_linalg.lsqr(matrix, b[:, i])[0]
+             for i in range(b.shape[1])])
+    return solution[:n_edges]
+
+
+def propagate_linear(g, implementation_edges, deltas):
+    """Calculate the changes caused by the implementation edges by solving
+    sparse linear systems instead of traversing the graph
+
+    The changes are pulled upstream of the implementation edges and pushed
+    downstream so that all vertices stay balanced (the result the
+    breadth-first-search converges to). Implementation edges sharing the
+    same target vertex are solved at once with one right-hand side per edge.
+
+    Parameters
+    ----------
+    g : the graph, the edges to explore are marked by the edge property
+        'include'
+    implementation_edges : the edges changed by the solution part
+    deltas : signed changes in absolute values on the implementation edges
+
+    Returns
+    -------
+    np.array (float)
+        The summed up signed changes, indexed by edge
+    """
+    n_slots = g.edge_index_range
+    edge_index = np.fromiter(g.edge_index, dtype=int)
+    edges = g.get_edges()
+    sources = np.zeros(n_slots, dtype=int)
+    targets = np.zeros(n_slots, dtype=int)
+    sources[edge_index] = edges[:, 0]
+    targets[edge_index] = edges[:, 1]
+    amounts = g.ep.amount.a
+    balance_factor = g.vp.downstream_balance_factor.a
+    included = np.zeros(n_slots, dtype=bool)
+    included[edge_index] = g.ep.include.a[edge_index]
+    included = np.flatnonzero(included)
+
+    changes = np.zeros(n_slots)
+    implementation = np.array(
+        [g.edge_index[edge] for edge in implementation_edges], dtype=int)
+    if not len(implementation):
+        return changes
+    deltas = np.asarray(deltas, dtype=float)
+
+    n_vertices = g.num_vertices()
+    adjacency = sparse.csr_matrix(
+        (np.ones(len(included)),
+         (sources[included], targets[included])),
+        shape=(n_vertices, n_vertices))
+
+    def reachable(matrix, vertex):
+        mask = np.zeros(n_vertices, dtype=bool)
+        mask[csgraph.breadth_first_order(
+            matrix, vertex, directed=True, return_predecessors=False)] = True
+        return mask
+
+    def solve(members, downstream, **kwargs):
+        slots = np.union1d(included, implementation[members])
+        # one right-hand side per implementation edge
+        rhs = np.zeros((len(slots), len(members)))
+        positions = np.searchsorted(slots, implementation[members])
+        rhs[positions, np.arange(len(members))] = deltas[members]
+        fixed = np.zeros(len(slots), dtype=bool)
+        fixed[positions] = True
+        solution = _solve_linear(
+            sources[slots], targets[slots], amounts[slots], balance_factor,
+            downstream, fixed, rhs, **kwargs)
+        changes[slots] += solution.sum(axis=1)
+
+    for target in np.unique(targets[implementation]):
+        downstream = reachable(adjacency, target)
+        members = np.flatnonzero(targets[implementation] == target)
+        cyclic = downstream[sources[implementation[members]]]
+        if (~cyclic).any():
+            solve(members[~cyclic], downstream)
+        # the source is downstream of its own implementation edge, the
+        # imbalance of the cycle has to be covered from upstream
+        for member in members[cyclic]:
+            source = sources[implementation[member]]
+            upstream = reachable(adjacency.T.tocsr(), source)
+            solve(np.array([member]), downstream, upstream=upstream,
+                  balance_vertex=source)
+    return changes
+
+
+class GraphWalker:
+    """Calculates the changes of solutions on the flows of a graph
+
+    Parameters
+    ----------
+    g : the graph, needs the edge properties 'amount', 'include' and
+        'changed' and the vertex property 'downstream_balance_factor'
+    engine : 'bfs' traverses the graph, 'linear' solves sparse linear
+             systems, defaults to settings.GRAPH_WALKER_ENGINE
+    in_place : if True, the changes are applied to g itself, otherwise
+               calculate returns a changed copy and g is left untouched
+    """
+    def __init__(self, g, engine=None, in_place=False):
+        self.graph = g
+        self.engine = engine or getattr(settings, 'GRAPH_WALKER_ENGINE', 'bfs')
+        self.in_place = in_place
+        self._snapshot = None
+
+    def snapshot(self):
+        """Remember the amounts and flags of the edges to roll back to"""
+        self._snapshot = {name: self.graph.ep[name].a.copy()
+                          for name in ['amount', 'changed', 'include']}
+
+    def rollback(self):
+        """Reset the amounts and flags of the edges to the last snapshot"""
+        if self._snapshot is None:
+            raise ValueError('there is no snapshot to roll back to')
+        for name, values in self._snapshot.items():
+            self.graph.ep[name].a[:len(values)] = values
+
+    def calculate(self, implementation_edges, deltas):
+        """Calculate the changes on flows for a solution
+
+        Returns
+        -------
+        Graph
+            the graph with the changed amounts, the walker's graph itself
+            if in_place, a copy otherwise
+        """
+        g = self.graph if self.in_place else gt.Graph(self.graph)
+
+        if self.engine == 'linear':
+            overall_changes = propagate_linear(
+                g, implementation_edges, deltas)
+        else:
+            overall_changes = self._traverse(g, implementation_edges, deltas)
 
         if overall_changes is not None:
             g.ep.amount.a += overall_changes
@@ -301,3 +514,25 @@ class GraphWalker:
             g.ep.changed.a[has_changed] = True
 
         return g
+
+    @staticmethod
+    def _traverse(g, implementation_edges, deltas):
+        if not len(implementation_edges):
+            return None
+        # scratch space shared by all traversals
+        change = g.new_edge_property('float')
+        total_change = g.new_edge_property('float')
+        # store the changes for each actor to sum total in the end
+        overall_changes = np.zeros(len(g.ep.amount.a))
+
+        for i, edge in enumerate(implementation_edges):
+
+            g.ep.include[edge] = True
+            solution_delta = deltas[i]
+            changes = traverse_graph(g, edge=edge,
+                                     delta=solution_delta,
+                                     change=change,
+                                     total_change=total_change)
+            overall_changes += changes.a
+            g.ep.include[edge] = False
+        return overall_changes
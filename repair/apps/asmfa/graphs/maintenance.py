@@ -0,0 +1,86 @@
+'''
+incremental maintenance of the base graphs
+
+the ids of created, changed and deleted status quo fraction flows are
+collected per keyflow and patched into the base graph of the keyflow
+(see BaseGraph.patch) once the transaction of the changes is committed,
+keyflows whose base graph is not built yet are skipped
+
+bulk changes (e.g. translating whole keyflows) suppress the patching, the
+base graphs are rebuilt once afterwards instead
+'''
+import threading
+from contextlib import contextmanager
+
+from django.db import transaction
+
+_local = threading.local()
+
+
+def flows_changed(keyflow_id, flow_ids):
+    '''
+    mark the fraction flows of the keyflow with the given ids as changed,
+    the base graph is patched on commit
+    '''
+    if getattr(_local, 'suppressed', False):
+        return
+    pending = getattr(_local, 'pending', None)
+    if pending is None:
+        pending = _local.pending = {}
+    pending.setdefault(keyflow_id, set()).update(flow_ids)
+    # the ids left over by rolled back transactions are patched with the
+    # next commit, patching unchanged flows does no harm
+    transaction.on_commit(patch_pending)
+
+
+@contextmanager
+def suppress_patching():
+    '''
+    context for bulk changes of the fraction flows, the changes are not
+    patched into the base graphs (they have to be rebuilt afterwards)
+    '''
+    suppressed = getattr(_local, 'suppressed', False)
+    _local.suppressed = True
+    try:
+        yield
+    finally:
+        _local.suppressed = suppressed
+
+
+def patch_pending():
+    '''patch the base graphs with all changes collected so far'''
+    from repair.apps.asmfa.models import KeyflowInCasestudy
+    from repair.apps.asmfa.graphs.graph import BaseGraph
+    pending = getattr(_local, 'pending', None)
+    if not pending:
+        return
+    _local.pending = None
+    for keyflow in KeyflowInCasestudy.objects.filter(id__in=pending.keys()):
+        base_graph = BaseGraph(keyflow)
+        if base_graph.exists:
+            base_graph.patch(pending[keyflow.id])
+
+
+def track_fraction_flow_change(sender, instance, **kwargs):
+    '''
+    receiver for saved fraction flows, the flows added by strategies are not
+    part of the status quo
+
+    deleted fraction flows are not tracked by signals (that would prevent
+    bulk deletes), they have to be passed to flows_changed explicitly
+    '''
+    if instance.strategy_id is None:
+        flows_changed(instance.keyflow_id, [instance.id])
+
+
+def track_translated_flows_delete(sender, instance, **kwargs):
+    '''
+    pre_delete receiver for flows and stocks of actors, their fraction flows
+    are deleted by cascade
+    '''
+    from repair.apps.asmfa.models import FractionFlow, ActorStock
+    lookup = 'stock' if sender is ActorStock else 'flow'
+    flow_ids = list(FractionFlow.objects.filter(
+        **{lookup: instance}).values_list('id', flat=True))
+    if flow_ids:
+        flows_changed(instance.keyflow_id, flow_ids)
@@ -0,0 +1,258 @@
+'''
+columnar snapshots of graphs
+
+the sources and targets of the edges and the properties of the edges and
+vertices of a graph are stored as raw numpy arrays (.npy files) in a
+directory next to the .gt file, they are memory-mapped read-only when
+opened, so opening a snapshot doesn't decode anything and the pages of the
+files are shared by all processes reading the same snapshot
+
+a snapshot is replaced as a whole, snapshots opened before keep reading the
+mapped files of the replaced one
+
+edge properties have to be numeric (bool, int or float), vertex properties
+may be strings as well, the edges are stored in the order of their index,
+numeric graph properties (e.g. the version) are kept in the meta data
+'''
+try:
+    import graph_tool as gt
+except ModuleNotFoundError:
+    pass
+import os
+import json
+import shutil
+import tempfile
+
+import numpy as np
+
+# value types of graph-tool properties stored as numpy arrays
+NUMERIC_TYPES = ('bool', 'uint8_t', 'int16_t', 'int32_t', 'int64_t',
+                 'double', 'long double')
+META_FILE = 'meta.json'
+
+
+def _column_file(path, prefix, name):
+    return os.path.join(path, f'{prefix}_{name}.npy')
+
+
+def read_meta(path):
+    '''
+    return the meta data of the snapshot in the directory at path (number of
+    vertices and edges, property types and graph properties)
+    '''
+    with open(os.path.join(path, META_FILE)) as f:
+        return json.load(f)
+
+
+def write_snapshot(graph, path):
+    '''
+    write the snapshot of the graph into the directory at path, an existing
+    snapshot is replaced as a whole
+
+    Parameters
+    ----------
+    graph: Graph
+        the graph-tool graph
+    path: str
+        the directory of the snapshot
+    '''
+    # unique per writer, concurrent writers don't write into the same files
+    parent, name = os.path.split(os.path.abspath(path))
+    tmp_path = tempfile.mkdtemp(prefix=f'{name}.tmp-', dir=parent)
+    os.chmod(tmp_path, 0o755)
+
+    # source, target and index of all edges, ordered by index
+    edges = graph.get_edges([graph.edge_index])
+    edges = edges[np.argsort(edges[:, 2])]
+    edge_index = edges[:, 2].astype(int)
+    np.save(os.path.join(tmp_path, 'sources.npy'), edges[:, 0].astype(int))
+    np.save(os.path.join(tmp_path, 'targets.npy'), edges[:, 1].astype(int))
+
+    meta = {'num_vertices': graph.num_vertices(),
+            'num_edges': len(edges),
+            'edge_properties': {},
+            'vertex_properties': {},
+            'graph_properties': {}}
+    for (kind, name), prop in graph.properties.items():
+        if kind == 'g' and prop.value_type() in NUMERIC_TYPES:
+            # numpy scalars are not serializable
+            value = np.asarray(prop[graph]).item()
+            meta['graph_properties'][name] = [prop.value_type(), value]
+    for name, prop in graph.edge_properties.items():
+        value_type = prop.value_type()
+        if value_type not in NUMERIC_TYPES:
+            continue
+        np.save(_column_file(tmp_path, 'e', name), prop.a[edge_index])
+        meta['edge_properties'][name] = value_type
+    for name, prop in graph.vertex_properties.items():
+        value_type = prop.value_type()
+        if value_type in NUMERIC_TYPES:
+            values = prop.a
+        elif value_type == 'string':
+            values = np.array([prop[v] for v in graph.vertices()], dtype=str)
+        else:
+            continue
+        np.save(_column_file(tmp_path, 'v', name), values)
+        meta['vertex_properties'][name] = value_type
+    with open(os.path.join(tmp_path, META_FILE), 'w') as f:
+        json.dump(meta, f)
+
+    # directories can't be replaced atomically, the old one is moved away
+    # first, the files stay readable for snapshots having them mapped already
+    # until they are closed, snapshots opened in between may fail to find
+    # the directory
+    old_path = f'{tmp_path}.old'
+    try:
+        os.rename(path, old_path)
+    except FileNotFoundError:
+        pass
+    os.rename(tmp_path, path)
+    shutil.rmtree(old_path, ignore_errors=True)
+
+
+def remove_snapshot(path):
+    shutil.rmtree(path, ignore_errors=True)
+
+
+class GraphSnapshot:
+    '''
+    read-only view of a snapshot, all columns are memory-mapped when opened
+    (mapping is cheap, nothing is read until accessed)
+
+    Parameters
+    ----------
+    path: str
+        the directory of the snapshot
+    mmap_mode: str, optional
+        passed to numpy.load, defaults to read-only mapping
+    '''
+    def __init__(self, path, mmap_mode='r'):
+        self.path = path
+        self.mmap_mode = mmap_mode
+        meta = read_meta(path)
+        self.num_vertices = meta['num_vertices']
+        self.num_edges = meta['num_edges']
+        self.edge_property_types = meta['edge_properties']
+        self.vertex_property_types = meta['vertex_properties']
+        # name -> (value type, value)
+        self._graph_properties = meta.get('graph_properties', {})
+        # mapped at once, the snapshot might be replaced afterwards
+        self._columns = {}
+        filenames = (['sources.npy', 'targets.npy'] +
+                     [f'e_{name}.npy' for name in self.edge_property_types] +
+                     [f'v_{name}.npy' for name in self.vertex_property_types])
+        for filename in filenames:
+            self._columns[filename] = np.load(os.path.join(path, filename),
+                                              mmap_mode=mmap_mode)
+
+    @property
+    def graph_properties(self):
+        '''the values of the graph properties by name'''
+        return {name: value
+                for name, (value_type, value)
+                in self._graph_properties.items()}
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, META_FILE))
+
+    def _load(self, filename):
+        return self._columns[filename]
+
+    @property
+    def sources(self):
+        '''the vertex indices of the sources of the edges'''
+        return self._load('sources.npy')
+
+    @property
+    def targets(self):
+        '''the vertex indices of the targets of the edges'''
+        return self._load('targets.npy')
+
+    def edge_property(self, name):
+        '''the values of the edge property ordered by edge index'''
+        if name not in self.edge_property_types:
+            raise KeyError(f'no edge property {name}')
+        return self._load(f'e_{name}.npy')
+
+    def vertex_property(self, name):
+        '''the values of the vertex property ordered by vertex index'''
+        if name not in self.vertex_property_types:
+            raise KeyError(f'no vertex property {name}')
+        return self._load(f'v_{name}.npy')
+
+    def to_graph(self):
+        '''
+        return a graph-tool graph with all edges and properties of the
+        snapshot (the edges keep their indices)
+        '''
+        graph = gt.Graph(directed=True)
+        graph.add_vertex(self.num_vertices)
+        graph.add_edge_list(np.column_stack([self.sources, self.targets]))
+        for name, value_type in self.vertex_property_types.items():
+            values = self.vertex_property(name)
+            if value_type == 'string':
+                prop = graph.new_vertex_property(value_type,
+                                                 vals=values.tolist())
+            else:
+                prop = graph.new_vertex_property(value_type)
+                prop.a[:] = values
+            graph.vertex_properties[name] = prop
+        for name, value_type in self.edge_property_types.items():
+            prop = graph.new_edge_property(value_type)
+            prop.a[:] = self.edge_property(name)
+            graph.edge_properties[name] = prop
+        for name, (value_type, value) in self._graph_properties.items():
+            graph.graph_properties[name] = graph.new_graph_property(
+                value_type, value)
+        return graph
+
+    def serialize(self):
+        '''the flows as in BaseGraph.serialize without iterating the edges'''
+        vertex_ids = self.vertex_property('id')
+        columns = zip(self.edge_property('id').tolist(),
+                      vertex_ids[self.sources].tolist(),
+                      vertex_ids[self.targets].tolist(),
+                      self.edge_property('material').tolist(),
+                      self.edge_property('amount').tolist())
+        flows = [{'id': flow_id, 'source': source, 'target': target,
+                  'material': material, 'amount': amount}
+                 for flow_id, source, target, material, amount in columns]
+        return {'flows': flows}
+
+
+def diff_snapshots(base, other, properties=('amount', 'material', 'process',
+                                            'waste', 'hazardous')):
+    '''
+    compare the edges of two snapshots by their persistent id (e.g. the base
+    graph and the graph of a strategy)
+
+    Parameters
+    ----------
+    base: GraphSnapshot
+    other: GraphSnapshot
+    properties: list, optional
+        the edge properties to compare
+
+    Returns
+    -------
+    dict
+        the ids of the edges only in other ('added') and only in base
+        ('removed') and for each compared property a tuple of the ids of the
+        edges whose values differ, their values in base and in other
+    '''
+    base_ids = np.asarray(base.edge_property('id'))
+    other_ids = np.asarray(other.edge_property('id'))
+    common, base_idx, other_idx = np.intersect1d(
+        base_ids, other_ids, return_indices=True)
+    diff = {
+        'added': np.setdiff1d(other_ids, common),
+        'removed': np.setdiff1d(base_ids, common)
+    }
+    for name in properties:
+        base_values = base.edge_property(name)[base_idx]
+        other_values = other.edge_property(name)[other_idx]
+        changed = base_values != other_values
+        diff[name] = (common[changed], base_values[changed],
+                      other_values[changed])
+    return diff
@@ -1,75 +1,183 @@
+import os
 import time
 from django.core.management.base import BaseCommand, CommandError
 
-from repair.apps.asmfa.models import Actor2Actor, ActorStock
+from repair.apps.asmfa.models import (KeyflowInCasestudy, Actor2Actor,
+                                      ActorStock, TranslationCheckpoint)
 from repair.apps.login.models import CaseStudy
+from repair.apps.asmfa.graphs.graph import BaseGraph
+from repair.apps.asmfa.translation import (translate_flows, translate_stocks,
+                                           plan_checkpoints, run_checkpoints,
+                                           partition_items, expected_rows,
+                                           measure_throughput)
+
+
+def progress(name, queryset):
+    '''callback printing the progress of the translation'''
+    length = queryset.count()
+    start = time.time()
+    done = 0
+
+    def report(n_translated, n_created):
+        nonlocal done
+        done += n_translated
+        print(f'{done}/{length} {name} converted in {time.time() - start:.1f}s')
+    return report
 
 
 def translate(*args, casestudy_id=None,
               ignore_stocks=False, ignore_flows=False):
+    '''
+    sequential translation in the calling process (used by the migrations,
+    which can't use a pool of processes)
+    '''
     casestudy_ids = CaseStudy.objects.all().values_list('id', flat=True) \
         if casestudy_id is None else [casestudy_id]
 
     for casestudy_id in sorted(casestudy_ids):
         print('-' * 50)
         print(f'Processing Casestudy id {casestudy_id}')
-        start = time.time()
 
         # convert stocks
         if not ignore_stocks:
-            stocks = ActorStock.objects.filter(keyflow__casestudy__id=casestudy_id)
-            length = len(stocks)
+            stocks = ActorStock.objects.filter(
+                keyflow__casestudy__id=casestudy_id)
             print('\nTranslating actor-stocks to fraction-flows')
-            i = 1
-            for stock in stocks.iterator():
-                stock.save()
-                if i % 10 == 0:
-                    end = time.time()
-                    t = end - start
-                    print(f'{i}/{length} stocks converted in {t}s')
-                    start = time.time()
-                i += 1
-            print('done')
+            n = translate_stocks(stocks, callback=progress('stocks', stocks))
+            print(f'done, {n} fraction-flows created')
 
         # convert flows
         if not ignore_flows:
-            flows = Actor2Actor.objects.filter(keyflow__casestudy__id=casestudy_id)
-            length = len(flows)
+            flows = Actor2Actor.objects.filter(
+                keyflow__casestudy__id=casestudy_id)
             print('\nTranslating actor2actor-flows to fraction-flows')
-            i = 1
-            for flow in flows.iterator():
-                flow.save()
-                if i % 10 == 0:
-                    end = time.time()
-                    t = end - start
-                    print(f'{i}/{length} flows converted in {t}s')
-                    start = time.time()
-                i += 1
-            print('done')
+            n = translate_flows(flows, callback=progress('flows', flows))
+            print(f'done, {n} fraction-flows created')
 
 
 class Command(BaseCommand):
 
-    help = "translates all flows and stocks to fraction-flows (removing old ones)"
+    help = ("translates all flows and stocks to fraction-flows (removing old "
+            "ones) partitioned by keyflow and id range in parallel, an "
+            "interrupted run is resumed when called again")
 
     def add_arguments(self, parser):
         parser.add_argument('--casestudy_id', action='append', type=int)
+        parser.add_argument('--keyflow_id', action='append', type=int)
         parser.add_argument('--flows_only', action='store_true')
         parser.add_argument('--stocks_only', action='store_true')
+        parser.add_argument('--processes', type=int, default=None,
+                            help='number of processes, defaults to the '
+                            'number of cpus, 0 to run in this process')
+        parser.add_argument('--partition_size', type=int, default=20000,
+                            help='number of flows (resp. stocks) per '
+                            'partition')
+        parser.add_argument('--restart', action='store_true',
+                            help='discard the progress of an interrupted run')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='only plan the partitions, nothing is '
+                            'translated')
+        parser.add_argument('--stats', action='store_true',
+                            help='report the expected number of rows and '
+                            'the throughput')
 
     def handle(self, *args, **options):
-        casestudy_ids = options['casestudy_id']
-        flows_only = options['flows_only']
-        stocks_only = options['stocks_only']
-        if flows_only and stocks_only:
-            raise Exception("flows_only excludes stocks_only")
-        if casestudy_ids:
-            for casestudy_id in casestudy_ids:
-                translate(casestudy_id=casestudy_id,
-                          ignore_flows=stocks_only,
-                          ignore_stocks=flows_only)
-        else:
-            translate()
-
-if __name__ == 'main':
-    translate()
+        if options['flows_only'] and options['stocks_only']:
+            raise CommandError("flows_only excludes stocks_only")
+        kinds = [TranslationCheckpoint.FLOWS, TranslationCheckpoint.STOCKS]
+        if options['flows_only']:
+            kinds = [TranslationCheckpoint.FLOWS]
+        if options['stocks_only']:
+            kinds = [TranslationCheckpoint.STOCKS]
+
+        keyflows = KeyflowInCasestudy.objects.all()
+        if options['casestudy_id']:
+            keyflows = keyflows.filter(casestudy__id__in=options['casestudy_id'])
+        if options['keyflow_id']:
+            keyflows = keyflows.filter(id__in=options['keyflow_id'])
+        keyflow_ids = sorted(keyflows.values_list('id', flat=True))
+        if not keyflow_ids:
+            raise CommandError('no keyflows found')
+
+        if options['dry_run']:
+            self.dry_run(keyflow_ids, kinds, options)
+            return
+
+        if options['restart']:
+            TranslationCheckpoint.objects.filter(
+                keyflow__in=keyflow_ids, kind__in=kinds).delete()
+        checkpoints = plan_checkpoints(keyflow_ids, kinds,
+                                       options['partition_size'])
+        n_done = checkpoints.filter(done=True).count()
+        if n_done:
+            print(f'Resuming interrupted run, {n_done}/{len(checkpoints)} '
+                  'partitions already done')
+        pending = checkpoints.filter(done=False)
+        n_items = sum(c.n_items for c in pending)
+        print(f'Translating {n_items} flows and stocks in '
+              f'{len(pending)} partitions')
+
+        start = time.time()
+        done = {'items': 0, 'rows': 0}
+
+        def progress(checkpoint):
+            done['items'] += checkpoint.n_items
+            done['rows'] += checkpoint.n_created
+            print(f'{checkpoint.kind} {checkpoint.first_id}-'
+                  f'{checkpoint.last_id} of keyflow {checkpoint.keyflow_id} '
+                  f'done in {checkpoint.duration:.1f}s '
+                  f'({done["items"]}/{n_items})')
+
+        run_checkpoints(pending, processes=options['processes'],
+                        callback=progress)
+        # the base graphs are not patched while translating
+        for keyflow in keyflows.order_by('id'):
+            base_graph = BaseGraph(keyflow)
+            if base_graph.exists:
+                print(f'Rebuilding the base graph of keyflow {keyflow.id}')
+                base_graph.build()
+        duration = time.time() - start
+        print(f'done in {duration:.1f}s')
+        if options['stats']:
+            self.print_throughput(done['items'], done['rows'], duration)
+        # the run is complete, nothing to resume
+        checkpoints.delete()
+
+    @staticmethod
+    def print_throughput(n_items, n_rows, duration):
+        if not duration:
+            return
+        print(f'{n_items} flows and stocks translated into {n_rows} '
+              f'fraction-flows, {n_items / duration:.0f} flows/s, '
+              f'{n_rows / duration:.0f} rows/s')
+
+    def dry_run(self, keyflow_ids, kinds, options):
+        '''print the partitions (and the statistics) without translating'''
+        partition_size = options['partition_size']
+        total_items = 0
+        total_seconds = 0
+        for keyflow_id in keyflow_ids:
+            for kind in kinds:
+                partitions = partition_items(kind, keyflow_id, partition_size)
+                n_items = sum(p[2] for p in partitions)
+                if not n_items:
+                    continue
+                total_items += n_items
+                line = (f'keyflow {keyflow_id}: {n_items} {kind} in '
+                        f'{len(partitions)} partitions')
+                if options['stats']:
+                    rows = expected_rows(kind, keyflow_id)
+                    throughput = measure_throughput(kind, keyflow_id)
+                    line += f', {rows} fraction-flows expected'
+                    if throughput:
+                        line += f', {throughput:.0f} {kind}/s'
+                        total_seconds += n_items / throughput
+                print(line)
+        print(f'{total_items} flows and stocks to translate')
+        if options['stats'] and total_seconds:
+            processes = options['processes']
+            if processes is None:
+                processes = os.cpu_count() or 1
+            parallel = max(processes, 1)
+            print(f'estimated duration: {total_seconds / parallel:.0f}s '
+                  f'with {parallel} processes')
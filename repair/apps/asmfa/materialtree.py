@@ -0,0 +1,160 @@
+'''
+process-level cache of the hierarchy of the materials
+
+the hierarchy is loaded once into arrays with the ancestor chains and the
+intervals of the materials in an euler tour of the tree, so that ancestor and
+descendant checks don't have to walk up the parents query by query
+
+the cache is invalidated by saving or deleting materials in this process,
+changes made by other processes (or by bulk operations not sending signals)
+are picked up after settings.MATERIAL_TREE_MAX_AGE seconds at latest
+'''
+import threading
+import time
+
+import numpy as np
+from django.conf import settings
+
+
+class MaterialTree:
+    '''
+    hierarchy of all materials
+
+    Parameters
+    ----------
+    rows: list of tuple
+       (id, parent id) of all materials
+    '''
+    def __init__(self, rows):
+        self.ids = np.array([r[0] for r in rows], dtype=np.int64)
+        self._index = {mat_id: i for i, mat_id in enumerate(self.ids.tolist())}
+        n = len(self.ids)
+        self.parents = np.full(n, -1, dtype=np.int64)
+        children = [[] for i in range(n)]
+        roots = []
+        for i, (mat_id, parent_id) in enumerate(rows):
+            parent = self._index.get(parent_id) if parent_id else None
+            if parent is None:
+                roots.append(i)
+            else:
+                self.parents[i] = parent
+                children[parent].append(i)
+
+        # euler tour, the descendants of a material are the ones visited
+        # after entering and before leaving it
+        self.enter = np.full(n, -1, dtype=np.int64)
+        self.leave = np.full(n, -1, dtype=np.int64)
+        self.top = np.full(n, -1, dtype=np.int64)
+        order = []
+        for root in roots:
+            stack = [(root, False)]
+            while stack:
+                i, leaving = stack.pop()
+                if leaving:
+                    self.leave[i] = len(order)
+                    continue
+                self.enter[i] = len(order)
+                self.top[i] = root
+                order.append(i)
+                stack.append((i, True))
+                stack.extend((c, False) for c in reversed(children[i]))
+        self.order = np.array(order, dtype=np.int64)
+
+        # ancestor chains (ids from the parent up to the top ancestor)
+        ids = self.ids.tolist()
+        self.chains = {}
+        for i in order:
+            parent = self.parents[i]
+            self.chains[ids[i]] = (
+                () if parent < 0
+                else (ids[parent], ) + self.chains[ids[parent]])
+
+    def _idx(self, material_id):
+        i = self._index[material_id]
+        # materials not reachable from a top level material are part of
+        # a cycle (or descend from one)
+        if self.enter[i] < 0:
+            raise RecursionError(
+                f'There seems to be a cycle in ancestry of material '
+                f'{material_id}')
+        return i
+
+    def __contains__(self, material_id):
+        return material_id in self._index
+
+    def is_descendant(self, material_id, *ancestor_ids):
+        '''
+        return True if the material is a descendant of any of the passed
+        materials
+        '''
+        i = self._idx(material_id)
+        for ancestor_id in ancestor_ids:
+            a = self._index[ancestor_id]
+            if self.enter[a] < self.enter[i] and self.leave[i] <= self.leave[a]:
+                return True
+        return False
+
+    def ancestor(self, material_id, *ancestor_ids):
+        '''
+        return the id of the first ancestor of the material found in the
+        passed materials, None if there is none
+        '''
+        self._idx(material_id)
+        ancestor_ids = set(ancestor_ids)
+        for ancestor_id in self.chains[material_id]:
+            if ancestor_id in ancestor_ids:
+                return ancestor_id
+        return None
+
+    def top_ancestor(self, material_id):
+        '''return the id of the top level ancestor (or itself if top level)'''
+        return self.ids[self.top[self._idx(material_id)]].item()
+
+    def ancestors(self, material_id):
+        '''return the ids of all ancestors starting with the parent'''
+        self._idx(material_id)
+        return list(self.chains[material_id])
+
+    def descendants(self, material_id):
+        '''return the ids of all descendants of the material (deep)'''
+        i = self._idx(material_id)
+        return self.ids[self.order[self.enter[i] + 1:self.leave[i]]].tolist()
+
+    def descend(self, material_ids):
+        '''
+        return the ids of the given materials and all of their descendants
+        '''
+        mats = []
+        for material_id in material_ids:
+            mats.extend(self.descendants(material_id))
+            mats.append(material_id)
+        return mats
+
+
+_tree = None
+_loaded = 0
+_lock = threading.Lock()
+
+
+def get_material_tree(*material_ids):
+    '''
+    return the cached hierarchy of the materials, (re)load it if it is
+    outdated or any of the passed materials is missing
+    '''
+    global _tree, _loaded
+    max_age = getattr(settings, 'MATERIAL_TREE_MAX_AGE', 60)
+    with _lock:
+        if (_tree is None or time.time() - _loaded > max_age or
+            any(mat_id not in _tree for mat_id in material_ids)):
+            from repair.apps.asmfa.models import Material
+            _tree = MaterialTree(
+                list(Material.objects.values_list('id', 'parent_id')))
+            _loaded = time.time()
+        return _tree
+
+
+def invalidate_material_tree(*args, **kwargs):
+    '''drop the cached hierarchy (signature of a signal receiver)'''
+    global _tree
+    with _lock:
+        _tree = None
@@ -0,0 +1,35 @@
+# Generated by Django 2.2.4 on 2026-10-18 14:02
+
+from django.db import migrations, models
+import django.db.models.deletion
+import repair.apps.login.models.bases
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('changes', '0048_calculationjob'),
+        ('asmfa', '0048_auto_20190923_1237'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StrategyFlow',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.FloatField(default=0)),
+                ('waste', models.BooleanField(default=False)),
+                ('hazardous', models.BooleanField(default=False)),
+                ('fractionflow', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='f_strategyflow', to='asmfa.FractionFlow')),
+                ('material', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='f_strategyflowmaterials', to='asmfa.Material')),
+                ('process', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='f_strategyflowprocesses', to='asmfa.Process')),
+                ('strategy', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='f_strategyflows', to='changes.Strategy')),
+            ],
+            options={
+                'abstract': False,
+                'default_permissions': ('add', 'change', 'delete', 'view'),
+                'unique_together': {('strategy', 'fractionflow')},
+            },
+            bases=(repair.apps.login.models.bases.GDSEModelMixin, models.Model),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 2.2.4 on 2026-10-18 15:21
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_actor_areas(apps, schema_editor):
+    ActorInArea = apps.get_model('asmfa', 'ActorInArea')
+    AdministrativeLocation = apps.get_model('asmfa', 'AdministrativeLocation')
+    Area = apps.get_model('studyarea', 'Area')
+    qn = schema_editor.connection.ops.quote_name
+    schema_editor.execute(
+        f'INSERT INTO {qn(ActorInArea._meta.db_table)} '
+        f'({qn("actor_id")}, {qn("area_id")}) '
+        f'SELECT l.{qn("actor_id")}, a.{qn("id")} '
+        f'FROM {qn(Area._meta.db_table)} a '
+        f'INNER JOIN {qn(AdministrativeLocation._meta.db_table)} l '
+        f'ON ST_Intersects(a.{qn("geom")}, l.{qn("geom")}) '
+        f'WHERE l.{qn("actor_id")} IS NOT NULL'
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('studyarea', '0031_auto_20190923_1237'),
+        ('asmfa', '0049_strategyflow'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ActorInArea',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('actor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='area_memberships', to='asmfa.Actor')),
+                ('area', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='actor_memberships', to='studyarea.Area')),
+            ],
+            options={
+                'unique_together': {('actor', 'area')},
+            },
+        ),
+        migrations.RunPython(fill_actor_areas, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.4 on 2026-10-18 16:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('asmfa', '0050_actorinarea'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='keyflowincasestudy',
+            name='data_version',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 2.2.4 on 2026-10-18 17:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('asmfa', '0051_keyflowincasestudy_data_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TranslationCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('flows', 'Flows'), ('stocks', 'Stocks')], max_length=10)),
+                ('first_id', models.IntegerField()),
+                ('last_id', models.IntegerField()),
+                ('n_items', models.IntegerField(default=0)),
+                ('done', models.BooleanField(default=False)),
+                ('n_created', models.IntegerField(default=0)),
+                ('duration', models.FloatField(null=True)),
+                ('keyflow', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='asmfa.KeyflowInCasestudy')),
+            ],
+            options={
+                'unique_together': {('kind', 'keyflow', 'first_id')},
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 2.2.4 on 2026-10-18 19:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('asmfa', '0052_translationcheckpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='keyflowincasestudy',
+            name='statusquo_version',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='strategyflow',
+            name='statusquo_version',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='strategyflow',
+            name='build_version',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -2,6 +2,7 @@
 from __future__ import unicode_literals
 
 from django.db import models
+from django.db.models import signals
 
 from repair.apps.asmfa.models import (KeyflowInCasestudy, Composition,
                                       Material, ProductFraction,
@@ -16,6 +17,10 @@ from repair.apps.asmfa.models.nodes import (
 
 from repair.apps.login.models.bases import GDSEModel
 from repair.apps.utils.protect_cascade import PROTECT_CASCADE
+from repair.apps.asmfa.dataversion import bump_on_change
+from repair.apps.asmfa.translation import translate_flows, translate_stocks
+from repair.apps.asmfa.graphs.maintenance import (
+    track_fraction_flow_change, track_translated_flows_delete)
 
 
 class Flow(GDSEModel):
@@ -92,37 +97,8 @@ class Actor2Actor(Flow):
 
     def save(self, **kwargs):
         super().save(**kwargs)
-
-        # delete eventually already translated fraction flows
-        # (recreation in any case)
-        fraction_flows = FractionFlow.objects.filter(flow=self)
-        fraction_flows.delete()
-        composition = self.composition
-        fractions = ProductFraction.objects.filter(composition=composition)
-        fraction_flows = []
-        for fraction in fractions:
-            fraction_flow = FractionFlow(
-                flow=self,
-                stock=None,
-                to_stock=False,
-                origin=self.origin,
-                destination=self.destination,
-                material=fraction.material,
-                amount=self.amount*fraction.fraction,
-                nace=composition.nace,
-                composition_name=composition.name,
-                publication=fraction.publication or self.publication,
-                avoidable=fraction.avoidable,
-                hazardous=fraction.hazardous,
-                waste=self.waste,
-                process=self.process,
-                keyflow=self.keyflow,
-                description=self.description,
-                year=self.year
-            )
-            fraction_flows.append(fraction_flow)
-        if fraction_flows:
-            FractionFlow.objects.bulk_create(fraction_flows)
+        # (re)create the fraction flows
+        translate_flows([self])
 
 
 class Stock(GDSEModel):
@@ -169,38 +145,8 @@ class ActorStock(Stock):
 
     def save(self, **kwargs):
         super().save(**kwargs)
-
-        # delete eventually already translated fraction flows
-        # (recreation in any case)
-        fraction_flows = FractionFlow.objects.filter(stock=self)
-        fraction_flows.delete()
-        composition = self.composition
-        fractions = ProductFraction.objects.filter(composition=composition)
-        fraction_flows = []
-        for fraction in fractions:
-            fraction_flow = FractionFlow(
-                flow=None,
-                stock=self,
-                to_stock=True,
-                origin=self.origin,
-                destination=None,
-                material=fraction.material,
-                amount=self.amount*fraction.fraction,
-                nace=composition.nace,
-                composition_name=composition.name,
-                publication=fraction.publication or self.publication,
-                avoidable=fraction.avoidable,
-                hazardous=fraction.hazardous,
-                waste=self.waste,
-                process=None,
-                keyflow=self.keyflow,
-                description=self.description,
-                year=self.year
-            )
-            fraction_flows.append(fraction_flow)
-        if fraction_flows:
-            FractionFlow.objects.bulk_create(fraction_flows)
-
+        # (re)create the fraction flows
+        translate_stocks([self])
 
 
 class FractionFlow(Flow):
@@ -248,6 +194,46 @@ class FractionFlow(Flow):
                                  related_name='f_newfractionflowstrategy')
 
 
+signals.post_save.connect(
+    bump_on_change,
+    sender=FractionFlow,
+    weak=False,
+    dispatch_uid='models.bump_on_fractionflow_save')
+
+signals.post_save.connect(
+    track_fraction_flow_change,
+    sender=FractionFlow,
+    weak=False,
+    dispatch_uid='models.patch_graph_on_fractionflow_save')
+
+# no delete receivers for fraction flows, they would prevent fast deletes,
+# the fraction flows are deleted along with the flows and stocks of the
+# actors or in bulk (the changes are passed on explicitly there)
+signals.post_delete.connect(
+    bump_on_change,
+    sender=Actor2Actor,
+    weak=False,
+    dispatch_uid='models.bump_on_actor2actor_delete')
+
+signals.pre_delete.connect(
+    track_translated_flows_delete,
+    sender=Actor2Actor,
+    weak=False,
+    dispatch_uid='models.patch_graph_on_actor2actor_delete')
+
+signals.post_delete.connect(
+    bump_on_change,
+    sender=ActorStock,
+    weak=False,
+    dispatch_uid='models.bump_on_actorstock_delete')
+
+signals.pre_delete.connect(
+    track_translated_flows_delete,
+    sender=ActorStock,
+    weak=False,
+    dispatch_uid='models.patch_graph_on_actorstock_delete')
+
+
 class StrategyFractionFlow(GDSEModel):
     strategy = models.ForeignKey(Strategy, on_delete=models.CASCADE,
                                  related_name='f_fractionflowstrategy')
@@ -264,3 +250,54 @@ class StrategyFractionFlow(GDSEModel):
 
     class Meta(GDSEModel.Meta):
         unique_together = ('strategy', 'fractionflow')
+
+
+class StrategyFlow(GDSEModel):
+    '''
+    effective values of a fraction flow in a calculated strategy (status quo
+    values overridden by the ones of the strategy), materialized after the
+    calculation to avoid joining the StrategyFractionFlows on every query,
+    they are valid as long as neither the status quo version of the keyflow
+    nor the build version of the strategy they were materialized with change
+    '''
+    strategy = models.ForeignKey(Strategy, on_delete=models.CASCADE,
+                                 related_name='f_strategyflows')
+    fractionflow = models.ForeignKey(FractionFlow, on_delete=models.CASCADE,
+                                     related_name='f_strategyflow')
+    amount = models.FloatField(default=0)
+    material = models.ForeignKey(Material, null=True,
+                                 on_delete=models.CASCADE,
+                                 related_name='f_strategyflowmaterials')
+    process = models.ForeignKey(Process, null=True,
+                                on_delete=models.CASCADE,
+                                related_name='f_strategyflowprocesses')
+    waste = models.BooleanField(default=False)
+    hazardous = models.BooleanField(default=False)
+    statusquo_version = models.IntegerField(default=0)
+    build_version = models.IntegerField(default=0)
+
+    class Meta(GDSEModel.Meta):
+        unique_together = ('strategy', 'fractionflow')
+
+
+class TranslationCheckpoint(models.Model):
+    '''
+    partition (range of ids of flows or stocks of a keyflow) of a run of the
+    translate command, an interrupted run resumes with the partitions not
+    done yet
+    '''
+    FLOWS = 'flows'
+    STOCKS = 'stocks'
+    kind = models.CharField(max_length=10,
+                            choices=((FLOWS, 'Flows'), (STOCKS, 'Stocks')))
+    keyflow = models.ForeignKey(KeyflowInCasestudy, on_delete=models.CASCADE,
+                                related_name='+')
+    first_id = models.IntegerField()
+    last_id = models.IntegerField()
+    n_items = models.IntegerField(default=0)
+    done = models.BooleanField(default=False)
+    n_created = models.IntegerField(default=0)
+    duration = models.FloatField(null=True)
+
+    class Meta:
+        unique_together = ('kind', 'keyflow', 'first_id')
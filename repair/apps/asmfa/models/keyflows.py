@@ -3,11 +3,15 @@ from __future__ import unicode_literals
 from django.utils.functional import cached_property
 
 from django.db import models
+from django.db.models import signals
 from collections import defaultdict
 
 from repair.apps.login.models import (CaseStudy, GDSEModel)
 from repair.apps.publications.models import PublicationInCasestudy
 from repair.apps.utils.protect_cascade import PROTECT_CASCADE
+from repair.apps.asmfa.materialtree import (get_material_tree,
+                                            invalidate_material_tree)
+from repair.apps.asmfa.dataversion import bump_on_material_change
 
 
 class Keyflow(GDSEModel):
@@ -33,6 +37,10 @@ class KeyflowInCasestudy(GDSEModel):
         upload_to='sustainability', blank=True, null=True)
     sustainability_conclusions = models.FileField(
         upload_to='sustainability', blank=True, null=True)
+    # bumped whenever the data of the keyflow changes, see dataversion
+    data_version = models.IntegerField(default=0)
+    # bumped whenever the status quo data changes (not by strategies)
+    statusquo_version = models.IntegerField(default=0)
 
     def __str__(self):
         return 'KeyflowInCasestudy {pk}: {k} in {c}'.format(
@@ -54,11 +62,9 @@ class Material(GDSEModel):
     @cached_property
     def descendants(self):
         """ all children of the material (deep traversal) """
-        descendants = []
-        for child in self.children:
-            descendants.append(child)
-            descendants.extend(child.descendants)
-        return descendants
+        ids = get_material_tree(self.id).descendants(self.id)
+        materials = Material.objects.in_bulk(ids)
+        return [materials[i] for i in ids]
 
     @cached_property
     def children(self):
@@ -67,35 +73,14 @@ class Material(GDSEModel):
 
     @cached_property
     def top_ancestor(self):
-        ancestor = self
-        parent = self.parent
-        i = 0
-        while parent:
-            ancestor = parent
-            parent = parent.parent
-            i += 1
-            if i > 100:
-                raise RecursionError(
-                    'There appears to be a cycle in ancestry '
-                    'of material {} - {}'
-                    .format(self.id, self.name))
-        return ancestor
+        top_id = get_material_tree(self.id).top_ancestor(self.id)
+        return self if top_id == self.id else Material.objects.get(id=top_id)
 
     def is_descendant(self, *args):
         ''' return True if material is descendant of any of
         the passed materials '''
-        parent = self.parent
-        materials = list(args)
-        i = 0
-        while parent:
-            if parent in materials: return True
-            parent = parent.parent
-            i += 1
-            if i > 1000:
-                raise RecursionError(
-                    'There seems to be an cycle in ancestry of material {} - {}'
-                    .format(self.id, self.name))
-        return False
+        ids = [m.id for m in args]
+        return get_material_tree(self.id, *ids).is_descendant(self.id, *ids)
 
     def ancestor(self, *args):
         '''
@@ -103,19 +88,10 @@ class Material(GDSEModel):
         if material is descendant of any of the passed materials
         else return None
         '''
-        parent = self.parent
-        materials = list(args)
-        i = 0
-        while parent:
-            if parent in materials:
-                return parent
-            parent = parent.parent
-            i += 1
-            if i > 1000:
-                raise RecursionError(
-                    'There seems to be an cycle in ancestry of material {} - {}'
-                    .format(self.id, self.name))
-        return None
+        materials = {m.id: m for m in args}
+        ancestor_id = get_material_tree(self.id).ancestor(
+            self.id, *materials.keys())
+        return materials.get(ancestor_id)
 
     def save(self, *args, **kwargs):
         '''auto set level'''
@@ -123,6 +99,31 @@ class Material(GDSEModel):
         super().save(*args, **kwargs)
 
 
+signals.post_save.connect(
+    invalidate_material_tree,
+    sender=Material,
+    weak=False,
+    dispatch_uid='models.invalidate_material_tree_save')
+
+signals.post_delete.connect(
+    invalidate_material_tree,
+    sender=Material,
+    weak=False,
+    dispatch_uid='models.invalidate_material_tree_delete')
+
+signals.post_save.connect(
+    bump_on_material_change,
+    sender=Material,
+    weak=False,
+    dispatch_uid='models.bump_on_material_save')
+
+signals.post_delete.connect(
+    bump_on_material_change,
+    sender=Material,
+    weak=False,
+    dispatch_uid='models.bump_on_material_delete')
+
+
 class Composition(GDSEModel):
 
     name = models.CharField(max_length=255, blank=True)
@@ -2,11 +2,13 @@
 from __future__ import unicode_literals
 
 from django.db import models
+from django.db.models import signals
 from django.contrib.gis.db import models as gis
 
 from repair.apps.studyarea.models import Area
 from repair.apps.login.models import GDSEModelMixin
 from .nodes import Actor
+from repair.apps.asmfa import actorareas, dataversion
 
 
 class Geolocation(GDSEModelMixin, gis.Model):
@@ -60,3 +62,62 @@ class OperationalLocation(Establishment):
     actor = models.ForeignKey(Actor,
                               related_name='operational_locations',
                               on_delete=models.CASCADE)
+
+
+class ActorInArea(models.Model):
+    """
+    Area (of any admin level) the administrative location of an actor lies
+    in, maintained by repair.apps.asmfa.actorareas
+    """
+    actor = models.ForeignKey(Actor,
+                              related_name='area_memberships',
+                              on_delete=models.CASCADE)
+    area = models.ForeignKey(Area,
+                             related_name='actor_memberships',
+                             on_delete=models.CASCADE)
+
+    class Meta:
+        unique_together = ('actor', 'area')
+
+
+signals.post_save.connect(
+    actorareas.update_on_location_save,
+    sender=AdministrativeLocation,
+    weak=False,
+    dispatch_uid='models.update_actor_areas_location_save')
+
+signals.post_delete.connect(
+    actorareas.update_on_location_delete,
+    sender=AdministrativeLocation,
+    weak=False,
+    dispatch_uid='models.update_actor_areas_location_delete')
+
+signals.post_save.connect(
+    actorareas.update_on_area_save,
+    sender=Area,
+    weak=False,
+    dispatch_uid='models.update_actor_areas_area_save')
+
+signals.post_save.connect(
+    dataversion.bump_on_location_change,
+    sender=AdministrativeLocation,
+    weak=False,
+    dispatch_uid='models.bump_on_location_save')
+
+signals.post_delete.connect(
+    dataversion.bump_on_location_change,
+    sender=AdministrativeLocation,
+    weak=False,
+    dispatch_uid='models.bump_on_location_delete')
+
+signals.post_save.connect(
+    dataversion.bump_on_area_change,
+    sender=Area,
+    weak=False,
+    dispatch_uid='models.bump_on_area_save')
+
+signals.post_delete.connect(
+    dataversion.bump_on_area_change,
+    sender=Area,
+    weak=False,
+    dispatch_uid='models.bump_on_area_delete')
@@ -4,6 +4,7 @@ from __future__ import unicode_literals
 import re
 
 from django.db import models
+from django.db.models import signals
 from django.utils.timezone import now
 from djmoney.models.fields import MoneyField
 from django.core.exceptions import ValidationError
@@ -11,6 +12,7 @@ from django.core.exceptions import ValidationError
 from repair.apps.login.models import GDSEModel
 from repair.apps.asmfa.models.keyflows import KeyflowInCasestudy
 from repair.apps.utils.protect_cascade import PROTECT_CASCADE
+from repair.apps.asmfa.dataversion import bump_on_actor_change
 
 
 class Node(GDSEModel):
@@ -130,3 +132,15 @@ class Actor(Node):
 
     activity = models.ForeignKey(Activity, on_delete=PROTECT_CASCADE)
 
+
+signals.post_save.connect(
+    bump_on_actor_change,
+    sender=Actor,
+    weak=False,
+    dispatch_uid='models.bump_on_actor_save')
+
+signals.post_delete.connect(
+    bump_on_actor_change,
+    sender=Actor,
+    weak=False,
+    dispatch_uid='models.bump_on_actor_delete')
@@ -32,6 +32,10 @@ from repair.apps.asmfa.models import (KeyflowInCasestudy,
                                       Process
                                       )
 from repair.apps.publications.models import PublicationInCasestudy
+from repair.apps.asmfa.actorareas import update_actor_areas
+from repair.apps.asmfa.translation import translate_flows, translate_stocks
+from repair.apps.asmfa.materialtree import (get_material_tree,
+                                            invalidate_material_tree)
 
 
 class ActivityGroupCreateSerializer(BulkSerializerMixin,
@@ -149,11 +153,15 @@ class Actor2ActorCreateSerializer(BulkSerializerMixin,
 
     def _create_models(self, df):
         created = super()._create_models(df)
-        # trigger conversion to fraction flow
-        for model in created:
-            model.save()
+        # bulk creation doesn't trigger the conversion to fraction flows
+        translate_flows(created)
         return created
 
+    def _update_models(self, df):
+        updated = super()._update_models(df)
+        translate_flows(updated)
+        return updated
+
 
 class ActorStockCreateSerializer(BulkSerializerMixin,
                                  ActorStockSerializer):
@@ -183,11 +191,15 @@ class ActorStockCreateSerializer(BulkSerializerMixin,
 
     def _create_models(self, df):
         created = super()._create_models(df)
-        # trigger conversion to fraction flow
-        for model in created:
-            model.save()
+        # bulk creation doesn't trigger the conversion to fraction flows
+        translate_stocks(created)
         return created
 
+    def _update_models(self, df):
+        updated = super()._update_models(df)
+        translate_stocks(updated)
+        return updated
+
 
 class AdminLocationCreateSerializer(
     BulkSerializerMixin, AdministrativeLocationSerializer):
@@ -210,6 +222,13 @@ class AdminLocationCreateSerializer(
         return AdministrativeLocation.objects.filter(
             actor__activity__activitygroup__keyflow=self.keyflow)
 
+    def save_data(self, dataframe):
+        new, updated = super().save_data(dataframe)
+        # bulk created and updated locations don't send signals
+        update_actor_areas([location.actor_id for location in new] +
+                           [location.actor_id for location in updated])
+        return new, updated
+
 
 class MaterialCreateSerializer(BulkSerializerMixin, MaterialSerializer):
     field_map = {
@@ -229,6 +248,25 @@ class MaterialCreateSerializer(BulkSerializerMixin, MaterialSerializer):
     def get_queryset(self):
         return Material.objects.filter(keyflow=self.keyflow)
 
+    def _update_models(self, df):
+        updated = super()._update_models(df)
+        # the levels are set when saving, the parents might have changed
+        # by the bulk update
+        invalidate_material_tree()
+        tree = get_material_tree()
+        changed = []
+        for material in self.get_queryset():
+            try:
+                level = len(tree.ancestors(material.id)) + 1
+            except RecursionError:
+                continue
+            if material.level != level:
+                material.level = level
+                changed.append(material)
+        Material.objects.bulk_update(changed, ['level'],
+                                     batch_size=self.update_batch_size)
+        return updated
+
 
 class FractionCreateSerializer(BulkSerializerMixin, ProductFractionSerializer):
 
@@ -312,6 +350,7 @@ class CompositionCreateMixin:
         fraction_serializer.error_mask = self.error_mask
         fraction_serializer._validate_fractions(df_fract)
         fraction_serializer._create_models(df_fract)
+        self.bump_data_version()
         result = BulkResult(created=new_comp, updated=updated_comp)
         return result
 
@@ -134,6 +134,7 @@ class KeyflowInCasestudySerializer(NestedHyperlinkedModelSerializer):
     name = serializers.CharField(source='keyflow.name',
                                  allow_blank=True, required=False)
     graph_date = serializers.SerializerMethodField()
+    graph_version = serializers.SerializerMethodField()
 
     class Meta:
         model = KeyflowInCasestudy
@@ -157,6 +158,7 @@ class KeyflowInCasestudySerializer(NestedHyperlinkedModelSerializer):
                   'administrative_locations',
                   'operational_locations',
                   'graph_date',
+                  'graph_version',
                   'sustainability_statusquo',
                   'sustainability_conclusions'
                   )
@@ -165,6 +167,10 @@ class KeyflowInCasestudySerializer(NestedHyperlinkedModelSerializer):
         kfgraph = BaseGraph(obj)
         return kfgraph.date
 
+    def get_graph_version(self, obj):
+        kfgraph = BaseGraph(obj)
+        return kfgraph.version
+
 
 class KeyflowInCasestudyPostSerializer(InCasestudySerializerMixin,
                                        NestedHyperlinkedModelSerializer):
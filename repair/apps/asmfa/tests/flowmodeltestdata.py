@@ -23,7 +23,8 @@ from repair.apps.asmfa.factories import (KeyflowInCasestudyFactory,
                                          )
 from repair.apps.publications.factories import PublicationInCasestudyFactory
 
-from repair.apps.asmfa.models import Actor, Material, Actor2Actor
+from repair.apps.asmfa.models import (Actor, Material, Actor2Actor,
+                                      FractionFlow)
 
 
 def _split_flows(G):
@@ -513,3 +514,20 @@ class GenerateBigTestDataMixin(GeneratePlasticPackagingData):
                              )
                  for i in range(n_flows)]
         Actor2Actor.objects.bulk_create(flows)
+
+    def create_fraction_flows(self):
+        """
+        Translate the big amounts of flows into fraction flows
+        (the compositions have no fractions, the whole flow is plastic)
+        """
+        material = self.materials['Plastic']
+        flows = Actor2Actor.objects.filter(keyflow=self.kic)
+        fraction_flows = [FractionFlow(flow=flow,
+                                       origin_id=flow.origin_id,
+                                       destination_id=flow.destination_id,
+                                       material=material,
+                                       keyflow=self.kic,
+                                       amount=flow.amount,
+                                       )
+                          for flow in flows]
+        FractionFlow.objects.bulk_create(fraction_flows)
@@ -1,8 +1,12 @@
 # -*- coding: utf-8 -*-
 
 import os
+import time
+from tempfile import NamedTemporaryFile
 from unittest import skip
 import pandas as pd
+from django.test import TestCase
+from django.contrib.gis.geos import GEOSGeometry
 from django.urls import reverse
 from test_plus import APITestCase
 from rest_framework import status
@@ -29,6 +33,11 @@ from repair.apps.asmfa.models import (ActivityGroup, Activity, Actor,
                                       FractionFlow)
 from repair.apps.publications.factories import (PublicationFactory,
                                                 PublicationInCasestudyFactory)
+from repair.apps.asmfa.serializers import (Actor2ActorCreateSerializer,
+                                           AdminLocationCreateSerializer)
+from repair.apps.utils.serializers import ErrorMask, _typed_value
+from repair.apps.asmfa.dataversion import get_data_version
+from reversion.models import Version
 
 
 class BulkImportNodesTest(LoginTestCase, APITestCase):
@@ -219,6 +228,43 @@ class BulkImportNodesTest(LoginTestCase, APITestCase):
         assert res.status_code == status.HTTP_201_CREATED, (
             responses.get(res.status_code, res.status_code), res.content)
 
+    def test_bulk_actors_update(self):
+        """Test that uploading actors again updates them in bulk"""
+        file_path = os.path.join(os.path.dirname(__file__),
+                                self.testdata_folder,
+                                self.filename_actor)
+        res = self.client.post(self.actor_url,
+                               {'bulk_upload': open(file_path, 'rb')})
+        assert res.status_code == status.HTTP_201_CREATED
+        actors = Actor.objects.filter(
+            activity__activitygroup__keyflow=self.kic)
+        n_actors = actors.count()
+        # mess up the names, the upload has to restore them
+        actors.update(name='tbd')
+        n_versions = Version.objects.get_for_model(Actor).count()
+        version = get_data_version(self.kic.id)
+
+        res = self.client.post(self.actor_url,
+                               {'bulk_upload': open(file_path, 'rb')})
+        assert res.status_code == status.HTTP_201_CREATED
+        assert actors.count() == n_actors
+        assert not actors.filter(name='tbd').exists()
+        # the updated actors are recorded in the revision of the upload
+        assert (Version.objects.get_for_model(Actor).count() ==
+                n_versions + n_actors)
+        assert get_data_version(self.kic.id) > version
+
+    def test_typed_index_values(self):
+        """rows are matched with models by the typed values of the index"""
+        bvdid = Actor._meta.get_field('BvDid')
+        activity = Actor._meta.get_field('activity')
+        assert _typed_value(bvdid, 1.0) == _typed_value(bvdid, '1') == '1'
+        assert _typed_value(bvdid, np.nan) is None
+        assert _typed_value(bvdid, None) is None
+        assert _typed_value(activity, 3.0) == _typed_value(activity, '3') == 3
+        assert _typed_value(activity, 3.5) == 3.5
+        assert _typed_value(activity, Activity(id=3)) == 3
+
     def test_bulk_actor_errors(self):
         """Test that activity matches activitygroup"""
         file_path = os.path.join(os.path.dirname(__file__),
@@ -542,3 +588,118 @@ class BulkImportMaterialsTest(LoginTestCase, APITestCase):
         res = self.client.post(self.product_url, data)
         assert res.status_code == status.HTTP_400_BAD_REQUEST
 
+
+def parse_int(x):
+    """reference: parsing of a single integer"""
+    try:
+        return int(x)
+    except:
+        return np.NaN
+
+
+def parse_float(x):
+    """reference: parsing of a single float"""
+    if isinstance(x, str):
+        if x.count(',') + x.count('.') > 1:
+            return np.NaN
+        x = x.replace(',', '.')
+    try:
+        return float(x)
+    except:
+        return np.NaN
+
+
+def parse_bool(x):
+    """reference: parsing of a single boolean"""
+    x = x.lower()
+    if x == 'true':
+        return True
+    elif x == 'false':
+        return False
+    return np.NaN
+
+
+class BulkParseBenchmark(TestCase):
+    """
+    parse the columns of synthetic flow and location files with 100k rows
+    """
+    n_rows = 100000
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        np.random.seed(0)
+        n = cls.n_rows
+        amounts = np.random.randint(0, 10 ** 6, n).astype(str).astype(object)
+        # decimal commas, decimals in an integer column and garbage
+        amounts[::1000] = '12,5'
+        amounts[1::1000] = 'x'
+        years = np.random.randint(2000, 2020, n).astype(str).astype(object)
+        years[::777] = '2016.0'
+        waste = np.random.choice(['true', 'False', 'TRUE', 'no'], n,
+                                 p=[0.4, 0.4, 0.19, 0.01])
+        cls.flows = pd.DataFrame({'amount': amounts, 'year': years,
+                                  'waste': waste})
+        xs = np.random.uniform(3, 7, n).round(4)
+        ys = np.random.uniform(50, 54, n).round(4)
+        wkt = np.array([f'POINT({x} {y})' for x, y in zip(xs, ys)],
+                       dtype=object)
+        wkt[::500] = 'POINT(1 2 3)'
+        wkt[1::500] = 'POINT(1,2)'
+        wkt[2::500] = wkt[3]
+        cls.locations = pd.DataFrame({'bvdid': np.arange(n).astype(str),
+                                      'wkt': wkt})
+
+    def read(self, dataframe, serializer):
+        """write the dataframe to a csv-file and read it again"""
+        with NamedTemporaryFile(suffix='.csv', mode='w') as f:
+            dataframe.to_csv(f, sep=';', index=False)
+            f.flush()
+            with open(f.name, 'rb') as file:
+                return serializer.file_to_dataframe(file)
+
+    def parse(self, serializer, dataframe):
+        serializer.error_mask = ErrorMask(dataframe)
+        start = time.time()
+        parsed = serializer._parse_columns(dataframe)
+        duration = time.time() - start
+        print(f'parsing {len(dataframe)} rows with {type(serializer).__name__}'
+              f': {duration:.2f}s')
+        return parsed, serializer.error_mask.error_matrix
+
+    def test_parse_flows(self):
+        serializer = Actor2ActorCreateSerializer()
+        dataframe = self.read(self.flows, serializer)
+        parsed, errors = self.parse(serializer, dataframe)
+
+        for column, parse in [('amount', parse_int), ('year', parse_int),
+                              ('waste', parse_bool)]:
+            expected = dataframe[column].apply(parse)
+            is_error = expected.isna()
+            np.testing.assert_array_equal(errors[column] != 0, is_error)
+            np.testing.assert_array_equal(
+                parsed.loc[~is_error, column].astype(expected.dtype),
+                expected[~is_error])
+        assert (errors['amount'] != 0).sum() == 2 * self.n_rows / 1000
+
+        # the float parser (used by fractions) on the same values
+        entries = dataframe['amount']
+        expected = entries.apply(parse_float)
+        floats = serializer._parse_floats(entries)
+        np.testing.assert_array_equal(floats.isna(), expected.isna())
+        np.testing.assert_array_almost_equal(floats.dropna(),
+                                             expected.dropna())
+
+    def test_parse_locations(self):
+        serializer = AdminLocationCreateSerializer()
+        dataframe = self.read(self.locations, serializer)
+        parsed, errors = self.parse(serializer, dataframe)
+
+        is_error = errors['wkt'] != 0
+        assert is_error.sum() == self.n_rows / 500
+        geoms = parsed.loc[~is_error, 'wkt']
+        assert all(not geom.hasz for geom in geoms)
+        # equal geometries are different objects
+        assert len(set(map(id, geoms))) == len(geoms)
+        for i in [0, 3, 4, 5]:
+            assert geoms[i].equals(GEOSGeometry(dataframe['wkt'][i]))
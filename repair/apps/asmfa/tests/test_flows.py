@@ -1,15 +1,20 @@
 # -*- coding: utf-8 -*-
 
 from django.test import TestCase
+from django.db import connection
 from django.db.models import Q
+from django.test.utils import CaptureQueriesContext
 from django.db.models.functions import Coalesce
 from test_plus import APITestCase
 from django.db.utils import IntegrityError
-from repair.tests.test import BasicModelPermissionTest
+from django.urls import reverse
+from repair.tests.test import BasicModelPermissionTest, LoginTestCase
 from repair.apps.asmfa.models.keyflows import Material
 from repair.apps.asmfa.models.flows import (Actor2Actor, FractionFlow,
-                                            StrategyFractionFlow)
+                                            StrategyFractionFlow,
+                                            TranslationCheckpoint)
 from repair.apps.asmfa.factories import (KeyflowInCasestudyFactory,
+                                         ActorStockFactory,
                                          Group2GroupFactory,
                                          Activity2ActivityFactory,
                                          Actor2ActorFactory,
@@ -28,6 +33,11 @@ from repair.apps.changes.factories import (SolutionFactory,
                                            SolutionCategoryFactory,
                                            StrategyFactory,
                                            StrategyFractionFlowFactory)
+from repair.apps.asmfa.materialtree import get_material_tree
+from repair.apps.asmfa.dataversion import get_data_version
+from repair.apps.utils.utils import descend_materials
+from repair.apps.asmfa.translation import (translate_flows, translate_stocks,
+                                           plan_checkpoints, run_checkpoints)
 import json
 
 
@@ -426,6 +436,149 @@ import json
         #self.assertRaises(Exception, super().test_delete)
         #x = 'breakpoint'
 
+class MaterialTreeTest(TestCase):
+
+    def setUp(self):
+        self.grandparent = MaterialFactory()
+        self.parent = MaterialFactory(parent=self.grandparent)
+        self.child = MaterialFactory(parent=self.parent)
+        self.sibling = MaterialFactory(parent=self.grandparent)
+        self.other = MaterialFactory()
+
+    def test_hierarchy(self):
+        args = (self.child, self.parent, self.grandparent)
+        assert self.child.ancestor(*args) == self.parent
+        assert self.grandparent.ancestor(*args) is None
+        assert self.child.is_descendant(*args)
+        assert not self.grandparent.is_descendant(*args)
+        assert not self.sibling.is_descendant(self.parent, self.other)
+        assert self.child.top_ancestor == self.grandparent
+        assert self.other.top_ancestor == self.other
+        assert self.grandparent.descendants == [
+            self.parent, self.child, self.sibling]
+
+        descendants = descend_materials([self.parent, self.other])
+        assert descendants == [self.child.id, self.parent.id, self.other.id]
+
+    def test_invalidation(self):
+        tree = get_material_tree()
+        # saving a material drops the cached hierarchy
+        self.sibling.parent = self.child
+        self.sibling.save()
+        assert get_material_tree() is not tree
+        assert self.sibling.is_descendant(self.parent)
+        assert set(descend_materials([self.parent])) == set(
+            [self.child.id, self.sibling.id, self.parent.id])
+        tree = get_material_tree()
+        self.sibling.delete()
+        assert get_material_tree() is not tree
+        assert descend_materials([self.parent]) == [
+            self.child.id, self.parent.id]
+
+
+class TranslationTest(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.kic = KeyflowInCasestudyFactory()
+        self.compositions = [CompositionFactory(keyflow=self.kic)
+                             for i in range(3)]
+        self.fractions = {}
+        for i, composition in enumerate(self.compositions):
+            # the last composition has no fractions
+            self.fractions[composition.id] = [
+                ProductFractionFactory(composition=composition,
+                                       fraction=fraction,
+                                       material__keyflow=self.kic,
+                                       publication=None if j else
+                                       PublicationInCasestudyFactory())
+                for j, fraction in enumerate([0.25, 0.75][:2 - i])]
+        self.flows = [
+            Actor2ActorFactory(keyflow=self.kic, composition=composition,
+                               amount=1000 * (i + 1))
+            for i, composition in enumerate(self.compositions * 2)]
+        self.stocks = [
+            ActorStockFactory(keyflow=self.kic, composition=composition,
+                              amount=100)
+            for composition in self.compositions]
+
+    def assert_translated(self, flow, is_stock=False):
+        fraction_flows = FractionFlow.objects.filter(
+            **{'stock' if is_stock else 'flow': flow})
+        fractions = self.fractions[flow.composition_id]
+        assert len(fraction_flows) == len(fractions)
+        by_material = {ff.material_id: ff for ff in fraction_flows}
+        for fraction in fractions:
+            ff = by_material[fraction.material_id]
+            self.assertAlmostEqual(ff.amount, flow.amount * fraction.fraction)
+            assert ff.origin_id == flow.origin_id
+            assert ff.destination_id == (
+                None if is_stock else flow.destination_id)
+            assert ff.to_stock == is_stock
+            assert ff.keyflow_id == flow.keyflow_id
+            assert ff.composition_name == flow.composition.name
+            assert ff.publication_id == (fraction.publication_id or
+                                         flow.publication_id)
+
+    def test_translation(self):
+        """the flows and stocks are translated at once"""
+        FractionFlow.objects.all().delete()
+        translate_flows(self.flows)
+        # the number of queries doesn't depend on the number of flows
+        with CaptureQueriesContext(connection) as single:
+            translate_flows(self.flows[:1])
+        with CaptureQueriesContext(connection) as all_flows:
+            translate_flows(Actor2Actor.objects.filter(keyflow=self.kic))
+        assert len(all_flows) == len(single)
+        for flow in self.flows:
+            self.assert_translated(flow)
+        translate_stocks(self.stocks)
+        for stock in self.stocks:
+            self.assert_translated(stock, is_stock=True)
+
+        # translating again replaces the fraction flows
+        n_fraction_flows = FractionFlow.objects.count()
+        flow = self.flows[0]
+        flow.amount = 50
+        flow.save()
+        assert FractionFlow.objects.count() == n_fraction_flows
+        self.assert_translated(flow)
+
+        # in batches
+        n = translate_flows(self.flows, batch_size=2)
+        assert n == 3 * 2
+        assert FractionFlow.objects.count() == n_fraction_flows
+
+    def test_checkpoints(self):
+        """interrupted runs are resumed with the partitions not done yet"""
+        FractionFlow.objects.all().delete()
+        kinds = [TranslationCheckpoint.FLOWS, TranslationCheckpoint.STOCKS]
+        checkpoints = plan_checkpoints([self.kic.id], kinds, 4)
+        # 6 flows in 2 partitions, 3 stocks in 1
+        assert len(checkpoints) == 3
+        assert sum(c.n_items for c in checkpoints) == 9
+
+        # interrupted after the first partition
+        version = get_data_version(self.kic.id)
+        run_checkpoints(checkpoints.filter(id=checkpoints[0].id), processes=0)
+        # bumped before and after the run, not per batch
+        assert get_data_version(self.kic.id) == version + 2
+        resumed = plan_checkpoints([self.kic.id], kinds, 4)
+        assert resumed.filter(done=True).count() == 1
+        done = []
+        run_checkpoints(resumed, processes=0, callback=done.append)
+        assert len(done) == 2
+        for flow in self.flows:
+            self.assert_translated(flow)
+        for stock in self.stocks:
+            self.assert_translated(stock, is_stock=True)
+        assert sum(c.n_created for c in resumed) == FractionFlow.objects.count()
+
+        # a completed run is planned anew
+        assert not plan_checkpoints(
+            [self.kic.id], kinds, 4).filter(done=True).exists()
+
+
 class StrategyFractionFlowTest(TestCase):
     csname = "Sandbox City"
     keyflow_id = 3
@@ -562,4 +715,134 @@ class StrategyFractionFlowTest(TestCase):
         try:
             super()._fixture_teardown()
         except IntegrityError as e:
-            print(e)
\ No newline at end of file
+            print(e)
+
+
+class FilterFlowStreamTest(LoginTestCase, APITestCase):
+    casestudy = 17
+    keyflow = 3
+
+    def setUp(self):
+        super().setUp()
+        self.url = reverse('fractionflow-list',
+                           kwargs=dict(casestudy_pk=self.casestudy,
+                                       keyflow_pk=self.keyflow))
+        activity = ActivityFactory(activitygroup__keyflow=self.kic)
+        actors = [ActorFactory(activity=activity) for i in range(4)]
+        material1 = MaterialFactory(keyflow=self.kic)
+        material2 = MaterialFactory(keyflow=self.kic, parent=material1)
+        for i, (origin, destination) in enumerate(
+            zip(actors, actors[1:] + [None])):
+            for material in [material1, material2]:
+                FractionFlowFactory(origin=origin, destination=destination,
+                                    to_stock=destination is None,
+                                    material=material, keyflow=self.kic,
+                                    amount=i + 1)
+
+    def test_stream(self):
+        """streamed flows are the same as the rendered ones"""
+        body = {'aggregation_level': json.dumps({'origin': 'activity'})}
+        response = self.client.post(self.url + '?GET=true', body)
+        assert response.status_code == 200
+        expected = json.loads(json.dumps(response.data))
+        assert len(expected) == 4
+
+        response = self.client.post(self.url + '?GET=true&stream=json', body)
+        assert response.status_code == 200
+        assert response.streaming
+        content = b''.join(response.streaming_content).decode('utf-8')
+        assert json.loads(content) == expected
+
+        response = self.client.post(self.url + '?GET=true&stream=ndjson', body)
+        assert response['Content-Type'] == 'application/x-ndjson'
+        lines = b''.join(response.streaming_content).decode('utf-8')
+        assert [json.loads(line) for line in lines.splitlines()] == expected
+
+        response = self.client.post(self.url + '?GET=true&stream=xml', body)
+        assert response.status_code == 400
+
+
+class FilterFlowSerializationTest(LoginTestCase, APITestCase):
+    casestudy = 17
+    keyflow = 3
+
+    def setUp(self):
+        super().setUp()
+        self.url = reverse('fractionflow-list',
+                           kwargs=dict(casestudy_pk=self.casestudy,
+                                       keyflow_pk=self.keyflow))
+        activity = ActivityFactory(activitygroup__keyflow=self.kic)
+        actors = [ActorFactory(activity=activity) for i in range(3)]
+        self.parent = MaterialFactory(keyflow=self.kic)
+        self.child = MaterialFactory(keyflow=self.kic, parent=self.parent)
+        process1 = ProcessFactory(name='process 1')
+        process2 = ProcessFactory(name='process 2')
+        # origin, destination, material, process, waste, amount
+        flows = [
+            (actors[0], actors[1], self.parent, process1, False, 1),
+            (actors[0], actors[1], self.child, process1, False, 2),
+            (actors[0], actors[1], self.child, process1, False, 3),
+            (actors[0], actors[1], self.parent, process2, False, 4),
+            (actors[0], actors[1], self.parent, None, True, 5),
+            (actors[1], actors[2], self.child, None, True, 6),
+            (actors[2], None, self.parent, process2, True, 7),
+            (actors[2], None, self.child, process2, True, 8),
+        ]
+        self.flows = [
+            FractionFlowFactory(origin=origin, destination=destination,
+                                to_stock=destination is None,
+                                material=material, process=process,
+                                waste=waste, hazardous=False,
+                                keyflow=self.kic, amount=amount)
+            for origin, destination, material, process, waste, amount
+            in flows]
+
+    def expected_groups(self, aggregate=False):
+        '''the amounts per material of the flows summed up per group'''
+        groups = {}
+        for flow in self.flows:
+            key = (flow.origin.id, getattr(flow.destination, 'id', None),
+                   flow.waste, flow.hazardous, flow.to_stock,
+                   getattr(flow.process, 'id', None))
+            process, materials = groups.setdefault(
+                key, (flow.process, {}))
+            material = self.parent if aggregate else flow.material
+            materials[material.id] = (
+                materials.get(material.id, 0) + flow.amount)
+        return groups
+
+    def response_groups(self, body):
+        response = self.client.post(self.url + '?GET=true', body)
+        assert response.status_code == 200
+        groups = {}
+        for flow in response.data:
+            destination = flow['destination']
+            key = (flow['origin']['id'],
+                   destination['id'] if destination else None,
+                   flow['waste'], flow['hazardous'], flow['stock'],
+                   flow['process_id'])
+            materials = {material['material']: material['amount']
+                         for material in flow['materials']}
+            assert key not in groups
+            groups[key] = (flow['process'], flow['amount'], materials)
+        return groups
+
+    def assert_groups(self, groups, expected):
+        assert set(groups) == set(expected)
+        for key, (process, materials) in expected.items():
+            process_name, amount, response_materials = groups[key]
+            assert process_name == (process.name if process else '')
+            assert response_materials == materials
+            self.assertAlmostEqual(amount, sum(materials.values()))
+
+    def test_grouped_flows(self):
+        """the flows are summed up per group and material"""
+        groups = self.response_groups({})
+        expected = self.expected_groups()
+        assert len(expected) == 5
+        self.assert_groups(groups, expected)
+
+        # the child material is aggregated to its parent
+        body = {'materials': json.dumps({'aggregate': True})}
+        groups = self.response_groups(body)
+        self.assert_groups(groups, self.expected_groups(aggregate=True))
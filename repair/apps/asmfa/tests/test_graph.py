@@ -1,14 +1,27 @@
 import os
+import tempfile
+import time
+from datetime import timedelta
+from itertools import chain
+try:
+    import graph_tool as gt
+except ModuleNotFoundError:
+    pass
+import numpy as np
 from test_plus import APITestCase
 from django.contrib.gis.geos import Polygon, Point, GeometryCollection
 from django.db.models.functions import Coalesce
-from django.db.models import Case, When, Value, F
+from django.db.models import Case, When, Value, F, Q
 from django.contrib.gis.geos import Polygon, MultiPolygon
 from django.db.models import Sum
 from django.test import TestCase
+from django.utils import timezone
 
 from repair.apps.asmfa.graphs.graph import BaseGraph, StrategyGraph
 from repair.apps.asmfa.graphs.graphwalker import GraphWalker
+from repair.apps.asmfa.graphs.cache import GraphCache
+from repair.apps.asmfa.graphs.snapshot import (GraphSnapshot, write_snapshot,
+                                               diff_snapshots)
 from repair.tests.test import LoginTestCase, AdminAreaTest
 from repair.apps.asmfa.factories import (ActorFactory,
                                          ActivityFactory,
@@ -33,11 +46,17 @@ from repair.apps.changes.factories import (StrategyFactory,
                                         )
 from repair.apps.asmfa.models import (Actor, FractionFlow, StrategyFractionFlow,
                                       Activity, Material, KeyflowInCasestudy,
-                                      CaseStudy, Process)
+                                      CaseStudy, Process, StrategyFlow,
+                                      AdministrativeLocation)
 from repair.apps.changes.models import (Solution, Strategy,
                                         ImplementationQuantity,
                                         SolutionInStrategy, Scheme,
-                                        ImplementationArea)
+                                        ImplementationArea, CalculationJob,
+                                        JobStatus)
+from repair.apps.changes import jobs
+from repair.apps.utils.utils import (get_annotated_fractionflows,
+                                     refresh_strategy_flows, _is_materialized,
+                                     descend_materials)
 from repair.apps.studyarea.factories import StakeholderFactory
 from repair.apps.login.factories import UserInCasestudyFactory
 
@@ -241,6 +260,269 @@ class GraphWalkerTest(TestCase):
                 self.assertAlmostEqual(result.ep.amount[e],
                                        gw.graph.ep.amount[e], places=2)
 
+    def calculate_with_engine(self, graph, engine, source, target, material,
+                              delta, materials, balance_factors=None,
+                              in_place=False):
+        gw = GraphWalker(graph, engine=engine, in_place=in_place)
+        gw.graph.edge_properties['changed'] = \
+            gw.graph.new_edge_property('bool', val=False)
+        gw.graph.edge_properties['include'] = gw.graph.new_edge_property(
+            'bool', vals=[gw.graph.ep.material[e] in materials
+                          for e in gw.graph.edges()])
+        bf = gw.graph.new_vertex_property('float', val=1.0)
+        if balance_factors is not None:
+            bf.a[:] = balance_factors
+        gw.graph.vertex_properties['downstream_balance_factor'] = bf
+        implementation_edges = [
+            e for e in gw.graph.edge(gw.graph.vertex(source),
+                                     gw.graph.vertex(target), all_edges=True)
+            if gw.graph.ep.material[e] == material]
+        return gw.calculate(implementation_edges, [delta])
+
+    def test_linear_engine(self):
+        """Cross-check the linear engine with the breadth-first-search"""
+        b2b = flowmodeltestdata.bread_to_beer_graph()
+        b2b_bf = BaseGraph._calc_balance_factors(b2b)
+        b2b_materials = ['barley', 'beer', 'sludge']
+        plastic = flowmodeltestdata.plastic_package_graph()
+        scenarios = [
+            # Farm->Brewery, changes are pushed downstream
+            (b2b, 5, 3, 'barley', -4.5, b2b_materials, b2b_bf),
+            # Brewery->Supermarkets, changes are pulled upstream
+            (b2b, 3, 4, 'beer', 10, b2b_materials, b2b_bf),
+            # Packaging->Consumption, part of the recycling cycle
+            (plastic, 1, 6, 'plastic', -0.3, ['plastic', 'crude oil'], None),
+            # Farm->Packaging
+            (plastic, 0, 1, 'milk', -26,
+             ['milk', 'human waste', 'other waste'], None),
+        ]
+        for scenario in scenarios:
+            graph = scenario[0]
+            bfs = self.calculate_with_engine(graph, 'bfs', *scenario[1:])
+            linear = self.calculate_with_engine(graph, 'linear', *scenario[1:])
+            np.testing.assert_array_almost_equal(
+                linear.ep.amount.a, bfs.ep.amount.a, decimal=3)
+
+        # farm->brewery: the beer and sludge are reduced by their shares of
+        # the balanced inflow of the brewery
+        linear = self.calculate_with_engine(
+            b2b, 'linear', 5, 3, 'barley', -4.5, b2b_materials, b2b_bf)
+        np.testing.assert_array_almost_equal(
+            linear.ep.amount.a - b2b.ep.amount.a,
+            [0, 0, 0, -10, -20, -4.5])
+
+
+    def test_in_place(self):
+        """Calculate in place and roll back to the original amounts"""
+        plastic = flowmodeltestdata.plastic_package_graph()
+        original = plastic.ep.amount.a.copy()
+        # sets up the properties of the graph and returns a changed copy
+        copied = self.calculate_with_engine(
+            plastic, 'bfs', 1, 6, 'plastic', -0.3, ['plastic', 'crude oil'])
+        self.assertIsNot(copied, plastic)
+        np.testing.assert_array_equal(plastic.ep.amount.a, original)
+
+        gw = GraphWalker(plastic, in_place=True)
+        gw.snapshot()
+        result = gw.calculate(
+            [e for e in plastic.edge(1, 6, all_edges=True)
+             if plastic.ep.material[e] == 'plastic'], [-0.3])
+        self.assertIs(result, plastic)
+        np.testing.assert_array_almost_equal(plastic.ep.amount.a,
+                                             copied.ep.amount.a)
+        np.testing.assert_array_equal(plastic.ep.changed.a,
+                                      copied.ep.changed.a)
+
+        gw.rollback()
+        np.testing.assert_array_equal(plastic.ep.amount.a, original)
+        self.assertFalse(plastic.ep.changed.a.any())
+
+
+class GraphCacheTest(TestCase):
+
+    def test_cache(self):
+        tmpdir = tempfile.mkdtemp()
+        b2b_file = os.path.join(tmpdir, 'b2b.gt')
+        plastic_file = os.path.join(tmpdir, 'plastic.gt')
+        flowmodeltestdata.bread_to_beer_graph().save(b2b_file)
+        flowmodeltestdata.plastic_package_graph().save(plastic_file)
+
+        cache = GraphCache()
+        g1 = cache.get(b2b_file)
+        g2 = cache.get(b2b_file)
+        assert len(cache) == 1
+        # the callers get copies of the cached graph
+        assert g1 is not g2
+        g1.ep.amount.a[:] = 0
+        assert cache.get(b2b_file).ep.amount.a.sum() > 0
+
+        # modified files are reloaded
+        g1.save(b2b_file)
+        os.utime(b2b_file, ns=(time.time_ns() + 10 ** 9, ) * 2)
+        assert cache.get(b2b_file).ep.amount.a.sum() == 0
+
+        cache.invalidate(b2b_file)
+        assert b2b_file not in cache
+
+        # the least recently used graphs are evicted if out of budget
+        cache = GraphCache(max_size=os.path.getsize(plastic_file))
+        cache.get(b2b_file)
+        cache.get(plastic_file)
+        assert plastic_file in cache
+        assert b2b_file not in cache
+        assert cache.size <= cache.max_size
+
+        with self.assertRaises(FileNotFoundError):
+            cache.get(os.path.join(tmpdir, 'missing.gt'))
+
+
+class GraphSnapshotTest(TestCase):
+
+    @staticmethod
+    def create_graph():
+        graph = gt.Graph(directed=True)
+        graph.add_vertex(4)
+        graph.vp.id = graph.new_vertex_property('int', vals=[10, 11, 12, 13])
+        graph.vp.name = graph.new_vertex_property(
+            'string', vals=['a', 'b', 'c', 'd'])
+        graph.ep.id = graph.new_edge_property('int')
+        graph.ep.amount = graph.new_edge_property('float')
+        graph.ep.material = graph.new_edge_property('int')
+        graph.ep.process = graph.new_edge_property('int')
+        graph.ep.waste = graph.new_edge_property('bool')
+        graph.ep.hazardous = graph.new_edge_property('bool')
+        edges = [(0, 1, 1, 100, 1), (1, 2, 2, 50, 2), (2, 3, 3, 25, 1),
+                 (3, 0, 4, 10, 2)]
+        graph.add_edge_list(
+            np.array(edges, dtype=float),
+            eprops=[graph.ep.id, graph.ep.amount, graph.ep.material])
+        return graph
+
+    def test_snapshot(self):
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, 'snapshot')
+        graph = self.create_graph()
+        write_snapshot(graph, path)
+        snapshot = GraphSnapshot(path)
+        assert snapshot.num_vertices == 4
+        assert snapshot.num_edges == 4
+        # the columns are memory-mapped read-only
+        amounts = snapshot.edge_property('amount')
+        assert isinstance(amounts, np.memmap)
+        with self.assertRaises(ValueError):
+            amounts[0] = 1
+        np.testing.assert_array_equal(amounts, graph.ep.amount.a)
+        flows = snapshot.serialize()['flows']
+        assert flows[1] == {'id': 2, 'source': 11, 'target': 12,
+                            'material': 2, 'amount': 50}
+
+        # the graph restored from the snapshot equals the original one
+        restored = snapshot.to_graph()
+        np.testing.assert_array_equal(restored.get_edges(), graph.get_edges())
+        for name in ['id', 'amount', 'material', 'waste']:
+            np.testing.assert_array_equal(restored.ep[name].a,
+                                          graph.ep[name].a)
+        assert [restored.vp.name[v] for v in restored.vertices()] == \
+            ['a', 'b', 'c', 'd']
+
+        # compare with a modified graph
+        graph.ep.amount.a[1] = 40
+        graph.ep.material.a[2] = 2
+        graph.remove_edge(graph.edge(3, 0))
+        e = graph.add_edge(3, 1)
+        graph.ep.id[e] = 5
+        other_path = os.path.join(tmpdir, 'other')
+        write_snapshot(graph, other_path)
+        diff = diff_snapshots(snapshot, GraphSnapshot(other_path))
+        np.testing.assert_array_equal(diff['added'], [5])
+        np.testing.assert_array_equal(diff['removed'], [4])
+        ids, base_values, other_values = diff['amount']
+        np.testing.assert_array_equal(ids, [2])
+        np.testing.assert_array_equal(base_values, [50])
+        np.testing.assert_array_equal(other_values, [40])
+        np.testing.assert_array_equal(diff['material'][0], [3])
+        assert not len(diff['waste'][0])
+
+        # replacing a snapshot keeps the opened one readable and leaves no
+        # temporary directories behind
+        write_snapshot(graph, path)
+        np.testing.assert_array_equal(
+            snapshot.edge_property('id'), [1, 2, 3, 4])
+        assert GraphSnapshot(path).num_edges == 4
+        assert sorted(os.listdir(tmpdir)) == ['other', 'snapshot']
+
+
+class BaseGraphPatchTest(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.kic = KeyflowInCasestudyFactory()
+        self.material = MaterialFactory(keyflow=self.kic)
+        self.actors = [
+            ActorFactory(activity__activitygroup__keyflow=self.kic)
+            for i in range(4)]
+        self.flows = [self.create_flow(self.actors[0], self.actors[1], 100),
+                      self.create_flow(self.actors[1], self.actors[2], 60),
+                      self.create_flow(self.actors[2], self.actors[3], 30),
+                      self.create_flow(self.actors[1], None, 20)]
+
+    def create_flow(self, origin, destination, amount):
+        return FractionFlowFactory(keyflow=self.kic, flow=None, stock=None,
+                                   origin=origin, destination=destination,
+                                   to_stock=destination is None,
+                                   material=self.material, amount=amount)
+
+    @staticmethod
+    def graph_table(graph):
+        """edges and balance factors by flow and actor ids"""
+        edges = sorted((graph.ep.id[e], graph.vp.id[e.source()],
+                        graph.vp.id[e.target()], graph.ep.amount[e])
+                       for e in graph.edges())
+        factors = sorted(
+            (graph.vp.id[v], graph.vp.downstream_balance_factor[v])
+            for v in graph.vertices())
+        return edges, factors
+
+    def test_patch(self):
+        basegraph = BaseGraph(self.kic, tag='test')
+        basegraph.build()
+        assert basegraph.version == 1
+        # the version is read from the meta data of the current snapshot
+        mtime = os.path.getmtime(basegraph.snapshot_path)
+        assert basegraph.version == 1
+        assert os.path.getmtime(basegraph.snapshot_path) == mtime
+
+        changed = self.flows[1]
+        changed.amount = 80
+        changed.save()
+        # the last actor has no flows left
+        deleted = self.flows[2]
+        deleted_id = deleted.id
+        deleted.delete()
+        new_actor = ActorFactory(activity__activitygroup__keyflow=self.kic)
+        added = self.create_flow(self.actors[2], new_actor, 40)
+
+        patched = basegraph.patch([changed.id, deleted_id, added.id])
+        assert basegraph.version == 2
+        # the patched graph equals a rebuilt one
+        rebuilt = BaseGraph(self.kic, tag='test').build()
+        assert patched.num_vertices() == rebuilt.num_vertices() == 4
+        assert self.graph_table(patched) == self.graph_table(rebuilt)
+        assert basegraph.version == 3
+        basegraph.remove()
+
+    def test_patch_single_flow(self):
+        basegraph = BaseGraph(self.kic, tag='test')
+        basegraph.build()
+        changed = self.flows[0]
+        changed.amount = 50
+        changed.save()
+        patched = basegraph.patch([changed.id])
+        assert basegraph.version == 2
+        rebuilt = BaseGraph(self.kic, tag='test').build()
+        assert self.graph_table(patched) == self.graph_table(rebuilt)
+        basegraph.remove()
+
 
 class GraphTest(LoginTestCase, APITestCase):
     @classmethod
@@ -806,6 +1088,366 @@ class StrategyGraphTest(LoginTestCase, APITestCase):
         # ToDo: additional asserts (test origins/destinations), affected flows
 
 
+    def test_incremental_build(self):
+        def create_part(solution, priority, factor):
+            part = SolutionPartFactory(
+                solution=solution,
+                question=None,
+                flow_reference=FlowReferenceFactory(
+                    origin_activity=self.households,
+                    destination_activity=self.collection,
+                    material=self.food_waste
+                ),
+                scheme=Scheme.MODIFICATION,
+                is_absolute=False,
+                priority=priority,
+                a=0,
+                b=factor
+            )
+            AffectedFlowFactory(
+                origin_activity=self.collection,
+                destination_activity=self.treatment,
+                solution_part=part,
+                material=self.food_waste
+            )
+            return part
+
+        first_part = create_part(self.solution, 0, 2)
+        second_part = create_part(self.solution, 1, 0.5)
+        implementation = SolutionInStrategyFactory(
+            strategy__keyflow=self.keyflow,
+            solution=self.solution
+        )
+        strategy = implementation.strategy
+
+        def changes():
+            return sorted(StrategyFractionFlow.objects.filter(
+                strategy=strategy).values_list('fractionflow', 'amount'))
+
+        calculated = []
+        def callback(implementation, solution_part):
+            calculated.append(solution_part.id)
+
+        sg = StrategyGraph(strategy, self.basegraph.tag)
+        sg.build()
+        full_changes = changes()
+        assert len(sg._load_checkpoint_keys()) == 2
+
+        # nothing changed, nothing to be recalculated
+        sg = StrategyGraph(strategy, self.basegraph.tag)
+        sg.build(callback=callback)
+        assert changes() == full_changes
+        # the progress is reported for the skipped parts as well
+        assert calculated == [first_part.id, second_part.id]
+
+        # changing the last part resumes from the checkpoint of the first one
+        second_part.b = 0.8
+        second_part.save()
+        sg = StrategyGraph(strategy, self.basegraph.tag)
+        keys_before = sg._load_checkpoint_keys()
+        sg.build()
+        keys_after = sg._load_checkpoint_keys()
+        assert keys_before[0] == keys_after[0]
+        assert keys_before[1] != keys_after[1]
+        incremental_changes = changes()
+
+        sg.build(incremental=False)
+        assert changes() == incremental_changes
+
+        # writing the changes once at the end gives the same results
+        sg.build(incremental=False, deferred=True)
+        assert changes() == incremental_changes
+        sg._remove_checkpoints()
+
+    def test_deferred_material_change(self):
+        # the first part changes the material of the flows, the second one
+        # references them by the new material
+        first_part = SolutionPartFactory(
+            solution=self.solution,
+            question=None,
+            flow_reference=FlowReferenceFactory(
+                origin_activity=self.households,
+                destination_activity=self.collection,
+                material=self.food_waste
+            ),
+            flow_changes=FlowReferenceFactory(material=self.orange_product),
+            scheme=Scheme.MODIFICATION,
+            is_absolute=False,
+            priority=0,
+            a=0,
+            b=1
+        )
+        second_part = SolutionPartFactory(
+            solution=self.solution,
+            question=None,
+            flow_reference=FlowReferenceFactory(
+                origin_activity=self.households,
+                destination_activity=self.collection,
+                material=self.orange_product
+            ),
+            scheme=Scheme.MODIFICATION,
+            is_absolute=False,
+            priority=1,
+            a=0,
+            b=2
+        )
+        for part in [first_part, second_part]:
+            AffectedFlowFactory(
+                origin_activity=self.collection,
+                destination_activity=self.treatment,
+                solution_part=part,
+                material=self.food_waste
+            )
+        implementation = SolutionInStrategyFactory(
+            strategy__keyflow=self.keyflow,
+            solution=self.solution
+        )
+        strategy = implementation.strategy
+
+        impl_flows = FractionFlow.objects.filter(
+            origin__activity=self.households,
+            destination__activity=self.collection,
+            material=self.food_waste,
+            strategy__isnull=True,
+        )
+        old_sum = impl_flows.aggregate(sum_amount=Sum('amount'))['sum_amount']
+
+        def changes():
+            return sorted(StrategyFractionFlow.objects.filter(
+                strategy=strategy).values_list(
+                    'fractionflow', 'amount', 'material'))
+
+        sg = StrategyGraph(strategy, self.basegraph.tag)
+        sg.build(incremental=False)
+        immediate_changes = changes()
+        impl_changes = StrategyFractionFlow.objects.filter(
+            fractionflow__in=impl_flows, strategy=strategy)
+        assert set(impl_changes.values_list('material', flat=True)) == \
+            set([self.orange_product.id])
+        # the second part found the flows with the changed material
+        new_sum = impl_changes.aggregate(sum_amount=Sum('amount'))['sum_amount']
+        self.assertAlmostEqual(new_sum, old_sum * 2)
+
+        # the changed materials are written before the second part selects
+        # its flows
+        sg.build(incremental=False, deferred=True)
+        assert changes() == immediate_changes
+        sg._remove_checkpoints()
+
+    def test_calculation_job(self):
+        strategy = StrategyFactory(keyflow=self.keyflow)
+        job = jobs.enqueue(strategy)
+        assert job.status == JobStatus.QUEUED
+        assert strategy.status == 1
+        # queueing again doesn't create a second job
+        assert jobs.enqueue(strategy).id == job.id
+        assert jobs.claim_next().id == job.id
+        assert jobs.claim_next() is None
+        # queueing while the strategy is calculated defers the new job
+        deferred = jobs.enqueue(strategy)
+        assert deferred.id != job.id
+        assert jobs.claim_next() is None
+        job = jobs.run_job(job, tag=self.basegraph.tag)
+        strategy.refresh_from_db()
+        assert job.status == JobStatus.FINISHED, job.message
+        assert strategy.status == 2
+        assert job.parts_done == job.n_parts == 0
+        assert jobs.claim_next().id == deferred.id
+
+        # running jobs exceeding the timeout were interrupted
+        CalculationJob.objects.filter(id=deferred.id).update(
+            started=timezone.now() - timedelta(
+                seconds=jobs.get_timeout() + 1))
+        assert jobs.fail_stale_jobs() == 1
+        deferred.refresh_from_db()
+        strategy.refresh_from_db()
+        assert deferred.status == JobStatus.FAILED
+        assert strategy.status == 0
+
+        # strategies of keyflows without base graph can't be calculated
+        job = CalculationJob.objects.create(strategy=strategy)
+        job = jobs.run_job(job, tag='no_graph')
+        assert job.status == JobStatus.FAILED
+        assert strategy.calculation_jobs.count() == 3
+
+    def test_rebuild_strategies(self):
+        strategy = StrategyFactory(keyflow=self.keyflow)
+        # new flows can't be defined relatively, the calculation fails
+        SolutionPartFactory(solution=self.solution, question=None,
+                            scheme=Scheme.NEW, is_absolute=False)
+        failing = SolutionInStrategyFactory(
+            strategy__keyflow=self.keyflow, solution=self.solution).strategy
+        results = jobs.rebuild_strategies(
+            Strategy.objects.filter(id__in=[strategy.id, failing.id]),
+            processes=0, tag=self.basegraph.tag)
+        results = {result['strategy']: result for result in results}
+        # the failing strategy doesn't abort the calculation of the other one
+        assert results[strategy.id]['status'] == 'finished'
+        assert results[failing.id]['status'] == 'failed'
+        assert results[failing.id]['message']
+        strategy.refresh_from_db()
+        failing.refresh_from_db()
+        assert strategy.status == 2
+        assert failing.status == 0
+        job = CalculationJob.objects.get(id=results[strategy.id]['job'])
+        assert job.status == JobStatus.FINISHED
+
+        # strategies queued already are not calculated twice
+        queued = jobs.enqueue(strategy)
+        assert jobs.create_rebuild_jobs([strategy]) == []
+        calc_jobs = jobs.rebuild_strategies_in_background([strategy, failing])
+        assert calc_jobs[0].id == queued.id
+        assert calc_jobs[1].status == JobStatus.QUEUED
+        StrategyGraph(failing, self.basegraph.tag)._remove_checkpoints()
+
+    def test_edge_selection(self):
+        """the flows are selected in the graph as in the database"""
+        strategy = StrategyFactory(keyflow=self.keyflow)
+        sg = StrategyGraph(strategy, self.basegraph.tag)
+        sg.graph = self.basegraph.load()
+        sg._index_attributes(sg.graph)
+        sg._index_graph()
+        status_quo = FractionFlow.objects.filter(keyflow=self.keyflow,
+                                                 strategy__isnull=True)
+
+        reference = FlowReferenceFactory(
+            origin_activity=self.households,
+            destination_activity=self.collection,
+            material=self.food_waste,
+            include_child_materials=True
+        )
+        expected = status_quo.filter(
+            origin__activity=self.households,
+            destination__activity=self.collection,
+            material__in=descend_materials([self.food_waste]))
+        referenced = sg._get_referenced_flows(reference, None)
+        assert referenced.count() > 0
+        assert (set(referenced.values_list('id', flat=True)) ==
+                set(expected.values_list('id', flat=True)))
+
+        part = SolutionPartFactory(
+            solution=self.solution,
+            question=None,
+            flow_reference=reference,
+            scheme=Scheme.MODIFICATION,
+            is_absolute=False,
+            a=0,
+            b=1
+        )
+        AffectedFlowFactory(
+            origin_activity=self.collection,
+            destination_activity=self.treatment,
+            solution_part=part,
+            material=self.food_waste
+        )
+        expected = status_quo.filter(
+            origin__activity=self.collection,
+            destination__activity=self.treatment,
+            material=self.food_waste)
+        mask = sg._get_affected_flows(part)
+        assert mask.any()
+        assert (set(sg.graph.ep.id.a[mask].tolist()) ==
+                set(expected.values_list('id', flat=True)))
+
+    def test_graph_index(self):
+        strategy = StrategyFactory(keyflow=self.keyflow)
+        sg = StrategyGraph(strategy, self.basegraph.tag)
+        sg.build()
+        assert len(sg._flow_edges) == sg.graph.num_edges()
+        assert len(sg._actor_vertices) == sg.graph.num_vertices()
+        for flow_id, edge in sg._flow_edges.items():
+            assert sg.graph.ep.id[edge] == flow_id
+        for actor_id, vertex in sg._actor_vertices.items():
+            assert sg.graph.vp.id[vertex] == actor_id
+        # a vertex for an actor not in the graph yet is added to the index
+        actor = Actor.objects.exclude(
+            id__in=list(sg._actor_vertices.keys())).first()
+        if actor:
+            vertex = sg._get_vertex(actor.id)
+            assert sg._actor_vertices[actor.id] == vertex
+            assert sg.graph.vp.id[vertex] == actor.id
+
+    def test_translate_to_db(self):
+        strategy = StrategyFactory(keyflow=self.keyflow)
+        sg = StrategyGraph(strategy, self.basegraph.tag)
+        sg.graph = self.basegraph.load()
+        sg._index_graph()
+        sg.graph.ep.changed = sg.graph.new_edge_property("bool")
+        # change some flows of the status quo
+        changed = np.zeros(sg.graph.num_edges(), dtype=bool)
+        changed[::3] = True
+        sg.graph.ep.changed.a[:] = changed
+        sg.graph.ep.amount.a[changed] *= 2
+        sg.translate_to_db()
+        strat_flows = StrategyFractionFlow.objects.filter(strategy=strategy)
+        assert strat_flows.count() == changed.sum()
+        amounts = dict(strat_flows.values_list('fractionflow_id', 'amount'))
+        for flow_id, amount in zip(sg.graph.ep.id.a[changed],
+                                   sg.graph.ep.amount.a[changed]):
+            self.assertAlmostEqual(amounts[flow_id], amount)
+
+        # existing modifications are overwritten, not duplicated
+        sg.graph.ep.amount.a[changed] += 1
+        sg.translate_to_db()
+        assert strat_flows.count() == changed.sum()
+        amounts = dict(strat_flows.values_list('fractionflow_id', 'amount'))
+        for flow_id, amount in zip(sg.graph.ep.id.a[changed],
+                                   sg.graph.ep.amount.a[changed]):
+            self.assertAlmostEqual(amounts[flow_id], amount)
+
+    def test_strategy_flows(self):
+        strategy = StrategyFactory(keyflow=self.keyflow)
+        sg = StrategyGraph(strategy, self.basegraph.tag)
+        sg.graph = self.basegraph.load()
+        sg._index_graph()
+        sg.graph.ep.changed = sg.graph.new_edge_property("bool")
+        changed = np.zeros(sg.graph.num_edges(), dtype=bool)
+        changed[::3] = True
+        sg.graph.ep.changed.a[:] = changed
+        sg.graph.ep.amount.a[changed] *= 2
+        sg.translate_to_db()
+
+        fields = ('id', 'strategy_amount', 'strategy_material',
+                  'strategy_material_name', 'strategy_material_level',
+                  'strategy_process', 'strategy_waste', 'strategy_hazardous')
+        # not materialized yet, joined on the fly
+        joined = list(get_annotated_fractionflows(
+            self.keyflow.id, strategy_id=strategy.id).values_list(*fields))
+        refresh_strategy_flows(strategy)
+        assert StrategyFlow.objects.filter(
+            strategy=strategy).count() == len(joined)
+        materialized = list(get_annotated_fractionflows(
+            self.keyflow.id, strategy_id=strategy.id).values_list(*fields))
+        assert sorted(materialized) == sorted(joined)
+
+        # refreshing again doesn't duplicate the flows
+        refresh_strategy_flows(strategy)
+        assert StrategyFlow.objects.filter(
+            strategy=strategy).count() == len(joined)
+
+        # calculating other strategies keeps the materialized flows
+        other = StrategyGraph(StrategyFactory(keyflow=self.keyflow),
+                              self.basegraph.tag)
+        other.clean_db()
+        assert _is_materialized(self.keyflow.id, strategy.id)
+        # recalculating the strategy itself outdates them
+        sg.clean_db()
+        assert not _is_materialized(self.keyflow.id, strategy.id)
+        sg.translate_to_db()
+        refresh_strategy_flows(strategy)
+        assert _is_materialized(self.keyflow.id, strategy.id)
+
+        # changes of the status quo outdate the materialized flows
+        flow = FractionFlow.objects.filter(
+            keyflow=self.keyflow, strategy__isnull=True).exclude(
+                f_strategyfractionflow__strategy=strategy).first()
+        flow.amount += 1
+        flow.save()
+        annotated = get_annotated_fractionflows(
+            self.keyflow.id, strategy_id=strategy.id).get(id=flow.id)
+        assert annotated.strategy_amount == flow.amount
+
+
 class PeelPioneerTest(LoginTestCase, APITestCase):
     fixtures = ['peelpioneer_data']
 
@@ -1389,3 +2031,162 @@ class PeelPioneerTest(LoginTestCase, APITestCase):
 class StrategyGraphPerformanceTest(MultiplyTestDataMixin,
                                    StrategyGraphTest):
     """The same tests but with bigger data"""
+
+
+class BaseGraphBenchmark(flowmodeltestdata.GenerateBigTestDataMixin,
+                         TestCase):
+    """
+    compare the bulk build of the base graph with adding the edges one by one
+    """
+    def setUp(self):
+        super().setUp()
+        self.create_keyflow()
+        self.create_materials()
+        self.create_actors(1000)
+        self.create_flows(10000)
+        self.create_fraction_flows()
+
+    def build_iteratively(self):
+        """the former way of building the graph, adding edge after edge"""
+        actorflows = FractionFlow.objects.filter(
+            keyflow=self.kic, to_stock=False)
+        stockflows = FractionFlow.objects.filter(
+            keyflow=self.kic, to_stock=True)
+        actors = Actor.objects.filter(
+            Q(id__in=actorflows.values('origin_id')) |
+            Q(id__in=actorflows.values('destination_id')) |
+            Q(id__in=stockflows.values('origin_id'))
+        ).values()
+        flows = list(chain(actorflows.values(), stockflows.values()))
+
+        graph = gt.Graph(directed=True)
+        graph.add_vertex(len(actors))
+        graph.vp.id = graph.new_vertex_property("int")
+        actorids = {}
+        for i in range(len(actors)):
+            graph.vp.id[i] = actors[i]['id']
+            actorids[actors[i]['id']] = i
+
+        graph.ep.id = graph.new_edge_property("int")
+        graph.ep.amount = graph.new_edge_property("float")
+        graph.ep.material = graph.new_edge_property("int")
+        graph.ep.process = graph.new_edge_property("int")
+        graph.ep.waste = graph.new_edge_property("bool")
+        graph.ep.hazardous = graph.new_edge_property("bool")
+
+        for flow in flows:
+            v0 = actorids.get(flow['origin_id'])
+            v1 = actorids.get(flow['destination_id']) \
+                if not flow['to_stock'] else v0
+            if (v0 != None and v1 != None):
+                e = graph.add_edge(graph.vertex(v0), graph.vertex(v1))
+                graph.ep.id[e] = flow['id']
+                graph.ep.material[e] = flow['material_id']
+                graph.ep.waste[e] = flow['waste']
+                graph.ep.hazardous[e] = flow['hazardous']
+                process_id = flow['process_id']
+                graph.ep.process[e] = process_id \
+                    if process_id is not None else - 1
+                graph.ep.amount[e] = flow['amount']
+        return graph
+
+    @staticmethod
+    def edge_table(graph):
+        """edges with actor ids and properties, sorted by flow id"""
+        rows = [(graph.ep.id[e], graph.vp.id[e.source()],
+                 graph.vp.id[e.target()], graph.ep.material[e],
+                 graph.ep.process[e], graph.ep.amount[e])
+                for e in graph.edges()]
+        return np.array(sorted(rows))
+
+    def test_bulk_build(self):
+        start = time.time()
+        iter_graph = self.build_iteratively()
+        t_iter = time.time() - start
+
+        basegraph = BaseGraph(self.kic, tag='benchmark')
+        start = time.time()
+        bulk_graph = basegraph.build()
+        t_bulk = time.time() - start
+        print(f'building graph with {bulk_graph.num_edges()} edges: '
+              f'{t_iter:.2f}s adding edges one by one, '
+              f'{t_bulk:.2f}s bulk build')
+
+        assert bulk_graph.num_vertices() == iter_graph.num_vertices()
+        assert bulk_graph.num_edges() == iter_graph.num_edges()
+        np.testing.assert_array_almost_equal(self.edge_table(bulk_graph),
+                                             self.edge_table(iter_graph))
+        basegraph.remove()
+
+
+class ClosestActorBenchmark(flowmodeltestdata.GenerateBigTestDataMixin,
+                            TestCase):
+    """
+    match 10k actors to their closest ones of 10k possible targets
+    """
+    n_actors = 10000
+
+    def setUp(self):
+        super().setUp()
+        self.create_keyflow()
+        self.create_actors(2 * self.n_actors)
+        actors = Actor.objects.filter(
+            activity__activitygroup__keyflow=self.kic).order_by('id')
+        # scatter the actors over about 200 x 200 km around Amsterdam
+        xs = np.random.uniform(3.5, 6.5, len(actors))
+        ys = np.random.uniform(51.5, 53.3, len(actors))
+        locations = [AdministrativeLocation(
+            actor=actor, geom=Point(x=x, y=y, srid=4326))
+                     for actor, x, y in zip(actors, xs, ys)]
+        AdministrativeLocation.objects.bulk_create(locations)
+        ids = list(actors.values_list('id', flat=True))
+        self.actors = Actor.objects.filter(id__in=ids[:self.n_actors])
+        self.targets = Actor.objects.filter(id__in=ids[self.n_actors:])
+
+    @staticmethod
+    def projected(actors):
+        """projected coordinates of the actors by id"""
+        coords = {}
+        for actor in actors.select_related('administrative_location'):
+            pnt = actor.administrative_location.geom.transform(
+                3035, clone=True)
+            coords[actor.id] = (pnt.x, pnt.y)
+        return coords
+
+    def closest_brute_force(self, actors, targets, max_distance):
+        """closest targets by comparing every actor with every target"""
+        actor_coords = self.projected(actors)
+        target_coords = self.projected(targets)
+        target_ids = np.array(list(target_coords.keys()))
+        target_xy = np.array(list(target_coords.values()))
+        closest = {}
+        for actor_id, xy in actor_coords.items():
+            distances = np.hypot(*(target_xy - xy).T)
+            i = distances.argmin()
+            if distances[i] <= max_distance:
+                closest[actor_id] = (target_ids[i], distances[i])
+        return closest
+
+    def test_find_closest_actor(self):
+        max_distance = 5000
+        start = time.time()
+        closest = StrategyGraph.find_closest_actor(
+            self.actors, self.targets, absolute_max_distance=max_distance)
+        duration = time.time() - start
+        print(f'matching {self.actors.count()} actors to the closest of '
+              f'{self.targets.count()} targets: {duration:.2f}s')
+
+        # compare a subset with the brute force search, compare the distances
+        # instead of the ids, equally distant targets might be picked instead
+        actor_ids = set(self.actors.values_list('id', flat=True)[:500])
+        expected = self.closest_brute_force(
+            Actor.objects.filter(id__in=actor_ids), self.targets,
+            max_distance)
+        found = {a: t for a, t in closest.items() if a in actor_ids}
+        assert found.keys() == expected.keys()
+        coords = self.projected(Actor.objects.filter(
+            Q(id__in=found.keys()) | Q(id__in=found.values())))
+        for actor_id, target_id in found.items():
+            distance = np.hypot(*np.subtract(coords[actor_id],
+                                             coords[target_id]))
+            self.assertAlmostEqual(distance, expected[actor_id][1], places=3)
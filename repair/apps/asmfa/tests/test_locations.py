@@ -1,13 +1,16 @@
 # -*- coding: utf-8 -*-
 
 from django.contrib.gis.geos.point import Point
+from django.contrib.gis.geos import Polygon, MultiPolygon
+from django.test import TestCase
 from django.urls import reverse
 from rest_framework import status
 from test_plus import APITestCase
 from repair.tests.test import LoginTestCase
 
 from repair.apps.login.models import CaseStudy
-from repair.apps.asmfa.models import Actor
+from repair.apps.asmfa.models import Actor, ActorInArea
+from repair.apps.asmfa.actorareas import rebuild_actor_areas
 from repair.apps.asmfa.factories import (AdministrativeLocationFactory,
                                          OperationalLocationFactory)
 from repair.apps.studyarea.factories import AreaFactory
@@ -488,3 +491,43 @@ class TestLocationsOfActor(LoginTestCase, APITestCase):
         geom = response.data['geometry']
         self.assertJSONEqual(str(geom), new_geom.geojson)
         assert response.data['properties']['address'] == new_streetname
+
+
+class ActorInAreaTest(TestCase):
+
+    @staticmethod
+    def square(x, y):
+        return MultiPolygon(Polygon(((x, y), (x, y + 1), (x + 1, y + 1),
+                                     (x + 1, y), (x, y))), srid=4326)
+
+    def memberships(self):
+        return set(ActorInArea.objects.values_list('actor', 'area'))
+
+    def test_memberships(self):
+        """the memberships follow the changes of locations and areas"""
+        area1 = AreaFactory(geom=self.square(0, 0))
+        area2 = AreaFactory(geom=self.square(0.5, 0),
+                            adminlevel=area1.adminlevel)
+        location = AdministrativeLocationFactory(
+            geom=Point(x=0.2, y=0.5, srid=4326))
+        actor = location.actor
+        assert self.memberships() == {(actor.id, area1.id)}
+
+        # moving the location
+        location.geom = Point(x=0.8, y=0.5, srid=4326)
+        location.save()
+        assert self.memberships() == {(actor.id, area1.id),
+                                      (actor.id, area2.id)}
+        # moving the area
+        area1.geom = self.square(5, 5)
+        area1.save()
+        assert self.memberships() == {(actor.id, area2.id)}
+        assert list(Actor.objects.filter(
+            area_memberships__area=area2)) == [actor]
+
+        ActorInArea.objects.all().delete()
+        rebuild_actor_areas()
+        assert self.memberships() == {(actor.id, area2.id)}
+
+        location.delete()
+        assert not self.memberships()
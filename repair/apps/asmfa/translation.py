@@ -0,0 +1,306 @@
+'''
+set-based translation of actor flows and stocks into fraction flows
+
+the flows (resp. stocks) are translated in batches, the fractions of the
+compositions are joined to all flows of a batch in a single query, the
+amounts of the fraction flows are calculated by the database, the outdated
+fraction flows of the batch are deleted at once and the new ones are bulk
+created
+
+whole keyflows are translated in partitions (ranges of ids) in a pool of
+processes, the progress is kept in TranslationCheckpoint to resume
+interrupted runs
+'''
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.db import connection, connections, transaction
+from django.db.models import F, FloatField, ExpressionWrapper
+from django.db.models.functions import Coalesce
+
+from repair.apps.asmfa.dataversion import (bulk_changes, bump_data_version,
+                                          suppress_bumps)
+from repair.apps.asmfa.graphs.maintenance import (flows_changed,
+                                                  suppress_patching)
+
+# number of flows translated at once
+BATCH_SIZE = 5000
+
+
+def _ids(objects):
+    if hasattr(objects, 'values_list'):
+        return list(objects.values_list('id', flat=True))
+    return [getattr(o, 'id', o) for o in objects]
+
+
+def _batches(ids, batch_size):
+    # sqlite limits the number of parameters of a query
+    max_params = connection.features.max_query_params
+    if max_params:
+        batch_size = min(batch_size, max_params - 1)
+    for i in range(0, len(ids), batch_size):
+        yield ids[i:i + batch_size]
+
+
+def _fraction_flows(ids, is_stock):
+    '''
+    unsaved fraction flows of the flows (resp. stocks) with the given ids
+    '''
+    from repair.apps.asmfa.models import FractionFlow, ProductFraction
+    related = 'actorstock' if is_stock else 'actor2actor'
+    prefix = f'composition__{related}__'
+    fields = dict(
+        f_id=F(prefix + 'id'),
+        f_origin=F(prefix + 'origin'),
+        f_amount=ExpressionWrapper(F(prefix + 'amount') * F('fraction'),
+                                   output_field=FloatField()),
+        f_publication=Coalesce('publication', prefix + 'publication'),
+        f_waste=F(prefix + 'waste'),
+        f_keyflow=F(prefix + 'keyflow'),
+        f_description=F(prefix + 'description'),
+        f_year=F(prefix + 'year'),
+    )
+    if not is_stock:
+        fields['f_destination'] = F(prefix + 'destination')
+        fields['f_process'] = F(prefix + 'process')
+    rows = ProductFraction.objects.filter(**{prefix + 'id__in': ids}).values(
+        'material', 'avoidable', 'hazardous',
+        'composition__nace', 'composition__name', **fields)
+    for row in rows.iterator():
+        yield FractionFlow(
+            flow_id=None if is_stock else row['f_id'],
+            stock_id=row['f_id'] if is_stock else None,
+            to_stock=is_stock,
+            origin_id=row['f_origin'],
+            destination_id=row.get('f_destination'),
+            material_id=row['material'],
+            amount=row['f_amount'],
+            nace=row['composition__nace'],
+            composition_name=row['composition__name'],
+            publication_id=row['f_publication'],
+            avoidable=row['avoidable'],
+            hazardous=row['hazardous'],
+            waste=row['f_waste'],
+            process_id=row.get('f_process'),
+            keyflow_id=row['f_keyflow'],
+            description=row['f_description'],
+            year=row['f_year']
+        )
+
+
+def _translate(model, objects, batch_size=BATCH_SIZE, callback=None):
+    from repair.apps.asmfa.models import FractionFlow, ActorStock
+    is_stock = model is ActorStock
+    ids = _ids(objects)
+    n_created = 0
+    for batch in _batches(ids, batch_size):
+        keyflow_ids = set(model.objects.filter(id__in=batch).values_list(
+            'keyflow', flat=True))
+        with transaction.atomic(), bulk_changes():
+            # delete the already translated fraction flows
+            # (recreation in any case)
+            outdated = FractionFlow.objects.filter(
+                **{'stock__in' if is_stock else 'flow__in': batch})
+            # neither delete nor bulk_create send signals, the changes are
+            # passed on explicitly
+            changed_ids = {}
+            for keyflow_id, flow_id in outdated.values_list('keyflow', 'id'):
+                changed_ids.setdefault(keyflow_id, []).append(flow_id)
+            outdated.delete()
+            created = FractionFlow.objects.bulk_create(
+                _fraction_flows(batch, is_stock), batch_size=batch_size)
+            for keyflow_id in keyflow_ids:
+                bump_data_version(id=keyflow_id)
+            for keyflow_id, flow_id in outdated.values_list('keyflow', 'id'):
+                changed_ids.setdefault(keyflow_id, []).append(flow_id)
+            for keyflow_id, flow_ids in changed_ids.items():
+                flows_changed(keyflow_id, flow_ids)
+        n_created += len(created)
+        if callback:
+            callback(len(batch), len(created))
+    return n_created
+
+
+def translate_flows(flows, batch_size=BATCH_SIZE, callback=None):
+    '''
+    translate the actor flows into fraction flows, the existing fraction
+    flows of the actor flows are replaced
+
+    Parameters
+    ----------
+    flows: QuerySet or list
+        the Actor2Actor flows (or their ids) to translate
+    batch_size: int, optional
+        number of flows translated at once
+    callback: function, optional
+        called after each batch with the number of translated flows and the
+        number of created fraction flows
+
+    Returns
+    -------
+    int
+        the number of created fraction flows
+    '''
+    from repair.apps.asmfa.models import Actor2Actor
+    return _translate(Actor2Actor, flows, batch_size=batch_size,
+                      callback=callback)
+
+
+def translate_stocks(stocks, batch_size=BATCH_SIZE, callback=None):
+    '''
+    translate the actor stocks into fraction flows, the existing fraction
+    flows of the stocks are replaced (see translate_flows)
+    '''
+    from repair.apps.asmfa.models import ActorStock
+    return _translate(ActorStock, stocks, batch_size=batch_size,
+                      callback=callback)
+
+
+def _model(kind):
+    from repair.apps.asmfa.models import (Actor2Actor, ActorStock,
+                                          TranslationCheckpoint)
+    return Actor2Actor if kind == TranslationCheckpoint.FLOWS else ActorStock
+
+
+def partition_items(kind, keyflow_id, partition_size):
+    '''
+    return the id ranges (first id, last id, number of items) of the flows
+    (resp. stocks) of the keyflow split into partitions of partition_size
+    '''
+    ids = list(_model(kind).objects.filter(keyflow=keyflow_id).order_by(
+        'id').values_list('id', flat=True))
+    return [(part[0], part[-1], len(part))
+            for part in (ids[i:i + partition_size]
+                         for i in range(0, len(ids), partition_size))]
+
+
+def plan_checkpoints(keyflow_ids, kinds, partition_size):
+    '''
+    return the checkpoints of a translation of the keyflows, the ones left
+    over from an interrupted run if there are any (resume), otherwise the
+    ones of a new run
+    '''
+    from repair.apps.asmfa.models import TranslationCheckpoint
+    checkpoints = TranslationCheckpoint.objects.filter(
+        keyflow__in=keyflow_ids, kind__in=kinds)
+    if checkpoints.filter(done=False).exists():
+        return checkpoints.order_by('kind', 'keyflow', 'first_id')
+    checkpoints.delete()
+    new = []
+    for kind in kinds:
+        for keyflow_id in keyflow_ids:
+            for first_id, last_id, n_items in partition_items(
+                kind, keyflow_id, partition_size):
+                new.append(TranslationCheckpoint(
+                    kind=kind, keyflow_id=keyflow_id, first_id=first_id,
+                    last_id=last_id, n_items=n_items))
+    TranslationCheckpoint.objects.bulk_create(new)
+    return checkpoints.order_by('kind', 'keyflow', 'first_id')
+
+
+def _items(checkpoint):
+    return _model(checkpoint.kind).objects.filter(
+        keyflow=checkpoint.keyflow_id, id__gte=checkpoint.first_id,
+        id__lte=checkpoint.last_id)
+
+
+def run_checkpoint(checkpoint_id):
+    '''
+    translate the partition of the checkpoint and mark it as done, neither
+    the version of the data is bumped nor the base graph of the keyflow
+    patched (see run_checkpoints)
+    '''
+    from repair.apps.asmfa.models import TranslationCheckpoint
+    checkpoint = TranslationCheckpoint.objects.get(id=checkpoint_id)
+    start = time.time()
+    translate = (translate_flows
+                 if checkpoint.kind == TranslationCheckpoint.FLOWS
+                 else translate_stocks)
+    with suppress_bumps(), suppress_patching():
+        n_created = translate(_items(checkpoint))
+    checkpoint.n_created = n_created
+    checkpoint.duration = time.time() - start
+    checkpoint.done = True
+    checkpoint.save()
+    return checkpoint
+
+
+def _run(checkpoint_id):
+    try:
+        return run_checkpoint(checkpoint_id)
+    finally:
+        # every process has its own connection
+        connection.close()
+
+
+def run_checkpoints(checkpoints, processes=None, callback=None):
+    '''
+    translate the partitions of the checkpoints not done yet in a pool of
+    processes (partitions don't share any flows)
+
+    Parameters
+    ----------
+    checkpoints: QuerySet
+        the checkpoints to run
+    processes: int, optional
+        the number of processes, defaults to the number of cpus,
+        the partitions are translated one after another in this process if 0
+    callback: function, optional
+        called with every finished checkpoint
+
+    the versions of the data of the keyflows are bumped once before and
+    after the run, the base graphs are not patched (rebuild them afterwards)
+    '''
+    pending = checkpoints.filter(done=False)
+    ids = list(pending.values_list('id', flat=True))
+    keyflow_ids = set(pending.values_list('keyflow', flat=True))
+    # invalidate the cached results right away, the run might be interrupted
+    for keyflow_id in keyflow_ids:
+        bump_data_version(id=keyflow_id)
+    if processes == 0:
+        for checkpoint_id in ids:
+            checkpoint = run_checkpoint(checkpoint_id)
+            if callback:
+                callback(checkpoint)
+    else:
+        # the forked processes must not share the connection of this one
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            futures = [executor.submit(_run, checkpoint_id)
+                       for checkpoint_id in ids]
+            for future in as_completed(futures):
+                checkpoint = future.result()
+                if callback:
+                    callback(checkpoint)
+    for keyflow_id in keyflow_ids:
+        bump_data_version(id=keyflow_id)
+
+
+def expected_rows(kind, keyflow_id):
+    '''number of fraction flows the flows (resp. stocks) translate into'''
+    from repair.apps.asmfa.models import ProductFraction, TranslationCheckpoint
+    related = ('actor2actor' if kind == TranslationCheckpoint.FLOWS
+               else 'actorstock')
+    return ProductFraction.objects.filter(
+        **{f'composition__{related}__keyflow': keyflow_id}).count()
+
+
+def measure_throughput(kind, keyflow_id, sample_size=1000):
+    '''
+    translate a sample of the flows (resp. stocks) of the keyflow without
+    committing it, returns the number of translated items per second (None
+    if there are no items)
+    '''
+    items = _model(kind).objects.filter(keyflow=keyflow_id).order_by('id')
+    sample = list(items.values_list('id', flat=True)[:sample_size])
+    if not sample:
+        return None
+    from repair.apps.asmfa.models import TranslationCheckpoint
+    translate = (translate_flows if kind == TranslationCheckpoint.FLOWS
+                 else translate_stocks)
+    with transaction.atomic():
+        start = time.time()
+        translate(sample)
+        duration = time.time() - start
+        transaction.set_rollback(True)
+    return len(sample) / duration if duration else None
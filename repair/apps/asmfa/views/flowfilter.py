@@ -2,15 +2,17 @@ from collections import defaultdict, OrderedDict
 from rest_framework.viewsets import ModelViewSet
 from reversion.views import RevisionMixin
 from django.contrib.gis.geos import GEOSGeometry
-from django.http import HttpResponseBadRequest, HttpResponse
+from django.http import (HttpResponseBadRequest, HttpResponse,
+                         StreamingHttpResponse)
 import numpy as np
 import copy
 import json
+from itertools import groupby
 from collections import defaultdict, OrderedDict
 from django.utils.translation import ugettext_lazy as _
-from django.contrib.gis.db.models import Union
 from rest_framework.response import Response
 from rest_framework.decorators import action
+from rest_framework.utils.encoders import JSONEncoder
 from django.db.models import (Q, Sum, F, QuerySet)
 
 from repair.apps.utils.views import (CasestudyViewSetMixin,
@@ -18,6 +20,7 @@ from repair.apps.utils.views import (CasestudyViewSetMixin,
                                      PostGetViewMixin)
 from repair.apps.utils.utils import (descend_materials,
                                      get_annotated_fractionflows)
+from repair.apps.asmfa.materialtree import get_material_tree
 
 from repair.apps.asmfa.models import (
     Flow, AdministrativeLocation, Actor2Actor, Group2Group,
@@ -25,7 +28,6 @@ from repair.apps.asmfa.models import (
     AdministrativeLocation, Process, StrategyFractionFlow
 )
 from repair.apps.changes.models import Strategy
-from repair.apps.studyarea.models import Area
 
 from repair.apps.asmfa.serializers import (
     FractionFlowSerializer
@@ -64,12 +66,44 @@ LEVEL_KEYWORD = {
     ActivityGroup: 'activitygroup'
 }
 
+# number of rows fetched at once when streaming
+STREAM_CHUNK_SIZE = 2000
+# number of serialized flows sent at once when streaming
+STREAM_FLOWS_PER_CHUNK = 100
+
+
+def stream_json(items, ndjson=False):
+    '''
+    generator of the JSON representation of the items in chunks, either as a
+    JSON array or as newline-delimited JSON (one item per line)
+    '''
+    encoder = JSONEncoder()
+    chunk = []
+    first = True
+    if not ndjson:
+        yield '['
+    for item in items:
+        chunk.append(encoder.encode(item))
+        if len(chunk) >= STREAM_FLOWS_PER_CHUNK:
+            yield _join_chunk(chunk, first, ndjson)
+            chunk = []
+            first = False
+    if chunk:
+        yield _join_chunk(chunk, first, ndjson)
+    if not ndjson:
+        yield ']'
+
+
+def _join_chunk(chunk, first, ndjson):
+    if ndjson:
+        return '\n'.join(chunk) + '\n'
+    return ('' if first else ',') + ','.join(chunk)
+
 def build_area_filter(function_name, values, keyflow_id):
     actors = Actor.objects.filter(
         activity__activitygroup__keyflow__id = keyflow_id)
-    areas = Area.objects.filter(id__in = values).aggregate(area=Union('geom'))
-    actors = actors.filter(
-        administrative_location__geom__intersects=areas['area'])
+    # the actors in the areas are precomputed, no need to intersect
+    actors = actors.filter(area_memberships__area__in=values)
     rest_func = 'origin__id__in' if function_name == 'origin__areas' \
         else 'destination__id__in'
     return rest_func, actors.values_list('id')
@@ -155,9 +189,20 @@ class FilterFlowViewSet(PostGetViewMixin, RevisionMixin,
                 destination: 'activity' or 'activitygroup', defaults to actor level
             }
         }
+
+        query params:
+            stream: 'json' to stream the flows as a JSON array,
+                    'ndjson' to stream them as newline-delimited JSON (one
+                    flow per line), the flows are serialized while being
+                    fetched instead of being rendered at once
         '''
         self.check_permission(request, 'view')
 
+        stream = request.query_params.get('stream', None)
+        if stream not in (None, 'json', 'ndjson'):
+            return HttpResponseBadRequest(
+                _('stream has to be either json or ndjson'))
+
         strategy_id = request.query_params.get('strategy', None)
         if strategy_id is not None:
             strategy = Strategy.objects.get(id=strategy_id)
@@ -229,6 +274,17 @@ class FilterFlowViewSet(PostGetViewMixin, RevisionMixin,
         except RecursionError as e:
             return HttpResponse(content=str(e), status=500)
 
+        if stream:
+            flows = self.iter_serialized(
+                queryset, origin_model=origin_level,
+                destination_model=destination_level,
+                aggregation_map=agg_map, chunk_size=STREAM_CHUNK_SIZE)
+            ndjson = stream == 'ndjson'
+            return StreamingHttpResponse(
+                stream_json(flows, ndjson=ndjson),
+                content_type=('application/x-ndjson' if ndjson
+                              else 'application/json'))
+
         data = self.serialize(queryset, origin_model=origin_level,
                               destination_model=destination_level,
                               aggregation_map=agg_map)
@@ -238,6 +294,7 @@ class FilterFlowViewSet(PostGetViewMixin, RevisionMixin,
         if query_params:
             query_params = query_params.copy()
             strategy = query_params.pop('strategy', None)
+            query_params.pop('stream', None)
             for key in query_params:
                 if (key.startswith('material') or
                     key.startswith('waste') or
@@ -280,41 +337,37 @@ class FilterFlowViewSet(PostGetViewMixin, RevisionMixin,
         queryset = queryset.order_by()
         materials_used = queryset.values('strategy_material').distinct()
         materials_used = Material.objects.filter(id__in=materials_used)
+        used_ids = [material.id for material in materials_used]
+        unaltered_ids = set(material.id for material in unaltered_materials)
+        tree = get_material_tree(*used_ids)
         #  no materials given -> aggregate to top level
         if not materials:
             # every material will be aggregated to the top ancestor
+            top_ids = {material.id: tree.top_ancestor(material.id)
+                       for material in materials_used}
+            top_materials = Material.objects.in_bulk(set(top_ids.values()))
             for material in materials_used:
-                if material.id not in unaltered_materials:
-                    agg_map[material.id] = material.top_ancestor
+                if material.id not in unaltered_ids:
+                    agg_map[material.id] = top_materials[top_ids[material.id]]
                 else:
                     agg_map[material.id] = material
 
         else:
-            exclusion = []
+            materials = list(materials)
             # look for parent material for each material in use
             for mat_used in materials_used:
-                found = False
-                if mat_used in unaltered_materials:
-                    found = True
+                if mat_used.id in unaltered_ids:
                     agg_map[mat_used.id] = mat_used
-                else:
-                    for material in materials:
-                        #  found yourself
-                        if mat_used == material:
-                            found = True
-                            agg_map[mat_used.id] = mat_used
-                            break
-                        #  found parent
-                        if mat_used.is_descendant(material):
-                            found = True
-                            agg_map[mat_used.id] = material
-                            break
-
-                if not found:
-                    exclusion.append(flow.id)
-            # exclude flows not in material hierarchy, shouldn't happen if
-            # correctly filtered before, but doesn't hurt
-            filtered = queryset.exclude(id__in=exclusion)
+                    continue
+                for material in materials:
+                    #  found yourself
+                    if mat_used.id == material.id:
+                        agg_map[mat_used.id] = mat_used
+                        break
+                    #  found parent
+                    if tree.is_descendant(mat_used.id, material.id):
+                        agg_map[mat_used.id] = material
+                        break
         return agg_map
 
     @staticmethod
@@ -346,23 +399,53 @@ class FilterFlowViewSet(PostGetViewMixin, RevisionMixin,
         aggregated to certain materials (values)
         (e.g. to aggregate child materials to their parents)
         '''
-        strategy = self.request.query_params.get('strategy', None)
+        return list(self.iter_serialized(
+            queryset, origin_model=origin_model,
+            destination_model=destination_model,
+            aggregation_map=aggregation_map))
+
+    def iter_serialized(self, queryset, origin_model=Actor,
+                        destination_model=Actor, aggregation_map=None,
+                        chunk_size=None):
+        '''
+        generator of the serialized flows in the same format as serialize,
+        the nodes and processes are queried when called, the flows are fetched
+        and serialized group by group while iterating
+
+        the rows are fetched with a server-side cursor in chunks of chunk_size
+        rows if given, otherwise all at once
+        '''
         origin_filter = 'origin' + FILTER_SUFFIX[origin_model]
         destination_filter = 'destination' + FILTER_SUFFIX[destination_model]
         origin_level = LEVEL_KEYWORD[origin_model]
         destination_level = LEVEL_KEYWORD[destination_model]
-        data = []
-        origins = origin_model.objects.filter(
-            id__in=list(queryset.values_list(origin_filter, flat=True)))
-        destinations = destination_model.objects.filter(
-            id__in=list(queryset.values_list(destination_filter, flat=True)))
         # workaround Django ORM bug
         queryset = queryset.order_by()
 
-        groups = queryset.values(
-            origin_filter, destination_filter,
-            'strategy_waste', 'strategy_process', 'to_stock',
-            'strategy_hazardous').distinct()
+        group_fields = (origin_filter, destination_filter,
+                        'strategy_waste', 'strategy_process', 'to_stock',
+                        'strategy_hazardous')
+        # sum up same materials per group in a single query, the rows of a
+        # group are adjacent
+        annotation = {
+            'material': F('strategy_material'),
+            'name':  F('strategy_material_name'),
+            'level': F('strategy_material_level'),
+            #'delta': Sum('strategy_delta'),
+            'amount': Sum('strategy_amount')
+        }
+        rows = queryset.values(*group_fields, 'strategy_material')\
+            .annotate(**annotation).order_by(*group_fields)
+        mat_fields = ('strategy_material', ) + tuple(annotation.keys())
+
+        origins = origin_model.objects.filter(
+            id__in=queryset.values(origin_filter))
+        destinations = destination_model.objects.filter(
+            id__in=queryset.filter(**{f'{destination_filter}__isnull': False})
+            .values(destination_filter))
+        processes = Process.objects.in_bulk(set(
+            queryset.filter(strategy_process__isnull=False)
+            .values_list('strategy_process', flat=True).distinct()))
 
         def get_code_field(model):
             if model == Actor:
@@ -381,69 +464,75 @@ class FilterFlowViewSet(PostGetViewMixin, RevisionMixin,
             add_fields=[get_code_field(destination_model)]
         )
 
-        for group in groups:
-            grouped = queryset.filter(**group)
-            origin_item = origin_dict[group[origin_filter]]
+        def serialize_group(group, grouped_mats):
+            (origin_id, destination_id, waste, process_id,
+             to_stock, hazardous) = group
+            origin_item = origin_dict[origin_id]
             origin_item['level'] = origin_level
-            dest_item = destination_dict[group[destination_filter]]
+            dest_item = destination_dict[destination_id]
             if dest_item:
                 dest_item['level'] = destination_level
-            # sum up same materials
-            annotation = {
-                'material': F('strategy_material'),
-                'name':  F('strategy_material_name'),
-                'level': F('strategy_material_level'),
-                #'delta': Sum('strategy_delta'),
-                'amount': Sum('strategy_amount')
-            }
-            grouped_mats = \
-                list(grouped.values('strategy_material').annotate(**annotation))
+            # sum over all rows in group
+            amounts = [mat['amount'] for mat in grouped_mats
+                       if mat['amount'] is not None]
+            strat_total_amount = sum(amounts) if amounts else None
             # aggregate materials according to mapping aggregation_map
             if aggregation_map:
-                aggregated = {}
-                for grouped_mat in grouped_mats:
-                    mat_id = grouped_mat['strategy_material']
-                    amount = grouped_mat['amount']
-                    mapped = aggregation_map[mat_id]
-
-                    agg_mat_ser = aggregated.get(mapped.id, None)
-                    # create dict for aggregated materials if there is none
-                    if not agg_mat_ser:
-                        agg_mat_ser = {
-                            'material': mapped.id,
-                            'name': mapped.name,
-                            'level': mapped.level,
-                            'amount': amount,
-                            #'delta': grouped_mat['delta']
-                        }
-                        aggregated[mapped.id] = agg_mat_ser
-                    # just sum amounts up if dict is already there
-                    else:
-                        agg_mat_ser['amount'] += amount
-                        #if strategy is not None:
-                            #agg_mat_ser['delta'] += grouped_mat['delta']
-                grouped_mats = aggregated.values()
-            process = Process.objects.get(id=group['strategy_process']) \
-                if group['strategy_process'] else None
-            # sum over all rows in group
-            #sq_total_amount = list(grouped.aggregate(Sum('amount')).values())[0]
-            strat_total_amount = list(
-                grouped.aggregate(Sum('strategy_amount')).values())[0]
-            #deltas = list(grouped.aggregate(Sum('strategy_delta')).values())[0]
-            flow_item = OrderedDict((
+                grouped_mats = self.aggregate_materials(grouped_mats,
+                                                        aggregation_map)
+            process = processes[process_id] if process_id else None
+            return OrderedDict((
                 ('origin', origin_item),
                 ('destination', dest_item),
-                ('waste', group['strategy_waste']),
-                ('hazardous', group['strategy_hazardous']),
-                ('stock', group['to_stock']),
+                ('waste', waste),
+                ('hazardous', hazardous),
+                ('stock', to_stock),
                 ('process', process.name if process else ''),
                 ('process_id', process.id if process else None),
                 ('amount', strat_total_amount),
                 ('materials', grouped_mats),
                 #('delta', deltas)
             ))
-            data.append(flow_item)
-        return data
+
+        def generate():
+            rows_iter = (rows.iterator(chunk_size=chunk_size)
+                         if chunk_size else rows)
+            for group, group_rows in groupby(
+                rows_iter,
+                key=lambda row: tuple(row[field] for field in group_fields)):
+                grouped_mats = [{field: row[field] for field in mat_fields}
+                                for row in group_rows]
+                yield serialize_group(group, grouped_mats)
+
+        return generate()
+
+    @staticmethod
+    def aggregate_materials(grouped_mats, aggregation_map):
+        '''
+        sum up the amounts of the serialized materials per material they are
+        mapped to in the aggregation_map
+        '''
+        aggregated = {}
+        for grouped_mat in grouped_mats:
+            mat_id = grouped_mat['strategy_material']
+            amount = grouped_mat['amount']
+            mapped = aggregation_map[mat_id]
+
+            agg_mat_ser = aggregated.get(mapped.id, None)
+            # create dict for aggregated materials if there is none
+            if not agg_mat_ser:
+                agg_mat_ser = {
+                    'material': mapped.id,
+                    'name': mapped.name,
+                    'level': mapped.level,
+                    'amount': amount,
+                    #'delta': grouped_mat['delta']
+                }
+                aggregated[mapped.id] = agg_mat_ser
+            # just sum amounts up if dict is already there
+            else:
+                agg_mat_ser['amount'] += amount
+        return list(aggregated.values())
 
     @staticmethod
     def filter_chain(queryset, filters, keyflow):
@@ -12,6 +12,9 @@ from rest_framework.response import Response
 import json
 
 from repair.apps.asmfa.graphs.graph import BaseGraph
+from repair.apps.changes.models import Strategy
+from repair.apps.changes.serializers import CalculationJobSerializer
+from repair.apps.changes import jobs
 
 from repair.apps.asmfa.models import (
     Keyflow,
@@ -85,6 +88,38 @@ class KeyflowInCasestudyViewSet(CasestudyViewSetMixin, ModelPermissionViewSet):
         res = kfgraph.validate()
         return Response(res)
 
+    @action(methods=['post'], detail=True)
+    def rebuild_strategies(self, request, **kwargs):
+        '''
+        recalculate all strategies of the keyflow in parallel in the
+        background, returns the calculation jobs of the strategies
+        '''
+        self.check_permission(request, 'change')
+        keyflow = self.get_object()
+        return self._rebuild_strategies([keyflow])
+
+    @action(methods=['post'], detail=False, url_path='rebuild_strategies')
+    def rebuild_casestudy_strategies(self, request, **kwargs):
+        '''
+        recalculate all strategies of all keyflows of the casestudy in
+        parallel in the background, keyflows without base data are skipped,
+        returns the calculation jobs of the strategies
+        '''
+        self.check_permission(request, 'change')
+        keyflows = self.queryset.filter(casestudy__id=kwargs['casestudy_pk'])
+        return self._rebuild_strategies(keyflows)
+
+    def _rebuild_strategies(self, keyflows):
+        keyflows = [keyflow for keyflow in keyflows
+                    if BaseGraph(keyflow).exists]
+        if not keyflows:
+            raise exceptions.NotFound(_('The base data is not set up.'))
+        strategies = Strategy.objects.filter(
+            keyflow__in=keyflows).order_by('id')
+        calc_jobs = jobs.rebuild_strategies_in_background(strategies)
+        return Response(
+            CalculationJobSerializer(calc_jobs, many=True).data)
+
 
 class CommaSeparatedValueFilter(Filter):
     def filter(self, qs, value):
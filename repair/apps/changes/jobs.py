@@ -0,0 +1,360 @@
+'''
+local job queue for the calculation of strategies
+
+the queue is kept in the database (CalculationJob), no external broker
+needed; the queued jobs are processed in the background by a pool of worker
+threads, the size of the pool (the number of strategies calculated in parallel
+per server process) is set with settings.STRATEGY_CALCULATION_CONCURRENCY
+
+the workers claim the jobs only when they are free to run them, a strategy
+is never calculated by two jobs at once (a job queued while the strategy is
+being calculated waits for the running one), jobs still running after
+settings.STRATEGY_CALCULATION_TIMEOUT seconds are considered lost (e.g. by a
+restart of the server) and marked as failed
+
+whole keyflows or casestudies can be recalculated at once in a pool of
+processes (rebuild_strategies, used by the management command
+rebuild_strategies), the web application queues them and lets a pool of
+worker processes (settings.STRATEGY_REBUILD_PROCESSES) run the queue
+instead of the threads (rebuild_strategies_in_background), the
+calculations are mostly bound to the GIL
+'''
+import os
+import logging
+import threading
+import time
+from datetime import timedelta
+from functools import partial
+from concurrent.futures import (ThreadPoolExecutor, ProcessPoolExecutor,
+                                as_completed)
+from concurrent.futures.process import BrokenProcessPool
+
+from django.conf import settings
+from django.db import connection, connections, transaction
+from django.utils import timezone
+
+from repair.apps.changes.models import (CalculationJob, JobStatus, Strategy,
+                                        SolutionInStrategy, SolutionPart)
+from repair.apps.asmfa.graphs.graph import StrategyGraph
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_process_executor = None
+_lock = threading.Lock()
+
+
+def get_concurrency():
+    '''number of strategies calculated in parallel'''
+    return getattr(settings, 'STRATEGY_CALCULATION_CONCURRENCY', 2)
+
+
+def _get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=get_concurrency(),
+                thread_name_prefix='strategy-calculation')
+    return _executor
+
+
+def get_rebuild_processes():
+    '''number of processes recalculating whole keyflows or casestudies'''
+    return (getattr(settings, 'STRATEGY_REBUILD_PROCESSES', None) or
+            os.cpu_count())
+
+
+def _get_process_executor(renew=False):
+    global _process_executor
+    with _lock:
+        if renew and _process_executor is not None:
+            _process_executor.shutdown(wait=False)
+            _process_executor = None
+        if _process_executor is None:
+            _process_executor = ProcessPoolExecutor(
+                max_workers=get_rebuild_processes())
+    return _process_executor
+
+
+def get_timeout():
+    '''seconds after which running jobs are considered lost'''
+    return getattr(settings, 'STRATEGY_CALCULATION_TIMEOUT', 6 * 60 * 60)
+
+
+def fail_stale_jobs():
+    '''
+    mark the jobs running for longer than the timeout as failed (their
+    worker is gone), returns the number of failed jobs
+    '''
+    started_before = timezone.now() - timedelta(seconds=get_timeout())
+    stale = CalculationJob.objects.filter(status=JobStatus.RUNNING,
+                                          started__lt=started_before)
+    strategy_ids = list(stale.values_list('strategy', flat=True))
+    n_failed = stale.update(
+        status=JobStatus.FAILED, finished=timezone.now(),
+        message='The calculation was interrupted.')
+    if n_failed:
+        logger.warning(f'{n_failed} interrupted calculation jobs failed')
+        # strategies still waiting for another job are being calculated
+        waiting = CalculationJob.objects.filter(
+            strategy__in=strategy_ids, status=JobStatus.QUEUED).values(
+                'strategy')
+        Strategy.objects.filter(id__in=strategy_ids).exclude(
+            id__in=waiting).update(status=0)
+    return n_failed
+
+
+def enqueue(strategy, processes=False):
+    '''
+    queue the calculation of the strategy and mark the strategy as being
+    calculated, returns the job
+
+    if the strategy is being calculated already, the job waits for the
+    running one to finish, processes=True lets the pool of processes run the
+    queue instead of the threads (see dispatch)
+    '''
+    fail_stale_jobs()
+    with transaction.atomic():
+        # serialize the queueing of the same strategy
+        Strategy.objects.select_for_update().filter(id=strategy.id).exists()
+        # the strategy is already waiting in the queue, no need to queue it
+        # twice
+        job = CalculationJob.objects.filter(
+            strategy=strategy, status=JobStatus.QUEUED).first()
+        if not job:
+            job = CalculationJob.objects.create(strategy=strategy)
+        strategy.status = 1
+        strategy.date = timezone.now()
+        strategy.save()
+    # the workers would not see the job before the request is committed
+    transaction.on_commit(partial(dispatch, processes=processes))
+    return job
+
+
+def claim_next():
+    '''
+    take the oldest queued job from the queue and mark it as running,
+    returns None if there are no jobs left, jobs of strategies being
+    calculated by another job are skipped
+    '''
+    running = CalculationJob.objects.filter(
+        status=JobStatus.RUNNING).values('strategy')
+    queued = CalculationJob.objects.filter(
+        status=JobStatus.QUEUED).exclude(
+            strategy__in=running).order_by('created', 'id')
+    for job in queued:
+        # another process might have claimed the job in the meantime
+        claimed = CalculationJob.objects.filter(
+            id=job.id, status=JobStatus.QUEUED).update(
+                status=JobStatus.RUNNING, started=timezone.now())
+        if claimed:
+            job.refresh_from_db()
+            return job
+    return None
+
+
+def dispatch(processes=False):
+    '''
+    start a worker for every queued job, the workers claim the jobs when
+    they start running (the jobs wait in the database, not in the pool)
+
+    the workers are threads of this process or, if processes is True,
+    processes of a pool kept for the lifetime of this process (each with its
+    own connection to the database, loading the base graphs only once)
+    '''
+    n_queued = CalculationJob.objects.filter(
+        status=JobStatus.QUEUED).count()
+    if not processes:
+        executor = _get_executor()
+        for i in range(min(n_queued, get_concurrency())):
+            executor.submit(_work)
+        return
+    # the forked processes must not share the connection of this one
+    connections.close_all()
+    executor = _get_process_executor()
+    for i in range(min(n_queued, get_rebuild_processes())):
+        try:
+            executor.submit(_work)
+        except BrokenProcessPool:
+            # a process of the pool died (e.g. out of memory)
+            executor = _get_process_executor(renew=True)
+            executor.submit(_work)
+
+
+def _work():
+    '''run queued jobs until there are none left'''
+    try:
+        while True:
+            job = claim_next()
+            if job is None:
+                return
+            run_job(job)
+    finally:
+        # every thread has its own connection to the database
+        connection.close()
+
+
+def run_job(job, tag=''):
+    '''
+    calculate the strategy of the job and report the progress to the job
+    '''
+    strategy = job.strategy
+    implementations = SolutionInStrategy.objects.filter(strategy=strategy)
+    job.status = JobStatus.RUNNING
+    job.started = job.started or timezone.now()
+    job.n_implementations = implementations.count()
+    job.n_parts = SolutionPart.objects.filter(
+        solution__solutioninstrategy__in=implementations).count()
+    job.parts_done = 0
+    job.save()
+
+    def progress(implementation, solution_part):
+        job.parts_done += 1
+        job.implementation = implementation
+        job.solution_part = solution_part
+        job.save(update_fields=['parts_done', 'implementation',
+                                'solution_part'])
+
+    sgraph = StrategyGraph(strategy, tag=tag)
+    try:
+        sgraph.build(callback=progress, deferred=True)
+    except FileNotFoundError:
+        job.status = JobStatus.FAILED
+        job.message = ('The base data is not set up. '
+                       'Please contact your workshop leader.')
+        strategy.status = 0
+    except Exception as e:
+        logger.exception(f'calculation of strategy {strategy.id} failed')
+        job.status = JobStatus.FAILED
+        job.message = str(e)
+        strategy.status = 0
+    else:
+        job.status = JobStatus.FINISHED
+        strategy.status = 2
+    job.finished = strategy.date = timezone.now()
+    job.save()
+    strategy.save()
+    return job
+
+
+def get_active_job(strategy):
+    '''the queued or running job of the strategy, None if there is none'''
+    return CalculationJob.objects.filter(
+        strategy=strategy,
+        status__in=[JobStatus.QUEUED, JobStatus.RUNNING]).first()
+
+
+def create_rebuild_jobs(strategies):
+    '''
+    create running jobs for the recalculation of the strategies (bypassing
+    the queue) and mark the strategies as being calculated, strategies
+    queued or being calculated already are skipped
+    '''
+    fail_stale_jobs()
+    calc_jobs = []
+    for strategy in strategies:
+        if get_active_job(strategy):
+            logger.info(f'strategy {strategy.id} is being calculated '
+                        'already, skipped')
+            continue
+        calc_jobs.append(CalculationJob.objects.create(
+            strategy=strategy, status=JobStatus.RUNNING,
+            started=timezone.now()))
+        strategy.status = 1
+        strategy.date = timezone.now()
+        strategy.save()
+    return calc_jobs
+
+
+def _rebuild(job_id, tag=''):
+    '''recalculate the strategy of the job, returns the result'''
+    start = time.time()
+    try:
+        job = run_job(CalculationJob.objects.get(id=job_id), tag=tag)
+    finally:
+        connection.close()
+    return {
+        'strategy': job.strategy_id,
+        'job': job.id,
+        'status': job.status.name.lower(),
+        'message': job.message,
+        'duration': time.time() - start
+    }
+
+
+def run_rebuild_jobs(job_ids, processes=None, tag=''):
+    '''
+    run the jobs in a pool of processes, every process has its own
+    connection to the database and loads the base graphs only once
+
+    Parameters
+    ----------
+    job_ids: list of int
+       ids of the jobs to run
+    processes: int, optional
+       the number of processes, defaults to the number of cpus,
+       the jobs are run one after another in this process if 0
+    tag: str, optional
+       tag of the graphs
+
+    Returns
+    -------
+    list of dict
+       the results per strategy in order of completion, failing strategies
+       don't affect the others
+    '''
+    if processes == 0:
+        return [_rebuild(job_id, tag=tag) for job_id in job_ids]
+    results = []
+    # the forked processes must not share the connection of this one,
+    # they open their own ones
+    connections.close_all()
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = {executor.submit(_rebuild, job_id, tag): job_id
+                   for job_id in job_ids}
+        for future in as_completed(futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                # the process itself failed (e.g. out of memory)
+                job_id = futures[future]
+                logger.exception(f'rebuild of job {job_id} failed')
+                job = CalculationJob.objects.get(id=job_id)
+                job.status = JobStatus.FAILED
+                job.message = str(e)
+                job.finished = timezone.now()
+                job.save()
+                job.strategy.status = 0
+                job.strategy.save()
+                results.append({
+                    'strategy': job.strategy_id,
+                    'job': job.id,
+                    'status': job.status.name.lower(),
+                    'message': job.message,
+                    'duration': None
+                })
+    return results
+
+
+def rebuild_strategies(strategies, processes=None, tag=''):
+    '''
+    recalculate the strategies in a pool of processes and wait for the
+    results (see run_rebuild_jobs)
+    '''
+    calc_jobs = create_rebuild_jobs(strategies)
+    return run_rebuild_jobs([job.id for job in calc_jobs],
+                            processes=processes, tag=tag)
+
+
+def rebuild_strategies_in_background(strategies):
+    '''
+    queue the recalculation of the strategies and let the pool of processes
+    run them (see enqueue), strategies being calculated already are skipped,
+    returns the jobs to track the progress with
+    '''
+    calc_jobs = []
+    for strategy in strategies:
+        job = get_active_job(strategy)
+        calc_jobs.append(job or enqueue(strategy, processes=True))
+    return calc_jobs
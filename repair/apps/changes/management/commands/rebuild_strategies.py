@@ -0,0 +1,44 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+
+from repair.apps.changes.models import Strategy
+from repair.apps.changes.jobs import rebuild_strategies
+
+
+class Command(BaseCommand):
+
+    help = ("recalculates all strategies of the given keyflows or "
+            "casestudies (all strategies if none given) in parallel")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--keyflow_id', action='append', type=int)
+        parser.add_argument('--casestudy_id', action='append', type=int)
+        parser.add_argument('--processes', type=int, default=None,
+                            help='number of processes, defaults to the '
+                            'number of cpus, 0 to run in this process')
+
+    def handle(self, *args, **options):
+        keyflow_ids = options['keyflow_id']
+        casestudy_ids = options['casestudy_id']
+        strategies = Strategy.objects.all()
+        if keyflow_ids:
+            strategies = strategies.filter(keyflow__id__in=keyflow_ids)
+        if casestudy_ids:
+            strategies = strategies.filter(
+                keyflow__casestudy__id__in=casestudy_ids)
+        strategies = strategies.order_by('id')
+        if not strategies:
+            raise CommandError('no strategies found')
+
+        print(f'Recalculating {len(strategies)} strategies')
+        start = time.time()
+        results = rebuild_strategies(strategies,
+                                     processes=options['processes'])
+        for result in sorted(results, key=lambda r: r['strategy']):
+            duration = result['duration']
+            duration = '-' if duration is None else f'{duration:.1f}s'
+            message = f" ({result['message']})" if result['message'] else ''
+            print(f"Strategy {result['strategy']}: {result['status']} "
+                  f"in {duration}{message}")
+        failed = sum(result['status'] != 'finished' for result in results)
+        print(f'done in {time.time() - start:.1f}s, {failed} failed')
@@ -0,0 +1,39 @@
+# Generated by Django 2.2.4 on 2026-10-18 10:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+import enumfields.fields
+import repair.apps.changes.models.strategies
+import repair.apps.login.models.bases
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('changes', '0047_flowreference_include_child_materials'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CalculationJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', enumfields.fields.EnumIntegerField(default=0, enum=repair.apps.changes.models.strategies.JobStatus)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('started', models.DateTimeField(null=True)),
+                ('finished', models.DateTimeField(null=True)),
+                ('n_implementations', models.IntegerField(default=0)),
+                ('n_parts', models.IntegerField(default=0)),
+                ('parts_done', models.IntegerField(default=0)),
+                ('message', models.TextField(blank=True, default='')),
+                ('implementation', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='changes.SolutionInStrategy')),
+                ('solution_part', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='changes.SolutionPart')),
+                ('strategy', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='calculation_jobs', to='changes.Strategy')),
+            ],
+            options={
+                'abstract': False,
+                'default_permissions': ('add', 'change', 'delete', 'view'),
+            },
+            bases=(repair.apps.login.models.bases.GDSEModelMixin, models.Model),
+        ),
+    ]
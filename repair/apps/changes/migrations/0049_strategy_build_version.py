@@ -0,0 +1,18 @@
+# Generated by Django 2.2.4 on 2026-10-18 21:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('changes', '0048_calculationjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='strategy',
+            name='build_version',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -1,6 +1,8 @@
 
 from django.db.models import signals
 from django.contrib.gis.db import models
+from enumfields import EnumIntegerField
+from enum import Enum
 from repair.apps.login.models import (GDSEModel,
                                       UserInCasestudy)
 from repair.apps.asmfa.models import KeyflowInCasestudy, Actor
@@ -29,6 +31,8 @@ class Strategy(GDSEModel):
     status = models.IntegerField(default=0)
     # calculation started resp. finished
     date = models.DateTimeField(null=True)
+    # bumped whenever the calculated flows of the strategy change
+    build_version = models.IntegerField(default=0)
 
 
 class SolutionInStrategy(GDSEModel):
@@ -74,6 +78,38 @@ class ImplementationArea(GDSEModel):
     geom = models.MultiPolygonField(null=True, srid=4326, blank=True)
 
 
+class JobStatus(Enum):
+    QUEUED = 0
+    RUNNING = 1
+    FINISHED = 2
+    FAILED = 3
+
+
+class CalculationJob(GDSEModel):
+    '''
+    queued calculation of a strategy, the job queue is kept in the database
+    '''
+    strategy = models.ForeignKey(Strategy, on_delete=models.CASCADE,
+                                 related_name='calculation_jobs')
+    status = EnumIntegerField(enum=JobStatus, default=JobStatus.QUEUED)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True)
+    finished = models.DateTimeField(null=True)
+
+    # progress of the calculation
+    n_implementations = models.IntegerField(default=0)
+    n_parts = models.IntegerField(default=0)
+    parts_done = models.IntegerField(default=0)
+    # implementation and solution part calculated last
+    implementation = models.ForeignKey(SolutionInStrategy, null=True,
+                                       on_delete=models.SET_NULL,
+                                       related_name='+')
+    solution_part = models.ForeignKey(SolutionPart, null=True,
+                                      on_delete=models.SET_NULL,
+                                      related_name='+')
+    message = models.TextField(blank=True, default='')
+
+
 def trigger_implementationquantity_sii(sender, instance,
                                        created, **kwargs):
     """
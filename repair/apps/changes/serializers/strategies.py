@@ -9,7 +9,9 @@ from repair.apps.asmfa.models import FractionFlow, StrategyFractionFlow
 from repair.apps.changes.models import (Strategy,
                                         SolutionInStrategy,
                                         ImplementationQuantity,
-                                        ImplementationArea
+                                        ImplementationArea,
+                                        CalculationJob,
+                                        SolutionPart
                                         )
 
 from repair.apps.login.serializers import (InCasestudyField,
@@ -60,6 +62,9 @@ def reset_strategy_status():
     # if strategy is not set up (e.g. while testing),
     # there won't be any strategies anyway
     try:
+        # the jobs interrupted by a restart are not running anymore
+        from repair.apps.changes.jobs import fail_stale_jobs
+        fail_stale_jobs()
         strategies = Strategy.objects.all()
         # look for strategies marked as being calculated and update their status
         # according to found graph
@@ -165,6 +170,43 @@ class StrategySerializer(CreateWithUserInCasestudyMixin,
         return activities
 
 
+class CalculationJobSerializer(serializers.ModelSerializer):
+    status = serializers.SerializerMethodField()
+    implementations = serializers.SerializerMethodField()
+
+    class Meta:
+        model = CalculationJob
+        fields = ('id', 'strategy', 'status', 'created', 'started',
+                  'finished', 'message', 'n_implementations', 'n_parts',
+                  'parts_done', 'implementation', 'solution_part',
+                  'implementations')
+
+    def get_status(self, obj):
+        return obj.status.name.lower()
+
+    def get_implementations(self, obj):
+        '''
+        progress per implementation, the implementations are calculated one
+        after another in the order of their priority
+        '''
+        implementations = SolutionInStrategy.objects.filter(
+            strategy=obj.strategy).order_by('priority', 'id')
+        parts_left = obj.parts_done
+        progress = []
+        for implementation in implementations:
+            n_parts = SolutionPart.objects.filter(
+                solution=implementation.solution).count()
+            parts_done = min(parts_left, n_parts)
+            parts_left -= parts_done
+            progress.append({
+                'id': implementation.id,
+                'solution': implementation.solution_id,
+                'n_parts': n_parts,
+                'parts_done': parts_done
+            })
+        return progress
+
+
 class StrategyField(InCasestudyField):
     parent_lookup_kwargs = {
         'casestudy_pk': 'strategy__keyflow__casestudy__id',
@@ -2,7 +2,6 @@ from rest_framework.decorators import action
 from rest_framework.response import Response
 from django.http import HttpResponseNotFound
 from django.utils.translation import gettext as _
-from django.utils import timezone
 
 from repair.apps.utils.views import CasestudyViewSetMixin, ReadUpdateViewSet
 from repair.apps.asmfa.models import KeyflowInCasestudy
@@ -11,19 +10,22 @@ from repair.apps.changes.models import (
     Strategy,
     SolutionInStrategy,
     ImplementationQuantity,
-    SolutionPart
+    SolutionPart,
+    CalculationJob
     )
 
 from repair.apps.changes.serializers import (
     StrategySerializer,
     SolutionInStrategySerializer,
     ImplementationQuantitySerializer,
-    SolutionPartSerializer
+    SolutionPartSerializer,
+    CalculationJobSerializer
     )
 
 from repair.apps.utils.views import (ModelPermissionViewSet,
                                      ReadUpdatePermissionViewSet)
-from repair.apps.asmfa.graphs.graph import StrategyGraph
+from repair.apps.asmfa.graphs.graph import BaseGraph
+from repair.apps.changes import jobs
 
 
 class StrategyViewSet(CasestudyViewSetMixin,
@@ -62,24 +64,36 @@ class StrategyViewSet(CasestudyViewSetMixin,
 
     @action(methods=['get', 'post'], detail=True)
     def build_graph(self, request, **kwargs):
+        '''
+        queue the calculation of the strategy, returns the strategy along
+        with the id of the calculation job
+        '''
         strategy = self.get_object()
-        strategy.status = 1
-        strategy.date = timezone.now()
-        strategy.save()
-
-        sgraph = StrategyGraph(strategy)
-        try:
-            graph = sgraph.build()
-        except FileNotFoundError:
+        if not BaseGraph(strategy.keyflow).exists:
             return HttpResponseNotFound(_(
                 'The base data is not set up. '
                 'Please contact your workshop leader.'))
+        job = jobs.enqueue(strategy)
         serializer = self.get_serializer(strategy)
+        data = serializer.data
+        data['job'] = job.id
+        return Response(data)
 
-        strategy.status = 2
-        strategy.date = timezone.now()
-        strategy.save()
-        return Response(serializer.data)
+    @action(methods=['get'], detail=True)
+    def calculation_status(self, request, **kwargs):
+        '''
+        progress of the calculation job passed as query parameter "job",
+        defaults to the latest job of the strategy
+        '''
+        strategy = self.get_object()
+        job_id = request.query_params.get('job')
+        calc_jobs = CalculationJob.objects.filter(strategy=strategy)
+        if job_id is not None:
+            calc_jobs = calc_jobs.filter(id=job_id)
+        job = calc_jobs.order_by('-created', '-id').first()
+        if not job:
+            return HttpResponseNotFound(_('No calculation found.'))
+        return Response(CalculationJobSerializer(job).data)
 
 
 class SolutionInStrategyViewSet(CasestudyViewSetMixin, ModelPermissionViewSet):
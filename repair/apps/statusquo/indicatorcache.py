@@ -0,0 +1,91 @@
+'''
+cache of the computed values of the indicators
+
+the values are stored in the cache set with settings.INDICATOR_CACHE (an
+alias of settings.CACHES) by indicator, strategy, areas, geometry and the
+version of the data of the keyflow (see repair.apps.asmfa.dataversion), any
+change of the data of the keyflow makes the cached values unreachable,
+they expire after settings.INDICATOR_CACHE_TIMEOUT seconds
+'''
+import hashlib
+
+from django.conf import settings
+from django.core.cache import caches
+
+from repair.apps.asmfa.dataversion import get_data_version
+
+_STATS_KEYS = {'hits': 'indicators:stats:hits',
+               'misses': 'indicators:stats:misses'}
+
+
+def get_cache():
+    return caches[getattr(settings, 'INDICATOR_CACHE', 'default')]
+
+
+def make_key(indicator_id, keyflow_id, strategy_id=None, area_ids=(),
+             geom=None, aggregate=None, version=None):
+    '''
+    return the key of the values of the indicator computed with the given
+    parameters for the current (or given) version of the data of the keyflow
+    '''
+    if version is None:
+        version = get_data_version(keyflow_id)
+    area_ids = sorted(set(int(area_id) for area_id in area_ids))
+    geom_hash = hashlib.sha1(geom.encode()).hexdigest() if geom else ''
+    params = (f'{keyflow_id}:{version}:{indicator_id}:{strategy_id}:'
+              f'{",".join(str(a) for a in area_ids)}:{geom_hash}:{aggregate}')
+    return f'indicators:{hashlib.sha1(params.encode()).hexdigest()}'
+
+
+def _count(stat):
+    cache = get_cache()
+    key = _STATS_KEYS[stat]
+    # add doesn't override existing counters, incr fails on missing ones
+    cache.add(key, 0, timeout=None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, 1, timeout=None)
+
+
+def lookup(key):
+    '''return the cached values, None if not cached (counted as miss)'''
+    values = get_cache().get(key)
+    _count('misses' if values is None else 'hits')
+    return values
+
+
+def store(key, values):
+    '''store the values in the cache'''
+    get_cache().set(key, values,
+                    timeout=getattr(settings, 'INDICATOR_CACHE_TIMEOUT', None))
+
+
+def get_or_compute(key, compute):
+    '''
+    return the cached values, compute (function without arguments) and cache
+    them if not cached yet
+    '''
+    values = lookup(key)
+    if values is None:
+        values = compute()
+        store(key, values)
+    return values
+
+
+def stats():
+    '''return the number of hits and misses and the hit rate'''
+    cache = get_cache()
+    counts = cache.get_many(_STATS_KEYS.values())
+    hits = counts.get(_STATS_KEYS['hits'], 0)
+    misses = counts.get(_STATS_KEYS['misses'], 0)
+    total = hits + misses
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': hits / total if total else None
+    }
+
+
+def reset_stats():
+    get_cache().delete_many(_STATS_KEYS.values())
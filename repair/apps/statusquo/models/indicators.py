@@ -1,4 +1,5 @@
 from django.db import models
+from django.db.models import signals
 from django.core.validators import validate_comma_separated_integer_list
 from enum import Enum
 from enumfields import EnumIntegerField
@@ -6,6 +7,8 @@ import importlib
 
 from repair.apps.login.models import GDSEModel
 from repair.apps.asmfa.models import Material, KeyflowInCasestudy
+from repair.apps.asmfa.dataversion import (bump_on_change,
+                                          bump_on_indicator_flow_change)
 
 
 class TriState(Enum):
@@ -100,3 +103,22 @@ class FlowIndicator(GDSEModel):
         module = importlib.import_module(
             'repair.apps.statusquo.views.computation')
         return getattr(module, self.indicator_type.name)
+
+
+signals.post_save.connect(
+    bump_on_change,
+    sender=FlowIndicator,
+    weak=False,
+    dispatch_uid='models.bump_on_indicator_save')
+
+signals.post_delete.connect(
+    bump_on_change,
+    sender=FlowIndicator,
+    weak=False,
+    dispatch_uid='models.bump_on_indicator_delete')
+
+signals.pre_delete.connect(
+    bump_on_indicator_flow_change,
+    sender=IndicatorFlow,
+    weak=False,
+    dispatch_uid='models.bump_on_indicatorflow_delete')
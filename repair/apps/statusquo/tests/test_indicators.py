@@ -15,7 +15,14 @@ from repair.apps.statusquo.factories import (FlowIndicatorFactory,
                                              )
 from repair.apps.studyarea.factories import (AreaFactory,
                                              )
-from repair.apps.statusquo.views.computation import ComputeIndicator
+from django.contrib.gis.geos import Polygon, MultiPolygon, Point
+from repair.apps.asmfa.models import FractionFlow, AdministrativeLocation
+from repair.apps.statusquo.views.computation import (ComputeIndicator,
+                                                     IndicatorA,
+                                                     IndicatorAB,
+                                                     BatchFlowSums)
+from repair.apps.statusquo import indicatorcache
+from repair.apps.asmfa.dataversion import get_data_version
 
 
 class FlowIndicatorTest(BasicModelPermissionTest, APITestCase):
@@ -126,3 +133,91 @@ class FlowIndicatorTest(BasicModelPermissionTest, APITestCase):
     def test_ComputeIndicator(self):
         ci = ComputeIndicator(self.keyflow_id1)
         ci.calculate_indicator_flow(self.flow_a)
+
+    def test_batch(self):
+        """the batch computation returns the same values as the single one"""
+        # area 1 contains actors 1 to 3, area 2 actors 3 to 5
+        self.area1.geom = MultiPolygon(
+            Polygon(((0, 0), (0, 1), (3.5, 1), (3.5, 0), (0, 0))), srid=4326)
+        self.area1.save()
+        self.area2.geom = MultiPolygon(
+            Polygon(((2.5, 0), (2.5, 1), (6, 1), (6, 0), (2.5, 0))), srid=4326)
+        self.area2.save()
+        actors = [self.actor1, self.actor2, self.actor3, self.actor4,
+                  self.actor5]
+        for i, actor in enumerate(actors):
+            AdministrativeLocation.objects.create(
+                actor=actor, geom=Point(i + 1, 0.5, srid=4326))
+        for i, flow in enumerate([self.flow1, self.flow2, self.flow3,
+                                  self.flow4, self.flow5, self.flow6]):
+            FractionFlow.objects.create(
+                flow=flow, origin=flow.origin, destination=flow.destination,
+                material=self.material1, keyflow=self.kic,
+                amount=10 * (i + 1))
+
+        areas = [self.area1, self.area2]
+        batch = BatchFlowSums(self.kic.id, areas=areas)
+        for compute_class in [IndicatorA, IndicatorAB]:
+            for aggregate in [False, True]:
+                single = compute_class(self.kic.id).calculate(
+                    self.obj, areas=areas, aggregate=aggregate)
+                batched = compute_class(self.kic.id, batch=batch).calculate(
+                    self.obj, areas=areas, aggregate=aggregate)
+                assert single == batched
+
+        url = reverse('flowindicator-compute-batch',
+                      kwargs=dict(casestudy_pk=self.casestudy,
+                                  keyflow_pk=self.kic.id))
+        response = self.client.get(url, {'areas': '1,2'})
+        assert response.status_code == 200
+        values = response.data[self.obj.id]
+        single = IndicatorA(self.kic.id).calculate(self.obj, areas=areas)
+        for value in single:
+            self.assertAlmostEqual(values[value['area']]['value'],
+                                   value['value'])
+
+    def test_cache(self):
+        """computed values are cached until the data of the keyflow change"""
+        indicatorcache.get_cache().clear()
+        url = reverse('flowindicator-compute',
+                      kwargs=dict(casestudy_pk=self.casestudy,
+                                  keyflow_pk=self.kic.id,
+                                  pk=self.obj.id))
+        version = get_data_version(self.kic.id)
+        response = self.client.get(url)
+        assert response.status_code == 200
+        assert indicatorcache.stats()['misses'] == 1
+        assert indicatorcache.stats()['hits'] == 0
+        response_cached = self.client.get(url)
+        assert response_cached.data == response.data
+        assert indicatorcache.stats()['hits'] == 1
+
+        # a new flow changes the version of the data, the values are
+        # computed again
+        FractionFlow.objects.create(
+            flow=self.flow1, origin=self.flow1.origin,
+            destination=self.flow1.destination, material=self.material1,
+            keyflow=self.kic, amount=10)
+        assert get_data_version(self.kic.id) > version
+        self.client.get(url)
+        stats = indicatorcache.stats()
+        assert stats['misses'] == 2
+        assert stats['hits'] == 1
+
+        # the fraction flows deleted by cascade send no signals, the deleted
+        # flow does
+        version = get_data_version(self.kic.id)
+        self.flow1.delete()
+        assert get_data_version(self.kic.id) > version
+
+        # so do deleted indicators and their flows
+        version = get_data_version(self.kic.id)
+        self.obj.flow_a.delete()
+        assert get_data_version(self.kic.id) > version
+        version = get_data_version(self.kic.id)
+        self.obj.delete()
+        assert get_data_version(self.kic.id) > version
+
+        # other parameters are cached separately
+        self.client.get(url, {'aggregate': 'true'})
+        assert indicatorcache.stats()['misses'] == 3
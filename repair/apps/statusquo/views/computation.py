@@ -1,5 +1,6 @@
 from abc import ABCMeta
 import numpy as np
+import pandas as pd
 from django.db.models import Q, Sum, Case, When, F, Value
 from collections import OrderedDict
 from django.utils.translation import ugettext as _
@@ -8,20 +9,171 @@ from django.db.models.functions import Coalesce
 
 from repair.apps.utils.utils import descend_materials
 from repair.apps.asmfa.models import (Actor, FractionFlow, Process,
-                                      AdministrativeLocation, Material)
+                                      AdministrativeLocation, Material,
+                                      ActorInArea)
 from repair.apps.asmfa.serializers import Actor2ActorSerializer
 from repair.apps.utils.utils import get_annotated_fractionflows
 
-def filter_actors_by_area(actors, geom):
+def filter_actors_by_area(actors, geom=None, area=None):
     '''
-    get actors in a polygon (by administrative location)
+    get actors in a polygon (by administrative location), the precomputed
+    memberships are taken if an area is given instead of a geometry
     '''
+    if area is not None:
+        return actors.filter(
+            id__in=ActorInArea.objects.filter(area=area).values('actor'))
     locations = AdministrativeLocation.objects.filter(actor__in=actors)
     locations = locations.filter(geom__intersects=geom)
     actors_in_area = actors.filter(id__in=locations.values('actor'))
     return actors_in_area
 
 
+def actors_in_areas(area_ids):
+    '''
+    get the ids of the actors in each of the areas (by administrative
+    location), returns a dict with the area ids as keys and sets of actor ids
+    as values
+    '''
+    members = {area_id: set() for area_id in area_ids}
+    memberships = ActorInArea.objects.filter(
+        area_id__in=area_ids).values_list('area_id', 'actor_id')
+    for area_id, actor_id in memberships:
+        members[area_id].add(actor_id)
+    return members
+
+
+class BatchFlowSums:
+    '''
+    precomputed sums of the flows of a keyflow to calculate many indicators
+    for many areas at once
+
+    the flows are fetched once, summed up per origin, destination and the
+    attributes the indicator flows filter by, the actors in the areas are
+    determined once as well; the sums of the indicator flows per area are
+    computed from those in memory
+
+    Parameters
+    ----------
+    keyflow_pk : int
+        id of the keyflow
+    strategy : Strategy, optional
+        strategy to take the flows of (status quo flows if not given)
+    areas : list of Area, optional
+        areas the sums are requested for
+    geom : str, optional
+        geoJSON of a custom geometry the sums are requested for (key 'geom')
+    '''
+    def __init__(self, keyflow_pk, strategy=None, areas=[], geom=None):
+        strategy_id = getattr(strategy, 'id', None)
+        flows = get_annotated_fractionflows(keyflow_pk,
+                                            strategy_id=strategy_id)
+        rows = flows.order_by().filter(
+            origin__isnull=False, destination__isnull=False
+        ).values(
+            'origin', 'destination', 'strategy_material', 'strategy_process',
+            'strategy_waste', 'strategy_hazardous', 'avoidable'
+        ).annotate(
+            sum_amount=Sum('amount'),
+            sum_strategy_amount=Sum('strategy_amount')
+        )
+        columns = {
+            'origin': 'origin',
+            'destination': 'destination',
+            'strategy_material': 'material',
+            'strategy_process': 'process',
+            'strategy_waste': 'waste',
+            'strategy_hazardous': 'hazardous',
+            'avoidable': 'avoidable',
+            'sum_amount': 'amount',
+            'sum_strategy_amount': 'strategy_amount'
+        }
+        df = pd.DataFrame.from_records(list(rows), columns=list(columns))
+        df = df.rename(columns=columns)
+        df['process'] = df['process'].fillna(-1)
+        df[['amount', 'strategy_amount']] = \
+            df[['amount', 'strategy_amount']].fillna(0)
+
+        # the activities and activity groups of the origins and destinations
+        actors = Actor.objects.filter(
+            id__in=set(df['origin']) | set(df['destination'])).values_list(
+                'id', 'activity', 'activity__activitygroup')
+        activities = {a[0]: a[1] for a in actors}
+        groups = {a[0]: a[2] for a in actors}
+        for node in ['origin', 'destination']:
+            df[f'{node}_activity'] = df[node].map(activities)
+            df[f'{node}_activitygroup'] = df[node].map(groups)
+        self.flows = df
+
+        self.members = actors_in_areas([area.id for area in areas])
+        if geom:
+            locations = AdministrativeLocation.objects.filter(
+                geom__intersects=geom, actor__isnull=False)
+            self.members['geom'] = set(
+                locations.values_list('actor', flat=True))
+
+    @staticmethod
+    def _node_mask(df, node, node_ids, node_level):
+        if not node_ids:
+            return np.ones(len(df), dtype=bool)
+        column = node
+        if node_level.name == 'ACTIVITY':
+            column = f'{node}_activity'
+        if node_level.name == 'ACTIVITYGROUP':
+            column = f'{node}_activitygroup'
+        return df[column].isin(node_ids).values
+
+    def _mask(self, indicator_flow):
+        '''mask of the flows matching the filters of the indicator flow'''
+        df = self.flows
+        mask = np.ones(len(df), dtype=bool)
+        flow_type = indicator_flow.flow_type.name
+        hazardous = indicator_flow.hazardous.name
+        avoidable = indicator_flow.avoidable.name
+        if flow_type != 'BOTH':
+            mask &= (df['waste'] == (flow_type == 'WASTE')).values
+        if hazardous != 'BOTH':
+            mask &= (df['hazardous'] == (hazardous == 'YES')).values
+        if avoidable != 'BOTH':
+            mask &= (df['avoidable'] == (avoidable == 'YES')).values
+        if indicator_flow.process_ids:
+            process_ids = [int(p) for p in
+                           indicator_flow.process_ids.split(',')]
+            mask &= df['process'].isin(process_ids).values
+        materials = indicator_flow.materials.all()
+        if materials:
+            mats = descend_materials(list(materials))
+            mask &= df['material'].isin(mats).values
+        for node in ['origin', 'destination']:
+            node_ids = getattr(indicator_flow, f'{node}_node_ids')
+            node_ids = [int(n) for n in node_ids.split(',')] \
+                if node_ids else []
+            node_level = getattr(indicator_flow, f'{node}_node_level')
+            mask &= self._node_mask(df, node, node_ids, node_level)
+        return mask
+
+    def sum(self, indicator_flow, key=None):
+        '''
+        sum up the status quo and strategy amounts of the flows of the
+        indicator flow, in the area with the id (resp. 'geom') given as key
+        (all flows if not given)
+        '''
+        if not indicator_flow:
+            return 0, 0
+        df = self.flows
+        mask = self._mask(indicator_flow)
+        if key is not None:
+            actor_ids = self.members[key]
+            spatial = indicator_flow.spatial_application.name
+            if spatial == 'ORIGIN' or spatial == 'BOTH':
+                mask &= df['origin'].isin(actor_ids).values
+            if spatial == 'DESTINATION' or spatial == 'BOTH':
+                mask &= df['destination'].isin(actor_ids).values
+        if not mask.any():
+            return 0, 0
+        return (df['amount'].values[mask].sum().item(),
+                df['strategy_amount'].values[mask].sum().item())
+
+
 class ComputeIndicator(metaclass=ABCMeta):
     '''
     abstract class for computing indicators
@@ -31,13 +183,15 @@ class ComputeIndicator(metaclass=ABCMeta):
     default_unit = ''
     is_absolute = True
 
-    def __init__(self, keyflow_pk, strategy=None):
+    def __init__(self, keyflow_pk, strategy=None, batch=None):
         self.keyflow_pk = keyflow_pk
         self.strategy = strategy
+        # precomputed sums (BatchFlowSums) to take the amounts from
+        self.batch = batch
 
-    def get_queryset(self, indicator_flow, geom=None):
+    def get_queryset(self, indicator_flow, geom=None, area=None):
         '''filter all flows by IndicatorFlow attributes,
-        optionally filter for geometry'''
+        optionally filter for geometry or area'''
 
         # there might be unset indicators -> return empty queryset
         # (calculation will return zero)
@@ -94,12 +248,13 @@ class ComputeIndicator(metaclass=ABCMeta):
         destinations = self.get_actors(destination_node_ids,
                                            indicator_flow.destination_node_level)
 
-        if geom:
+        if geom or area:
             spatial = indicator_flow.spatial_application.name
             if spatial == 'ORIGIN' or spatial == 'BOTH':
-                origins = filter_actors_by_area(origins, geom)
+                origins = filter_actors_by_area(origins, geom=geom, area=area)
             if spatial == 'DESTINATION' or spatial == 'BOTH':
-                destinations = filter_actors_by_area(destinations, geom)
+                destinations = filter_actors_by_area(destinations, geom=geom,
+                                                     area=area)
 
         flows = flows.filter(
                 Q(origin__in=origins) & Q(destination__in=destinations))
@@ -152,6 +307,21 @@ class ComputeIndicator(metaclass=ABCMeta):
         '''
         raise NotImplementedError
 
+    def sum_indicator_flow(self, indicator_flow, func='sum', geom=None,
+                           area=None, key=None):
+        '''
+        aggregate the status quo and the strategy amounts of the flows of the
+        indicator flow (in the geometry or area, key identifies it in the
+        batch), returns a tuple of both amounts
+        '''
+        if self.batch is not None and func == 'sum':
+            return self.batch.sum(indicator_flow, key=key)
+        agg_func = getattr(self, func)
+        flows = self.get_queryset(indicator_flow, geom=geom, area=area)
+        amount = agg_func(flows, field='amount')
+        strategy_amount = agg_func(flows, field='strategy_amount')
+        return amount, strategy_amount
+
     def calculate_indicator_flow(self, indicator_flow, areas=[],
                                  geom=None, aggregate=False, func='sum'):
         ''' calculate single IndicatorFlow by filtering and aggregating flows
@@ -182,25 +352,16 @@ class ComputeIndicator(metaclass=ABCMeta):
               aggregating areas)
         '''
 
-        agg_func = getattr(self, func)
         # single value (nothing to iterate)
         if (not areas or len(areas)) == 0 and not geom:
-            flows = self.get_queryset(indicator_flow, geom=geom)
-            amount = agg_func(flows, field='amount')
-            strategy_amount = agg_func(flows, field='strategy_amount')
-            return {-1: (amount, strategy_amount)}
+            return {-1: self.sum_indicator_flow(indicator_flow, func=func)}
         amounts = {}
-        geometries = []
         if geom:
-            geometries.append(('geom', geom))
+            amounts['geom'] = self.sum_indicator_flow(
+                indicator_flow, func=func, geom=geom, key='geom')
         for area in areas:
-            geom = area.geom
-            geometries.append((area.id, geom))
-        for g_id, geometry in geometries:
-            flows = self.get_queryset(indicator_flow, geom=geometry)
-            amount = agg_func(flows, field='amount')
-            strategy_amount = agg_func(flows, field='strategy_amount')
-            amounts[g_id] = (amount, strategy_amount)
+            amounts[area.id] = self.sum_indicator_flow(
+                indicator_flow, func=func, area=area, key=area.id)
         if aggregate:
             total_sum = 0
             total_strategy_amount = 0
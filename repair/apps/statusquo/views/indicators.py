@@ -1,3 +1,5 @@
+from collections import OrderedDict
+import numpy as np
 from reversion.views import RevisionMixin
 from rest_framework.response import Response
 from rest_framework.utils.serializer_helpers import ReturnList
@@ -11,6 +13,9 @@ from repair.apps.changes.models import Strategy
 from repair.apps.statusquo.models import FlowIndicator
 from repair.apps.statusquo.serializers import FlowIndicatorSerializer
 from repair.apps.studyarea.models import Area
+from repair.apps.statusquo.views.computation import BatchFlowSums
+from repair.apps.statusquo import indicatorcache
+from repair.apps.asmfa.dataversion import get_data_version
 
 
 
@@ -29,43 +34,132 @@ class FlowIndicatorViewSet(RevisionMixin, CasestudyViewSetMixin,
                 flow.delete()
         return super().destroy(request, **kwargs)
 
+    def _get_strategy(self, request):
+        '''
+        return the strategy requested (None if not requested), raises
+        ValueError if it is not calculated yet
+        '''
+        strategy = (request.data.get('strategy', None) or
+                    request.query_params.get('strategy', None))
+        if not strategy:
+            return None
+        strategy = Strategy.objects.get(id=strategy)
+        if strategy.status == 0:
+            raise ValueError(_('calculation is not done yet'))
+        if strategy.status == 1:
+            raise ValueError(_('calculation is still in process'))
+        return strategy
+
+    @staticmethod
+    def _get_param(request, name):
+        return (request.data.get(name, None) or
+                request.query_params.get(name, None))
+
     @action(methods=['get', 'post'], detail=True)
     def compute(self, request, **kwargs):
         self.check_permission(request, 'view')
         indicator = self.get_queryset().get(id=kwargs.get('pk', None))
-        query_params = request.query_params
-        body_params = request.data
         if not indicator:
             raise Http404
         compute_class = indicator.get_type()
-        geom = body_params.get('geom', None) or query_params.get('geom', None)
+        geom = self._get_param(request, 'geom')
         if geom == 'null':
             geom = None
-        areas = (body_params.get('areas', None) or
-                 query_params.get('areas', None))
-        aggregate = (body_params.get('aggregate', None) or
-                     query_params.get('aggregate', None))
-        strategy = (body_params.get('strategy', None) or
-                    query_params.get('strategy', None))
-        if strategy:
-            strategy = Strategy.objects.get(id=strategy)
-            if strategy.status == 0:
-                return HttpResponseBadRequest(
-                    _('calculation is not done yet'))
-            if strategy.status == 1:
-                return HttpResponseBadRequest(
-                    _('calculation is still in process'))
+        areas = self._get_param(request, 'areas')
+        aggregate = self._get_param(request, 'aggregate')
+        try:
+            strategy = self._get_strategy(request)
+        except ValueError as e:
+            return HttpResponseBadRequest(str(e))
         keyflow_pk = self.kwargs.get('keyflow_pk')
         compute = compute_class(keyflow_pk=keyflow_pk, strategy=strategy)
         if aggregate is not None:
             aggregate = aggregate.lower() == 'true'
         if areas:
-            areas = areas.split(',')
-            areas = Area.objects.filter(id__in=areas)
-        values = compute.calculate(indicator, areas=areas or [], geom=geom,
-                                  aggregate=aggregate)
+            areas = list(Area.objects.filter(id__in=areas.split(',')))
+        key = indicatorcache.make_key(
+            indicator.id, keyflow_pk,
+            strategy_id=strategy.id if strategy else None,
+            area_ids=[area.id for area in areas or []],
+            geom=geom, aggregate=aggregate)
+        values = indicatorcache.get_or_compute(
+            key, lambda: compute.calculate(indicator, areas=areas or [],
+                                           geom=geom, aggregate=aggregate))
         return Response(values)
 
+    @action(methods=['get', 'post'], detail=False)
+    def compute_batch(self, request, **kwargs):
+        '''
+        compute multiple indicators for multiple areas at once
+
+        params (query or body):
+            indicators: comma separated ids of the indicators, defaults to
+                        all indicators of the keyflow
+            areas: comma separated ids of the areas
+            geom: geoJSON of a custom geometry
+            aggregate: 'true' to aggregate the values of the areas
+            strategy: id of the strategy
+
+        returns the values of the indicators in the same format as compute
+        by indicator id and area id (resp. 'geom' or -1 if aggregated)
+        '''
+        self.check_permission(request, 'view')
+        indicators = self.get_queryset()
+        indicator_ids = self._get_param(request, 'indicators')
+        if indicator_ids:
+            indicators = indicators.filter(id__in=indicator_ids.split(','))
+        geom = self._get_param(request, 'geom')
+        if geom == 'null':
+            geom = None
+        areas = self._get_param(request, 'areas')
+        areas = list(Area.objects.filter(id__in=areas.split(','))) \
+            if areas else []
+        aggregate = self._get_param(request, 'aggregate')
+        if aggregate is not None:
+            aggregate = aggregate.lower() == 'true'
+        try:
+            strategy = self._get_strategy(request)
+        except ValueError as e:
+            return HttpResponseBadRequest(str(e))
+
+        keyflow_pk = self.kwargs.get('keyflow_pk')
+        version = get_data_version(keyflow_pk)
+        batch = None
+        results = OrderedDict()
+        indicators = indicators.select_related(
+            'flow_a', 'flow_b').prefetch_related(
+                'flow_a__materials', 'flow_b__materials')
+        for indicator in indicators:
+            key = indicatorcache.make_key(
+                indicator.id, keyflow_pk,
+                strategy_id=strategy.id if strategy else None,
+                area_ids=[area.id for area in areas], geom=geom,
+                aggregate=aggregate, version=version)
+            values = indicatorcache.lookup(key)
+            if values is None:
+                # the flows and the actors in the areas are fetched only once
+                # and shared by all indicators not cached yet
+                if batch is None:
+                    batch = BatchFlowSums(keyflow_pk, strategy=strategy,
+                                          areas=areas, geom=geom)
+                compute_class = indicator.get_type()
+                compute = compute_class(keyflow_pk=keyflow_pk,
+                                        strategy=strategy, batch=batch)
+                values = compute.calculate(indicator, areas=areas, geom=geom,
+                                           aggregate=aggregate)
+                indicatorcache.store(key, values)
+            # some indicators return the area ids as numpy types
+            results[indicator.id] = OrderedDict(
+                (np.asarray(value['area']).item(), value)
+                for value in values)
+        return Response(results)
+
+    @action(methods=['get'], detail=False)
+    def cache_stats(self, request, **kwargs):
+        '''hits and misses of the cache of the computed indicators'''
+        self.check_permission(request, 'view')
+        return Response(indicatorcache.stats())
+
     def get_queryset(self):
         keyflow_pk = self.kwargs.get('keyflow_pk')
         queryset = self.queryset
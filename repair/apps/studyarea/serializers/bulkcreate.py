@@ -4,6 +4,7 @@ from repair.apps.studyarea.serializers.areas import (AdminLevelSerializer,
                                                      AreaSerializer)
 from repair.apps.studyarea.models import (AdminLevels, Area)
 from django.db import transaction
+from repair.apps.asmfa.actorareas import update_area_actors
 
 
 class AreaCreateSerializer(BulkSerializerMixin, AreaSerializer):
@@ -32,6 +33,13 @@ class AreaCreateSerializer(BulkSerializerMixin, AreaSerializer):
     def get_queryset(self):
         return Area.objects.filter(adminlevel__casestudy=self.casestudy)
 
+    def save_data(self, dataframe):
+        new, updated = super().save_data(dataframe)
+        # bulk created and updated areas don't send signals
+        update_area_actors([area.id for area in new] +
+                           [area.id for area in updated])
+        return new, updated
+
 
 class AdminLevelCreateSerializer(BulkSerializerMixin, AdminLevelSerializer):
     field_map = {
@@ -1,6 +1,7 @@
 from typing import Type
 import pandas as pd
 from django_pandas.io import read_frame
+from django.db import transaction
 from django.db.utils import Error
 from django.contrib.gis.geos.error import GEOSException
 from django.contrib.gis.db.models.functions import GeoFunc
@@ -14,7 +15,10 @@ from tempfile import NamedTemporaryFile
 from rest_framework import serializers
 from django.db.models import Model
 from django.db.models.fields import (IntegerField, DecimalField,
-                                     FloatField, BooleanField)
+                                     FloatField, BooleanField,
+                                     CharField, TextField)
+from django.core import exceptions
+from decimal import Decimal
 from django.contrib.gis.db.models.fields import (PointField, PolygonField,
                                                  MultiPolygonField)
 from django.contrib.gis.geos import GEOSGeometry, WKTWriter
@@ -23,11 +27,41 @@ from django.conf import settings
 from copy import deepcopy
 from openpyxl import Workbook
 from openpyxl.writer.excel import save_virtual_workbook
+import reversion
+from djmoney.models.fields import MoneyField
 
 from repair.apps.asmfa.models import KeyflowInCasestudy
+from repair.apps.asmfa.dataversion import bump_data_version
 from repair.apps.login.models import CaseStudy
 
 
+def _typed_value(field, value):
+    '''
+    the value of a row or a model as the python type of the model field,
+    used to match rows with models (NaN is None, 1.0 and '1' are 1)
+    '''
+    value = getattr(value, 'id', value)
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return None
+    if field.is_relation:
+        field = field.target_field
+    is_text = isinstance(field, (CharField, TextField))
+    if isinstance(value, str) and not is_text:
+        try:
+            value = field.to_python(value)
+        except exceptions.ValidationError:
+            return value
+    # integral numbers read as floats from columns with missing values
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    elif (isinstance(value, Decimal) and value.is_finite() and
+          value == value.to_integral_value()):
+        value = int(value)
+    if is_text:
+        value = str(value)
+    return value
+
+
 class MakeValid(GeoFunc):
     function='ST_MakeValid'
 
@@ -239,17 +273,32 @@ class Reference:
 class ErrorMask:
     def __init__(self, dataframe):
         self.dataframe = dataframe.copy()
-        self.error_matrix = pd.DataFrame(
-            columns=dataframe.columns,
-            index=dataframe.index).fillna(0)
-        self.error_matrix.index = self.dataframe.index
+        # error messages per column (0 if no error), the matrix with all
+        # columns is only built when needed
+        self._errors = {}
         self._messages = []
 
     def add_message(self, msg):
         self._messages.append(msg)
 
     def set_error(self, indices, column, message):
-        self.error_matrix.loc[indices, column] = message
+        errors = self._errors.get(column, None)
+        if errors is None:
+            errors = np.zeros(len(self.dataframe), dtype=object)
+            self._errors[column] = errors
+        errors[self.dataframe.index.isin(indices)] = message
+
+    @property
+    def error_matrix(self):
+        '''
+        same dimension as the dataframe, no error: 0,
+        error: error message as string
+        '''
+        matrix = pd.DataFrame(0, columns=self.dataframe.columns,
+                              index=self.dataframe.index, dtype=object)
+        for column, errors in self._errors.items():
+            matrix[column] = errors
+        return matrix
 
     @property
     def messages(self):
@@ -257,7 +306,7 @@ class ErrorMask:
 
     @property
     def count(self):
-        return (self.error_matrix != 0).sum().sum()
+        return sum((errors != 0).sum() for errors in self._errors.values())
 
     def to_file(self, file_type='csv', encoding='cp1252'):
         '''
@@ -511,47 +560,84 @@ class BulkSerializerMixin(metaclass=serializers.SerializerMetaclass):
         df_done = df_done.rename(columns=rename)
         return df_done
 
-    def _parse_int(self, x):
-        try:
-            return int(x)
-        except:
-            return np.NaN
-
-    def _parse_float(self, x):
-        if isinstance(x, str):
-            n_c = x.count(',')
-            n_p = x.count('.')
-            if n_c + n_p > 1:
-                return np.NaN
-            x = x.replace(',', '.')
-        try:
-            return float(x)
-        except:
-            return np.NaN
-
-    def _parse_bool(self, x):
-        if isinstance(x, bool):
-            return x
-        x = x.lower()
-        if x == 'true':
-            return True
-        elif x == 'false':
-            return False
-        else:
-            return np.NaN
+    @staticmethod
+    def _split_strings(entries):
+        '''
+        return the stripped string entries and the other (e.g. numbers read
+        from excel files) entries of the series
+        '''
+        is_str = entries.map(type) == str
+        return entries[is_str].astype(object).str.strip(), entries[~is_str]
 
-    def _parse_wkt(self, x):
-        try:
-            if not isinstance(x, str):
-                return np.NaN
-            geom = GEOSGeometry(x)
-            if not geom.valid:
-                return geom.valid_reason
-            # force 2d
-            geom2d = GEOSGeometry(self.wkt_w.write(geom))
-        except GEOSException as e:
-            return str(e)
-        return geom2d
+    def _parse_ints(self, entries):
+        '''
+        parse the entries to integers, numbers with decimals are truncated,
+        strings have to be integers, NaN if not parsable
+        '''
+        strings, others = self._split_strings(entries)
+        valid = strings.str.match(r'^[+-]?\d+(_\d+)*$')
+        strings = pd.to_numeric(
+            strings[valid].str.replace('_', ''), errors='coerce')
+        others = np.trunc(pd.to_numeric(others, errors='coerce'))
+        parsed = pd.concat([strings, others]).reindex(entries.index)
+        if parsed.notna().all():
+            parsed = parsed.astype('int64')
+        return parsed
+
+    def _parse_floats(self, entries):
+        '''
+        parse the entries to floats, either "," or "." is accepted as decimal
+        separator (no thousands separators), NaN if not parsable
+        '''
+        strings, others = self._split_strings(entries)
+        valid = strings.str.count(r'[,.]') <= 1
+        strings = pd.to_numeric(
+            strings[valid].str.replace(',', '.', regex=False),
+            errors='coerce')
+        others = pd.to_numeric(others, errors='coerce')
+        return pd.concat([strings, others]).reindex(entries.index)
+
+    def _parse_bools(self, entries):
+        '''
+        parse the entries to booleans ("true" or "false" in any letter case),
+        NaN if not parsable
+        '''
+        is_str = entries.map(type) == str
+        strings = entries[is_str].astype(object).str.lower().map(
+            {'true': True, 'false': False})
+        others = entries[~is_str]
+        others = others.where(others.map(type) == bool)
+        return pd.concat([strings, others]).reindex(entries.index)
+
+    def _parse_wkts(self, entries):
+        '''
+        parse the wkt strings to 2D geometries, each distinct string is parsed
+        only once, the entries that could not be parsed are set to the error
+        messages (strings), the non-strings to NaN
+        '''
+        wkt_w = WKTWriter(dim=2)
+        parsed = {}
+        for wkt in pd.unique(entries[entries.map(type) == str]):
+            try:
+                geom = GEOSGeometry(wkt)
+                if not geom.valid:
+                    parsed[wkt] = geom.valid_reason
+                    continue
+                # force 2d (rewriting only geometries with z-coordinates)
+                if geom.hasz:
+                    geom = GEOSGeometry(wkt_w.write(geom))
+                else:
+                    geom.srid = None
+            except GEOSException as e:
+                parsed[wkt] = str(e)
+                continue
+            parsed[wkt] = geom
+        geoms = entries.map(lambda wkt: parsed.get(wkt, np.NaN))
+        # every row gets its own geometry
+        duplicated = entries.duplicated() & entries.notna()
+        geoms[duplicated] = geoms[duplicated].map(
+            lambda g: g.clone() if isinstance(g, GEOSGeometry) else g)
+        return geoms
 
     def _parse_columns(self, dataframe):
         '''
@@ -569,10 +655,8 @@ class BulkSerializerMixin(metaclass=serializers.SerializerMetaclass):
             if (isinstance(field, PointField)
                 or isinstance(field, PolygonField)
                 or isinstance(field, MultiPolygonField)):
-                self.wkt_w = WKTWriter(dim=2)
-                dataframe['wkt'] = dataframe['wkt'].apply(self._parse_wkt)
-                types = dataframe['wkt'].apply(type)
-                str_idx = types == str
+                dataframe['wkt'] = self._parse_wkts(dataframe['wkt'])
+                str_idx = dataframe['wkt'].map(type) == str
                 error_idx = dataframe.index[str_idx]
                 error_msg = _('invalid geometry')
                 self.error_mask.set_error(error_idx, 'wkt', error_msg)
@@ -589,16 +673,16 @@ class BulkSerializerMixin(metaclass=serializers.SerializerMetaclass):
                 not_na = dataframe[column].notna()
                 entries = dataframe[column].loc[not_na]
                 if isinstance(field, IntegerField):
-                    entries = entries.apply(self._parse_int)
+                    entries = self._parse_ints(entries)
                     error_msg = _('Integer expected: number without decimals')
                 elif (isinstance(field, FloatField) or
                       isinstance(field, DecimalField)):
-                    entries = entries.apply(self._parse_float)
+                    entries = self._parse_floats(entries)
                     error_msg = _('Float expected: number with or without '
                                   'decimals; use either "," or "." as decimal-'
                                   'seperators, no thousand-seperators allowed')
                 elif isinstance(field, BooleanField):
-                    entries = entries.apply(self._parse_bool)
+                    entries = self._parse_bools(entries)
                     error_msg = _('Boolean expected ("true" or "false")')
                 # nan is used to determine parsing errors
                 error_idx = entries[entries.isna()].index
@@ -712,9 +796,13 @@ class BulkSerializerMixin(metaclass=serializers.SerializerMetaclass):
                 df[field_name] = df[field_name].apply(
                     lambda x: x.id if hasattr(x, 'id') else x)
 
+        # compare the typed values (as strings, object columns may contain
+        # mixed types)
         for col in self.index_fields:
-            df_existing[col] = df_existing[col].map(str)
-            df[col] = df[col].map(str)
+            field = self.Meta.model._meta.get_field(col)
+            to_key = lambda v: str(_typed_value(field, v))
+            df_existing[col] = df_existing[col].map(to_key)
+            df[col] = df[col].map(to_key)
 
         merged = df.merge(df_existing,
                           how='left',
@@ -730,38 +818,40 @@ class BulkSerializerMixin(metaclass=serializers.SerializerMetaclass):
         df_update = dataframe.loc[idx_both]
 
         try:
-            #  map the self references now
-            if self.self_refs:
-                df_new_tmp = df_new.copy()
-                # create models without the self-references
-                for column in self.self_refs:
-                    df_new_tmp[column] = None
-                refs = self.self_refs.copy()
-                new_models = self._create_models(df_new_tmp)
-                # map the self-references on the newly created models
-                df_mapped = self._map_fields(dataframe,
-                                             columns=self.self_refs,
-                                             skip_self_references=False)
-                # check the errors occured while mapping
-                if self.error_mask.count > 0:
-                    # rollback on error
-                    for m in new_models:
-                        m.delete()
-                    fn, url = self.error_mask.to_file(
-                        file_type=self.input_file_ext.replace('.', ''),
-                        encoding=self.encoding
-                    )
-                    raise ValidationError(
-                        self.error_mask.messages, url
-                    )
-                # renaming was skipped before
-                rename = {v: self.field_map[v].name for v in refs}
-                df_mapped.rename(columns=rename, inplace=True)
-                new_models = self._update_models(df_mapped)
-                df_update = df_mapped.loc[idx_both]
-            else:
-                new_models = self._create_models(df_new)
-            updated_models = self._update_models(df_update)
+            # nothing is written if any of the rows is not valid
+            with transaction.atomic():
+                #  map the self references now
+                if self.self_refs:
+                    df_new_tmp = df_new.copy()
+                    # create models without the self-references
+                    for column in self.self_refs:
+                        df_new_tmp[column] = None
+                    refs = self.self_refs.copy()
+                    new_models = self._create_models(df_new_tmp)
+                    # map the self-references on the newly created models
+                    df_mapped = self._map_fields(dataframe,
+                                                 columns=self.self_refs,
+                                                 skip_self_references=False)
+                    # check the errors occured while mapping
+                    if self.error_mask.count > 0:
+                        # rollback on error
+                        for m in new_models:
+                            m.delete()
+                        fn, url = self.error_mask.to_file(
+                            file_type=self.input_file_ext.replace('.', ''),
+                            encoding=self.encoding
+                        )
+                        raise ValidationError(
+                            self.error_mask.messages, url
+                        )
+                    # renaming was skipped before
+                    rename = {v: self.field_map[v].name for v in refs}
+                    df_mapped.rename(columns=rename, inplace=True)
+                    new_models = self._update_models(df_mapped)
+                    df_update = df_mapped.loc[idx_both]
+                else:
+                    new_models = self._create_models(df_new)
+                updated_models = self._update_models(df_update)
         except Error as e:
             # ToDo: formatted message
             raise ValidationError(str(e))
@@ -781,9 +871,23 @@ class BulkSerializerMixin(metaclass=serializers.SerializerMetaclass):
             index_fields.append(i)
         return index_fields
 
+    # number of rows written at once when updating existing models
+    update_batch_size = 1000
+
+    def _index_key(self, values):
+        '''key to match rows with models by the typed values of their index
+        fields'''
+        model = self.Meta.model
+        return tuple(_typed_value(model._meta.get_field(f), v)
+                     for f, v in zip(self.index_fields, values))
+
     def _update_models(self, dataframe):
         '''
         update the models with the data in dataframe
+
+        the existing models are fetched at once and written in batches
+        (bypassing save() and the signals), the models are added to the
+        active revision
         '''
         if len(dataframe) == 0:
             return []
@@ -792,21 +896,68 @@ class BulkSerializerMixin(metaclass=serializers.SerializerMetaclass):
         # only fields defined in field_map will be written to database
         fields = [getattr(v, 'name', None) or v
                   for v in self.field_map.values()]
-        updated = []
+        update_fields = []
+        for c in dataframe.columns:
+            if c not in fields:
+                continue
+            field = model._meta.get_field(c)
+            if field.concrete and not field.primary_key:
+                update_fields.append(c)
+                # money is stored in two columns, the amount and the currency
+                if isinstance(field, MoneyField):
+                    update_fields.append(
+                        getattr(field, 'currency_field_name', None) or
+                        f'{c}_currency')
 
         dataframe = self._set_defaults(dataframe, model)
 
-        for row in dataframe.itertuples(index=False):
-            filter_kwargs = {c: getattr(row, c) for c in self.index_fields}
-            model = queryset.get(**filter_kwargs)
-            for c, v in row._asdict().items():
-                if c not in fields:
-                    continue
-                if type(v) in [int, float] and np.isnan(v):
+        # existing models by the values of their index fields
+        attnames = [model._meta.get_field(f).attname
+                    for f in self.index_fields]
+        existing = {}
+        for instance in queryset:
+            key = self._index_key(getattr(instance, a) for a in attnames)
+            existing.setdefault(key, instance)
+
+        updated = []
+        unmatched = []
+        for idx, row in zip(dataframe.index,
+                            dataframe.itertuples(index=False)):
+            key = self._index_key(getattr(row, c) for c in self.index_fields)
+            instance = existing.get(key)
+            if instance is None:
+                unmatched.append(idx)
+                continue
+            row = row._asdict()
+            for c in update_fields:
+                v = row[c]
+                if isinstance(v, float) and np.isnan(v):
                     v = None
-                setattr(model, c, v)
-            model.save()
-            updated.append(model)
+                setattr(instance, c, v)
+            updated.append(instance)
+        if unmatched:
+            for column in self.index_columns:
+                self.error_mask.set_error(unmatched, column,
+                                          _('no matching entry found'))
+            self.error_mask.add_message(
+                _('{n} rows to update do not match any existing entry'
+                  .format(n=len(unmatched))))
+            fn, url = self.error_mask.to_file(
+                file_type=self.input_file_ext.replace('.', ''),
+                encoding=self.encoding
+            )
+            raise ValidationError(self.error_mask.messages, url)
+        # rows with the same index update the same model
+        updated = list({id(m): m for m in updated}.values())
+
+        with transaction.atomic():
+            if update_fields:
+                model.objects.bulk_update(updated, update_fields,
+                                          batch_size=self.update_batch_size)
+            # save() would have added the models to the revision
+            if reversion.is_active() and reversion.is_registered(model):
+                for instance in updated:
+                    reversion.add_to_revision(instance)
         updated = queryset.filter(id__in=[m.id for m in updated])
         return updated
 
@@ -897,9 +1048,24 @@ class BulkSerializerMixin(metaclass=serializers.SerializerMetaclass):
         dataframe = validated_data['dataframe']
         dataframe = self.parse_dataframe(dataframe)
         new, updated = self.save_data(dataframe)
+        # models are created and updated in bulk without sending signals
+        self.bump_data_version()
         result = BulkResult(created=new, updated=updated)
         return result
 
+    def bump_data_version(self):
+        '''
+        mark the data of the keyflow (resp. all keyflows of the casestudy)
+        as changed
+        '''
+        url_pks = self.context['request'].session.get('url_pks', {})
+        keyflow_id = url_pks.get('keyflow_pk')
+        casestudy_id = url_pks.get('casestudy_pk')
+        if keyflow_id:
+            bump_data_version(id=keyflow_id)
+        elif casestudy_id:
+            bump_data_version(casestudy=casestudy_id)
+
     def to_representation(self, instance):
         """
         Object instance -> Dict of primitive datatypes.
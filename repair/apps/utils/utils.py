@@ -1,7 +1,10 @@
 from repair.apps.asmfa.models import Material
 from django.db.models.functions import Coalesce
 from django.db.models import (AutoField, Q, F, Case, When, FilteredRelation)
-from repair.apps.asmfa.models import FractionFlow
+from django.db import connection, transaction
+from repair.apps.asmfa.models import FractionFlow, StrategyFlow
+from repair.apps.asmfa.materialtree import get_material_tree
+from repair.apps.changes.models import Strategy
 
 def copy_django_model(obj):
     initial = dict([(f.name, getattr(obj, f.name))
@@ -14,37 +17,9 @@ def descend_materials(materials):
     """return list of material ids of given materials and all of their
     descendants
     """
-    mats = []
-    all_materials = Material.objects.values_list('id', 'parent__id')
-    mat_dict = {}
-
-    # might seem strange to build a dict with all materials and it's
-    # children, but this is in fact 1000 times faster than
-    # doing this in iteration over given material queryset
-    for mat_id, parent_id in all_materials:
-        if not parent_id:
-            continue
-        parent_entry = mat_dict.get(parent_id)
-        if not parent_entry:
-            parent_entry = []
-            mat_dict[parent_id] = parent_entry
-        parent_entry.append(mat_id)
-
-    def get_descendants(mat_id):
-        descendants = []
-        children = mat_dict.get(mat_id, [])
-        for child_id in children:
-            descendants.append(child_id)
-            descendants.extend(get_descendants(child_id))
-        return descendants
-
-    # use the dict to get all descending child materials
-    for material in materials:
-        # get the children of the given material
-        mats.extend(get_descendants(material.id))
-        # fractions have to contain children and the material itself
-        mats.append(material.id)
-    return mats
+    ids = [material.id for material in materials]
+    # the hierarchy is cached, no need to query all materials every time
+    return get_material_tree(*ids).descend(ids)
 
 
 def get_annotated_fractionflows(keyflow_id, strategy_id=None):
@@ -56,6 +31,11 @@ def get_annotated_fractionflows(keyflow_id, strategy_id=None):
 
     strategy fraction flows override fields of fraction flow (prefix 'strategy_') if
     changed in strategy
+
+    the values of calculated strategies are read from the materialized
+    StrategyFlows (see refresh_strategy_flows), the ones of strategies not
+    materialized (yet) or materialized before the status quo of the keyflow
+    or the calculation of the strategy changed are joined on the fly
     '''
 
     queryset = FractionFlow.objects
@@ -74,29 +54,104 @@ def get_annotated_fractionflows(keyflow_id, strategy_id=None):
                 # just setting Value(0) doesn't seem to work
                 strategy_delta=F('strategy_amount') - F('amount')
         )
-    else:
-        qs1 = queryset.filter(
-            Q(keyflow__id=keyflow_id) &
-            (Q(strategy__isnull=True) |
-             Q(strategy_id=strategy_id))
-        )
-        qsfiltered = qs1.annotate(sf=FilteredRelation(
-            'f_strategyfractionflow',
-            condition=Q(f_strategyfractionflow__strategy=strategy_id)))
-        queryset = qsfiltered.annotate(
-            # strategy fraction flow overrides amounts
-            strategy_amount=Coalesce('sf__amount', 'amount'),
-            strategy_material=Coalesce('sf__material', 'material'),
-            strategy_material_name=Coalesce(
-                'sf__material__name', 'material__name'),
-            strategy_material_level=Coalesce(
-                'sf__material__level', 'material__level'),
-            strategy_waste=Coalesce('sf__waste', 'waste'),
-            strategy_hazardous=Coalesce('sf__hazardous', 'hazardous'),
-            strategy_process=Coalesce('sf__process', 'process'),
-            #strategy_delta=Case(When(strategy=strategy,
-                                     #then=F('strategy_amount')),
-                                #default=F('strategy_amount') - F('amount'))
+    elif _is_materialized(keyflow_id, strategy_id):
+        # the annotations reuse the join of the filter
+        queryset = queryset.filter(
+            keyflow__id=keyflow_id,
+            f_strategyflow__strategy=strategy_id).annotate(
+                strategy_amount=F('f_strategyflow__amount'),
+                strategy_material=F('f_strategyflow__material'),
+                strategy_material_name=F('f_strategyflow__material__name'),
+                strategy_material_level=F('f_strategyflow__material__level'),
+                strategy_waste=F('f_strategyflow__waste'),
+                strategy_hazardous=F('f_strategyflow__hazardous'),
+                strategy_process=F('f_strategyflow__process'),
         )
+    else:
+        queryset = _join_strategy_fractionflows(queryset, keyflow_id,
+                                                strategy_id)
 
     return queryset.order_by('origin', 'destination')
+
+
+def _is_materialized(keyflow_id, strategy_id):
+    '''
+    return True if the materialized flows of the strategy are up to date
+    '''
+    # all flows of a strategy are materialized with the same versions
+    return StrategyFlow.objects.filter(
+        strategy_id=strategy_id,
+        statusquo_version=F('strategy__keyflow__statusquo_version'),
+        build_version=F('strategy__build_version')).exists()
+
+
+def _join_strategy_fractionflows(queryset, keyflow_id, strategy_id):
+    '''
+    annotate the fraction flows of the keyflow with the values of the
+    strategy fraction flows of the strategy
+    '''
+    qs1 = queryset.filter(
+        Q(keyflow__id=keyflow_id) &
+        (Q(strategy__isnull=True) |
+         Q(strategy_id=strategy_id))
+    )
+    qsfiltered = qs1.annotate(sf=FilteredRelation(
+        'f_strategyfractionflow',
+        condition=Q(f_strategyfractionflow__strategy=strategy_id)))
+    return qsfiltered.annotate(
+        # strategy fraction flow overrides amounts
+        strategy_amount=Coalesce('sf__amount', 'amount'),
+        strategy_material=Coalesce('sf__material', 'material'),
+        strategy_material_name=Coalesce(
+            'sf__material__name', 'material__name'),
+        strategy_material_level=Coalesce(
+            'sf__material__level', 'material__level'),
+        strategy_waste=Coalesce('sf__waste', 'waste'),
+        strategy_hazardous=Coalesce('sf__hazardous', 'hazardous'),
+        strategy_process=Coalesce('sf__process', 'process'),
+        #strategy_delta=Case(When(strategy=strategy,
+                                 #then=F('strategy_amount')),
+                            #default=F('strategy_amount') - F('amount'))
+    )
+
+
+def clear_strategy_flows(strategy):
+    '''
+    remove the materialized flows of the strategy, the flows are joined
+    on the fly until they are refreshed again
+    '''
+    StrategyFlow.objects.filter(strategy=strategy).delete()
+
+
+def refresh_strategy_flows(strategy):
+    '''
+    materialize the effective values of all flows of the strategy
+    (status quo flows overridden by the strategy fraction flows and the new
+    flows of the strategy) as StrategyFlows, should be called whenever the
+    calculation of the strategy is done (after bumping its build version)
+    '''
+    values = _join_strategy_fractionflows(
+        FractionFlow.objects, strategy.keyflow_id, strategy.id
+    ).order_by().values_list(
+        'id', 'strategy_amount', 'strategy_material', 'strategy_process',
+        'strategy_waste', 'strategy_hazardous')
+    select, params = values.query.sql_with_params()
+    qn = connection.ops.quote_name
+    meta = StrategyFlow._meta
+    columns = ['strategy_id', 'statusquo_version', 'build_version',
+               'fractionflow_id', 'amount', 'material_id', 'process_id',
+               'waste', 'hazardous']
+    query = (
+        f'INSERT INTO {qn(meta.db_table)} '
+        f'({", ".join(qn(c) for c in columns)}) '
+        f'SELECT %s, %s, %s, q.{qn("id")}, q.{qn("strategy_amount")}, '
+        f'q.{qn("strategy_material")}, q.{qn("strategy_process")}, '
+        f'q.{qn("strategy_waste")}, q.{qn("strategy_hazardous")} '
+        f'FROM ({select}) q'
+    )
+    with transaction.atomic():
+        clear_strategy_flows(strategy)
+        versions = Strategy.objects.values_list(
+            'keyflow__statusquo_version', 'build_version').get(id=strategy.id)
+        with connection.cursor() as cursor:
+            cursor.execute(query, (strategy.id, ) + versions + tuple(params))
@@ -220,6 +220,29 @@ MEDIA_URL = '/media/'
 TEMP_MEDIA_ROOT = os.path.join(MEDIA_ROOT, 'tmp')
 # dir to store the graphs in
 GRAPH_ROOT = os.path.join(MEDIA_ROOT, 'graphs')
+# number of strategies calculated in parallel in the background
+# (per server process)
+STRATEGY_CALCULATION_CONCURRENCY = 2
+# number of processes recalculating all strategies of a keyflow or
+# casestudy in the background (per server process, defaults to the number
+# of cpus)
+STRATEGY_REBUILD_PROCESSES = None
+# seconds after which running calculations are considered lost
+STRATEGY_CALCULATION_TIMEOUT = 6 * 60 * 60
+# engine propagating the changes of solutions through the graphs,
+# 'bfs' (breadth-first-search) or 'linear' (sparse linear systems)
+GRAPH_WALKER_ENGINE = 'bfs'
+# memory budget (in bytes) of the base graphs cached per server process
+GRAPH_CACHE_SIZE = 512 * 1024 ** 2
+# maximum age (in seconds) of the hierarchy of materials cached per server
+# process, changes of other processes are picked up after this time
+MATERIAL_TREE_MAX_AGE = 60
+# alias of the cache (see CACHES) the computed indicators are stored in, the
+# default local memory cache is per server process, configure a file based
+# cache to share the values (and the hit/miss statistics) between processes
+INDICATOR_CACHE = 'default'
+# seconds until the cached values of the indicators expire
+INDICATOR_CACHE_TIMEOUT = 24 * 60 * 60
 
 STATICFILES_DIRS = [
     os.path.join(PROJECT_DIR, "static"),